@@ -0,0 +1,235 @@
+# app/artifacts.py
+"""
+Almacén de artefactos en un volumen compartido (ARTIFACTS_DIR) para que cada
+modelo se entrene una vez por cluster y el resto de réplicas/workers lo cargue
+en solo lectura:
+
+- Estimadores/pipelines (KMeans, IsolationForest, pipeline supervisado, MLP,
+  pesos de autoencoder): joblib sin compresión, cargado con mmap_mode="r"
+  (los ndarrays quedan memory-mapped y compartidos entre procesos vía page cache).
+- Bundles de arrays (matrices estandarizadas, medias, escalas): un .npy por
+  array, cargados con np.load(mmap_mode="r"), zero-copy.
+
+Cada entrada vive en ARTIFACTS_DIR/<kind>/<key>/ donde key incluye la huella
+de los datos (versionado por datos). La escritura es atómica: se escribe en un
+directorio temporal y se publica con rename. Si ARTIFACTS_DIR no está
+definido, el almacén queda desactivado y todo se calcula en memoria.
+"""
+from typing import Any, Callable, Dict, Optional
+from collections import OrderedDict
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+
+import joblib
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+ARTIFACTS_DIR = os.getenv("ARTIFACTS_DIR", "")
+ARTIFACTS_MAX_VERSIONS = int(os.getenv("ARTIFACTS_MAX_VERSIONS", "8"))  # por kind
+ARTIFACTS_MEMO_SIZE = int(os.getenv("ARTIFACTS_MEMO_SIZE", "32"))      # cargados en este proceso
+ARTIFACTS_LOCK_TTL_S = float(os.getenv("ARTIFACTS_LOCK_TTL_S", "300"))  # fit en curso en otro proceso
+
+_MODEL_FILE = "model.joblib"
+_MANIFEST = "manifest.json"
+
+_memo: "OrderedDict[str, Any]" = OrderedDict()
+_memo_lock = threading.Lock()
+_stats = {"hits_memory": 0, "hits_disk": 0, "fits": 0, "writes": 0, "write_errors": 0}
+
+
+def enabled() -> bool:
+    return bool(ARTIFACTS_DIR)
+
+
+def _entry_dir(kind: str, key: str) -> str:
+    return os.path.join(ARTIFACTS_DIR, kind, key)
+
+
+def _memo_get(path: str) -> Optional[Any]:
+    with _memo_lock:
+        if path in _memo:
+            _memo.move_to_end(path)
+            _stats["hits_memory"] += 1
+            return _memo[path]
+    return None
+
+
+def _memo_put(path: str, obj: Any) -> None:
+    with _memo_lock:
+        _memo[path] = obj
+        _memo.move_to_end(path)
+        while len(_memo) > ARTIFACTS_MEMO_SIZE:
+            _memo.popitem(last=False)
+
+
+# ----------------------------------------------------------------------
+# Escritura atómica / versionado
+# ----------------------------------------------------------------------
+def _publish(kind: str, key: str, write: Callable[[str], Dict[str, Any]]) -> None:
+    """write(tmp_dir) escribe los archivos y devuelve metadatos extra del manifest."""
+    final = _entry_dir(kind, key)
+    tmp = f"{final}.tmp-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    try:
+        os.makedirs(tmp)
+        meta = write(tmp)
+        with open(os.path.join(tmp, _MANIFEST), "w") as fh:
+            json.dump({"kind": kind, "key": key, "created_at": time.time(), "pid": os.getpid(), **meta}, fh)
+        try:
+            os.rename(tmp, final)  # atómico en el mismo filesystem
+            _stats["writes"] += 1
+        except OSError:
+            # Otro proceso publicó la misma versión primero: la suya vale igual
+            shutil.rmtree(tmp, ignore_errors=True)
+        _prune(kind)
+    except Exception:
+        _stats["write_errors"] += 1
+        logger.exception("No se pudo publicar artefacto %s/%s", kind, key)
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def _prune(kind: str) -> None:
+    base = os.path.join(ARTIFACTS_DIR, kind)
+    try:
+        entries = [
+            os.path.join(base, d) for d in os.listdir(base)
+            if ".tmp-" not in d and not d.endswith(".lock")
+        ]
+    except OSError:
+        return
+    if len(entries) <= ARTIFACTS_MAX_VERSIONS:
+        return
+    entries.sort(key=lambda p: os.path.getmtime(p), reverse=True)
+    for old in entries[ARTIFACTS_MAX_VERSIONS:]:
+        shutil.rmtree(old, ignore_errors=True)
+
+
+def _acquire_fit_lock(kind: str, key: str) -> Optional[str]:
+    """Lock entre procesos/pods (O_EXCL en el volumen). None si otro proceso está entrenando."""
+    os.makedirs(os.path.join(ARTIFACTS_DIR, kind), exist_ok=True)
+    path = _entry_dir(kind, key) + ".lock"
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        os.write(fd, str(os.getpid()).encode())
+        os.close(fd)
+        return path
+    except FileExistsError:
+        try:
+            if time.time() - os.path.getmtime(path) > ARTIFACTS_LOCK_TTL_S:
+                os.remove(path)  # lock huérfano (pod muerto a mitad del fit)
+                return _acquire_fit_lock(kind, key)
+        except OSError:
+            pass
+        return None
+
+
+def _wait_for(kind: str, key: str, filename: str) -> bool:
+    path = os.path.join(_entry_dir(kind, key), filename)
+    lock = _entry_dir(kind, key) + ".lock"
+    t_end = time.time() + ARTIFACTS_LOCK_TTL_S
+    while time.time() < t_end:
+        if os.path.exists(path):
+            return True
+        if not os.path.exists(lock):
+            return os.path.exists(path)
+        time.sleep(0.2)
+    return False
+
+
+# ----------------------------------------------------------------------
+# Estimadores
+# ----------------------------------------------------------------------
+def load_or_fit(kind: str, key: str, fit: Callable[[], Any]) -> Any:
+    """
+    Devuelve el objeto ajustado para (kind, key): memoria del proceso ->
+    volumen compartido (mmap, solo lectura) -> fit + publicación.
+    """
+    if not enabled():
+        _stats["fits"] += 1
+        return fit()
+
+    path = os.path.join(_entry_dir(kind, key), _MODEL_FILE)
+    obj = _memo_get(path)
+    if obj is not None:
+        return obj
+
+    lock = None
+    if not os.path.exists(path):
+        lock = _acquire_fit_lock(kind, key)
+        if lock is None:
+            _wait_for(kind, key, _MODEL_FILE)  # otro pod está entrenando lo mismo
+
+    try:
+        if os.path.exists(path):
+            try:
+                obj = joblib.load(path, mmap_mode="r")
+                _stats["hits_disk"] += 1
+                _memo_put(path, obj)
+                return obj
+            except Exception:
+                logger.exception("Artefacto ilegible %s; se reentrena", path)
+
+        _stats["fits"] += 1
+        obj = fit()
+
+        def write(tmp: str) -> Dict[str, Any]:
+            joblib.dump(obj, os.path.join(tmp, _MODEL_FILE))  # sin compresión => mmap al cargar
+            return {"type": type(obj).__name__}
+        _publish(kind, key, write)
+        _memo_put(path, obj)
+        return obj
+    finally:
+        if lock:
+            try:
+                os.remove(lock)
+            except OSError:
+                pass
+
+
+# ----------------------------------------------------------------------
+# Bundles de arrays (matrices de features)
+# ----------------------------------------------------------------------
+def load_or_compute_arrays(
+    kind: str, key: str, compute: Callable[[], Dict[str, np.ndarray]]
+) -> Dict[str, np.ndarray]:
+    """Como load_or_fit, pero cada array se guarda como .npy y se carga memory-mapped."""
+    if not enabled():
+        return compute()
+
+    entry = _entry_dir(kind, key)
+    memo_key = entry + "#arrays"
+    arrays = _memo_get(memo_key)
+    if arrays is not None:
+        return arrays
+
+    if os.path.exists(os.path.join(entry, _MANIFEST)):
+        try:
+            with open(os.path.join(entry, _MANIFEST)) as fh:
+                names = json.load(fh)["arrays"]
+            arrays = {n: np.load(os.path.join(entry, f"{n}.npy"), mmap_mode="r") for n in names}
+            _stats["hits_disk"] += 1
+            _memo_put(memo_key, arrays)
+            return arrays
+        except Exception:
+            logger.exception("Bundle ilegible %s; se recalcula", entry)
+
+    arrays = compute()
+
+    def write(tmp: str) -> Dict[str, Any]:
+        for name, arr in arrays.items():
+            np.save(os.path.join(tmp, f"{name}.npy"), np.ascontiguousarray(arr))
+        return {"arrays": list(arrays)}
+    _publish(kind, key, write)
+    _memo_put(memo_key, arrays)
+    return arrays
+
+
+def stats() -> Dict[str, Any]:
+    with _memo_lock:
+        memo = len(_memo)
+    return {"enabled": enabled(), "dir": ARTIFACTS_DIR or None, "memo_entries": memo, **_stats}
@@ -0,0 +1,216 @@
+# app/backtest.py
+"""
+Backtesting point-in-time del modelo de riesgo (prob_riesgo).
+
+Para cada fecha de corte T se reconstruye lo que se sabía en T:
+- plazos: cumplido / fecha_cumplimiento solo si se cumplieron hasta T;
+  days_to_due y overdue_now relativos a T. Los cumplidos sin fecha de
+  cumplimiento se descartan (no se sabe desde cuándo lo están).
+- documentos: solo los creados hasta T; agregados y ventanas relativos a T.
+- etiquetas: build_train_labels(df, today=T).
+Con eso se entrena el pipeline servido (build_supervised_pipeline, config
+vigente) y se scorean los plazos abiertos en T que vencían en
+(T, T + horizonte_dias] y que después se resolvieron (etiqueta conocida hoy).
+
+Limitaciones del upstream: no hay fecha de alta de los plazos ni historial del
+estado del expediente, así que un plazo creado después de T puede aparecer en
+el conjunto evaluado de T y estado_abierto es el actual.
+
+El preprocesamiento común (carga y aplanado, documentos ordenados por fecha,
+desenlaces finales) se hace una vez; las fechas se reparten en lotes entre
+BACKTEST_N_JOBS procesos (cada proceso recibe los datos una sola vez).
+"""
+from typing import Any, Dict, List, Optional, Sequence
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from sklearn.metrics import brier_score_loss, roc_auc_score
+
+from .features import PLAZOS_TEXT_COLUMNS, _enrich_plazos_with_docs, now_ts
+from .models import (
+    MAX_TRAIN_ROWS,
+    MIN_TRAIN_ROWS,
+    RANDOM_STATE,
+    RIESGO_ALTA,
+    build_supervised_pipeline,
+    build_train_labels,
+    outcome_labels,
+    stratified_sample_idx,
+    supervised_config,
+)
+from .tuning import n_jobs_budget
+
+BACKTEST_N_JOBS = int(os.getenv("BACKTEST_N_JOBS", "-1"))
+BACKTEST_MAX_DATES = int(os.getenv("BACKTEST_MAX_DATES", "104"))
+CALIBRATION_BINS = 10
+
+# Columnas de flatten_plazos (el resto del DataFrame enriquecido se recalcula por fecha)
+PLAZOS_BASE_COLUMNS = [
+    "id_plazo", "descripcion", "fecha_vencimiento", "cumplido", "fecha_cumplimiento",
+    "expediente_id", "expediente_estado", "days_to_due", "desc_len", "estado_abierto", "overdue_now",
+] + PLAZOS_TEXT_COLUMNS
+
+
+# ----------------------------------------------------------------------
+# Estado a una fecha
+# ----------------------------------------------------------------------
+def plazos_as_of(df: pd.DataFrame, as_of: pd.Timestamp) -> pd.DataFrame:
+    """Plazos como se veían en `as_of`: cumplimientos posteriores deshechos y features relativas a esa fecha."""
+    fc = df["fecha_cumplimiento"]
+    cumplido = df["cumplido"].to_numpy(dtype=bool)
+    undated = cumplido & fc.isna().to_numpy()
+    out = df[~undated].copy()
+    fc = out["fecha_cumplimiento"]
+    known = out["cumplido"].to_numpy(dtype=bool) & (fc <= as_of).to_numpy()
+    out["cumplido"] = known
+    out["fecha_cumplimiento"] = fc.where(known)
+    out["days_to_due"] = (out["fecha_vencimiento"] - as_of).dt.days.astype("float32")
+    out["overdue_now"] = (out["days_to_due"] < 0) & (~out["cumplido"])
+    return out.reset_index(drop=True)
+
+
+def as_of_dates(desde: pd.Timestamp, hasta: pd.Timestamp, cada_dias: int) -> List[pd.Timestamp]:
+    """Fechas de corte de `hasta` hacia atrás cada `cada_dias` (la última siempre incluida), en orden."""
+    dates = []
+    t = hasta.normalize()
+    while t >= desde.normalize() and len(dates) < BACKTEST_MAX_DATES:
+        dates.append(t)
+        t -= pd.Timedelta(days=cada_dias)
+    return dates[::-1]
+
+
+# ----------------------------------------------------------------------
+# Métricas
+# ----------------------------------------------------------------------
+def calibration_table(y: np.ndarray, p: np.ndarray, bins: int = CALIBRATION_BINS) -> Dict[str, Any]:
+    """Riesgo medio vs. tasa real de atraso por tramo de riesgo (tramos vacíos se omiten) y ECE."""
+    edges = np.linspace(0.0, 1.0, bins + 1)
+    which = np.clip(np.digitize(p, edges[1:-1]), 0, bins - 1)
+    rows, ece = [], 0.0
+    for b in range(bins):
+        m = which == b
+        if not m.any():
+            continue
+        gap = abs(float(p[m].mean()) - float(y[m].mean()))
+        ece += m.sum() / len(y) * gap
+        rows.append({"desde": round(float(edges[b]), 2), "hasta": round(float(edges[b + 1]), 2), "n": int(m.sum()),
+                     "riesgo_medio": round(float(p[m].mean()), 4), "tasa_real": round(float(y[m].mean()), 4)})
+    return {"ece": round(ece, 4), "tramos": rows}
+
+
+def risk_metrics(y: np.ndarray, p: np.ndarray) -> Dict[str, Any]:
+    """AUC, precisión/recall con riesgo >= RIESGO_ALTA (prioridad ALTA), Brier y calibración."""
+    if len(y) == 0:
+        return {"n": 0}
+    alta = p >= RIESGO_ALTA
+    both = 0 < y.sum() < len(y)
+    return {
+        "n": int(len(y)),
+        "tasa_atraso": round(float(y.mean()), 4),
+        "auc": round(float(roc_auc_score(y, p)), 4) if both else None,
+        "alta": {
+            "umbral": RIESGO_ALTA,
+            "n": int(alta.sum()),
+            "precision": round(float(y[alta].mean()), 4) if alta.any() else None,
+            "recall": round(float(alta[y == 1].mean()), 4) if y.any() else None,
+        },
+        "brier": round(float(brier_score_loss(y, p)), 4),
+        "calibracion": calibration_table(y, p),
+    }
+
+
+# ----------------------------------------------------------------------
+# Una fecha / un lote (corre en los workers)
+# ----------------------------------------------------------------------
+def _backtest_date(plazos: pd.DataFrame, docs: pd.DataFrame, created_ns: np.ndarray, final: pd.Series,
+                   as_of: pd.Timestamp, horizonte_dias: int, windows: Sequence[int], cfg: Dict[str, Any],
+                   max_train: int, random_state: int) -> Dict[str, Any]:
+    t0 = time.perf_counter()
+    head: Dict[str, Any] = {"as_of": str(as_of.date())}
+    snap = plazos_as_of(plazos, as_of)
+    visible = docs.iloc[: int(np.searchsorted(created_ns, as_of.value, side="right"))]
+    df, num_feats = _enrich_plazos_with_docs(snap, visible, windows, today=as_of)
+
+    lab = build_train_labels(df, today=as_of)
+    fv = df["fecha_vencimiento"]
+    evaluable = ((~df["cumplido"]) & (fv >= as_of) & (fv <= as_of + pd.Timedelta(days=horizonte_dias))).to_numpy()
+    y_eval = final.reindex(df["id_plazo"].to_numpy()).to_numpy()
+    evaluable &= ~np.isnan(y_eval)
+    head.update(n_entrenamiento=int(len(lab)), n_documentos=int(len(visible)))
+    if len(lab) < MIN_TRAIN_ROWS or lab["y"].nunique() < 2:
+        return {**head, "status": "sin_entrenamiento", "n": int(evaluable.sum())}
+    if not evaluable.any():
+        return {**head, "status": "sin_evaluables", "n": 0}
+
+    idx = stratified_sample_idx(len(lab), max_train, lab["y"].to_numpy(), random_state)
+    train = lab.iloc[idx]
+    pipe = build_supervised_pipeline(num_feats, cfg).fit(train[["descripcion"] + num_feats], train["y"])
+    proba = pipe.predict_proba(df.loc[evaluable, ["descripcion"] + num_feats])[:, 1]
+    y = y_eval[evaluable].astype(int)
+    return {**head, "status": "ok", **risk_metrics(y, proba), "segundos": round(time.perf_counter() - t0, 2),
+            "_y": y, "_p": proba}
+
+
+def _backtest_batch(dates: Sequence[pd.Timestamp], *args) -> List[Dict[str, Any]]:
+    return [_backtest_date(*args[:4], d, *args[4:]) for d in dates]
+
+
+# ----------------------------------------------------------------------
+# Backtest
+# ----------------------------------------------------------------------
+def run_backtest(
+    df: pd.DataFrame,
+    df_docs: pd.DataFrame,
+    dates: Sequence[pd.Timestamp],
+    horizonte_dias: int = 30,
+    windows: Sequence[int] = (),
+    max_train: int = MAX_TRAIN_ROWS,
+    n_jobs: int = BACKTEST_N_JOBS,
+    random_state: int = RANDOM_STATE,
+) -> Dict[str, Any]:
+    """
+    df: plazos (enriquecidos o no; se usan las columnas de flatten_plazos);
+    df_docs: documentos con created_at (flatten_docs). Devuelve métricas por
+    fecha y agregadas sobre todas las predicciones.
+    """
+    t0 = time.perf_counter()
+    if df.empty or not len(dates):
+        return {"status": "sin_datos", "detail": "No hay plazos o fechas de corte."}
+
+    # Preprocesamiento común a todas las fechas
+    plazos = df[[c for c in PLAZOS_BASE_COLUMNS if c in df.columns]].drop_duplicates("id_plazo", keep="last")
+    plazos = plazos[plazos["id_plazo"].notna()].reset_index(drop=True)
+    final = outcome_labels(plazos, now_ts())
+    final.index = plazos["id_plazo"].to_numpy()
+    if df_docs.empty:
+        docs, created_ns = df_docs, np.zeros(0, dtype=np.int64)
+    else:
+        docs = df_docs[df_docs["created_at"].notna()].sort_values("created_at", kind="stable").reset_index(drop=True)
+        created_ns = docs["created_at"].to_numpy().astype("datetime64[ns]").view(np.int64)
+    cfg = supervised_config()["params"]
+    windows = tuple(sorted({int(w) for w in windows}))
+
+    n_jobs = min(n_jobs_budget(n_jobs), len(dates))
+    batches = [list(b) for b in np.array_split(np.array(dates, dtype=object), n_jobs) if len(b)]
+    args = (plazos, docs, created_ns, final, horizonte_dias, windows, cfg, max_train, random_state)
+    results = Parallel(n_jobs=n_jobs)(delayed(_backtest_batch)(b, *args) for b in batches)
+    per_date = sorted((r for batch in results for r in batch), key=lambda r: r["as_of"])
+
+    ok = [r for r in per_date if r["status"] == "ok"]
+    y = np.concatenate([r.pop("_y") for r in ok]) if ok else np.zeros(0, dtype=int)
+    p = np.concatenate([r.pop("_p") for r in ok]) if ok else np.zeros(0)
+    aucs = [r["auc"] for r in ok if r["auc"] is not None]
+    return {
+        "status": "ok" if ok else "sin_resultados",
+        "config": cfg,
+        "horizonte_dias": horizonte_dias,
+        "n_fechas": len(per_date),
+        "n_fechas_evaluadas": len(ok),
+        "n_jobs": n_jobs,
+        "global": {**risk_metrics(y, p), "auc_medio": round(float(np.mean(aucs)), 4) if aucs else None},
+        "fechas": per_date,
+        "segundos": round(time.perf_counter() - t0, 2),
+    }
@@ -1,7 +1,20 @@
 import os
 import logging
-from typing import Dict, Any, List
+import json
+import math
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, TimeoutError as FutureTimeout, wait
+from contextvars import ContextVar
+from functools import wraps
+from typing import Callable, Dict, Any, Hashable, List, Optional, Tuple
+import numpy as np
 import requests
+from fastapi.responses import JSONResponse
+
+from . import singleflight
 
 logger = logging.getLogger(__name__)
 
@@ -11,30 +24,436 @@ logger = logging.getLogger(__name__)
 PLAZOS_ENDPOINT = os.getenv("PLAZOS_ENDPOINT") or os.getenv("EXPEDIENTES_URL") or "http://localhost:3000/plazos"
 DOCS_ENDPOINT = os.getenv("DOCS_ENDPOINT") or os.getenv("DOCUMENTOS_URL") or "http://localhost:8081/admin/documentos"
 
-def fetch_plazos() -> Dict[str, Any]:
+# Timeouts por upstream (están en nubes distintas: DigitalOcean / Azure)
+PLAZOS_TIMEOUT_S = float(os.getenv("PLAZOS_TIMEOUT_MS", "10000")) / 1000.0
+DOCS_TIMEOUT_S = float(os.getenv("DOCS_TIMEOUT_MS", "10000")) / 1000.0
+
+# Paginación por upstream: none (colección completa en una respuesta) | page | cursor
+PLAZOS_PAGINATION = os.getenv("PLAZOS_PAGINATION", "none").strip().lower()
+DOCS_PAGINATION = os.getenv("DOCS_PAGINATION", "none").strip().lower()
+UPSTREAM_PAGE_SIZE = int(os.getenv("UPSTREAM_PAGE_SIZE", "1000"))
+UPSTREAM_MAX_IN_FLIGHT = int(os.getenv("UPSTREAM_MAX_IN_FLIGHT", "4"))   # páginas en vuelo por upstream
+UPSTREAM_FIRST_PAGE = int(os.getenv("UPSTREAM_FIRST_PAGE", "1"))
+UPSTREAM_MAX_PAGES = int(os.getenv("UPSTREAM_MAX_PAGES", "10000"))     # tope si el upstream ignora la paginación
+UPSTREAM_PAGE_PARAM = os.getenv("UPSTREAM_PAGE_PARAM", "page")
+UPSTREAM_SIZE_PARAM = os.getenv("UPSTREAM_SIZE_PARAM", "limit")
+UPSTREAM_CURSOR_PARAM = os.getenv("UPSTREAM_CURSOR_PARAM", "cursor")
+# Con paginación el timeout por upstream aplica a cada página; este acota el total
+UPSTREAM_TOTAL_TIMEOUT_S = float(os.getenv("UPSTREAM_TOTAL_TIMEOUT_MS", "60000")) / 1000.0
+
+# Resiliencia: reintentos con backoff exponencial + jitter, hedging y circuit breaker por upstream
+RETRIES = int(os.getenv("RETRIES", "3"))
+UPSTREAM_PAGE_RETRIES = int(os.getenv("UPSTREAM_PAGE_RETRIES", str(RETRIES)))  # por página
+RETRY_BASE_MS = float(os.getenv("RETRY_BASE_MS", "200"))
+RETRY_MAX_MS = float(os.getenv("RETRY_MAX_MS", "2000"))
+HEDGE_QUANTILE = float(os.getenv("HEDGE_QUANTILE", "0.95"))   # 0 = sin hedging
+HEDGE_MIN_MS = float(os.getenv("HEDGE_MIN_MS", "50"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))    # fallos seguidos para abrir
+BREAKER_COOLDOWN_S = float(os.getenv("BREAKER_COOLDOWN_MS", "30000")) / 1000.0
+
+# Pool pequeño para lanzar ambos upstreams en paralelo dentro de una request
+_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="upstream")
+# Descargas de páginas (acotadas por UPSTREAM_MAX_IN_FLIGHT en cada upstream)
+_page_pool = ThreadPoolExecutor(max_workers=2 * max(1, UPSTREAM_MAX_IN_FLIGHT), thread_name_prefix="upstream-page")
+# Intentos individuales (primario + hedge) de cada llamada
+_hedge_pool = ThreadPoolExecutor(max_workers=4 * max(1, UPSTREAM_MAX_IN_FLIGHT), thread_name_prefix="upstream-try")
+
+def _get_json(url: str, timeout: float, params: Optional[Dict[str, Any]] = None) -> Any:
+    r = requests.get(url, params=params, timeout=timeout)
+    r.raise_for_status()
+    return r.json()
+
+def _normalize_docs(data: Any) -> List[Dict[str, Any]]:
+    # Normalizar distintas formas de respuesta:
+    # - Si el endpoint devuelve {'data': [...]}, devolver la lista interna
+    # - Si devuelve directamente una lista, devolverla
+    # - Si devuelve otra cosa o null, devolver lista vacía
+    if isinstance(data, dict) and "data" in data:
+        return data.get("data") or []
+    if isinstance(data, list):
+        return data
+    return []
+
+# ----------------------------------------------------------------------
+# Resiliencia por upstream
+# ----------------------------------------------------------------------
+class CircuitOpen(Exception):
+    """El circuit breaker del upstream está abierto: se falla rápido sin llamar."""
+
+
+class Upstream:
+    """
+    Estado de un upstream: latencias recientes (el cuantil HEDGE_QUANTILE fija
+    cuándo lanzar el hedge), circuit breaker y contadores.
+
+    Breaker: closed -> open tras BREAKER_FAILURES intentos fallidos seguidos;
+    open falla rápido durante BREAKER_COOLDOWN_S; luego half_open deja pasar
+    un único intento de prueba (éxito -> closed, fallo -> open).
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._latencies: deque = deque(maxlen=256)
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._trial_in_flight = False
+        self.counters = {k: 0 for k in ("calls", "ok", "errors", "retries", "hedges", "hedge_wins",
+                                        "short_circuited", "breaker_opens")}
+
+    def count(self, name: str) -> None:
+        with self._lock:
+            self.counters[name] += 1
+
+    def hedge_delay(self) -> Optional[float]:
+        with self._lock:
+            if HEDGE_QUANTILE <= 0 or len(self._latencies) < HEDGE_MIN_SAMPLES:
+                return None
+            lat = np.fromiter(self._latencies, dtype=float)
+        return max(HEDGE_MIN_MS / 1000.0, float(np.quantile(lat, HEDGE_QUANTILE)))
+
+    def before_call(self) -> None:
+        with self._lock:
+            if self.state == "open":
+                if time.time() - self.opened_at < BREAKER_COOLDOWN_S:
+                    self.counters["short_circuited"] += 1
+                    raise CircuitOpen(f"circuit_open: {self.name} (reintenta en "
+                                      f"{BREAKER_COOLDOWN_S - (time.time() - self.opened_at):.0f}s)")
+                self.state = "half_open"
+            if self.state == "half_open":
+                if self._trial_in_flight:
+                    self.counters["short_circuited"] += 1
+                    raise CircuitOpen(f"circuit_open: {self.name} (intento de prueba en curso)")
+                self._trial_in_flight = True
+            self.counters["calls"] += 1
+
+    def on_success(self, latency_s: float) -> None:
+        with self._lock:
+            self._latencies.append(latency_s)
+            self.counters["ok"] += 1
+            self.consecutive_failures = 0
+            self.state = "closed"
+            self._trial_in_flight = False
+
+    def on_failure(self) -> None:
+        with self._lock:
+            self.counters["errors"] += 1
+            self.consecutive_failures += 1
+            reopen = self.state == "half_open"
+            self._trial_in_flight = False
+            if reopen or (self.state == "closed" and self.consecutive_failures >= BREAKER_FAILURES):
+                self.state = "open"
+                self.opened_at = time.time()
+                self.counters["breaker_opens"] += 1
+                logger.warning("circuit breaker abierto para %s", self.name)
+
+    def snapshot(self) -> Dict[str, Any]:
+        delay = self.hedge_delay()
+        with self._lock:
+            lat = np.fromiter(self._latencies, dtype=float)
+            return {
+                "state": self.state,
+                "consecutive_failures": self.consecutive_failures,
+                "opened_at": self.opened_at if self.state != "closed" else None,
+                "latency_p50_ms": round(float(np.quantile(lat, 0.5)) * 1000, 1) if len(lat) else None,
+                "latency_p95_ms": round(float(np.quantile(lat, 0.95)) * 1000, 1) if len(lat) else None,
+                "hedge_delay_ms": round(delay * 1000, 1) if delay is not None else None,
+                **self.counters,
+            }
+
+
+upstreams = {"plazos": Upstream("plazos"), "docs": Upstream("docs")}
+
+def _retryable(exc: BaseException) -> bool:
+    # 4xx (salvo 429) no mejora reintentando
+    if isinstance(exc, requests.HTTPError) and exc.response is not None:
+        code = exc.response.status_code
+        return code >= 500 or code == 429
+    return not isinstance(exc, CircuitOpen)
+
+def _hedged_get(up: Upstream, url: str, timeout: float, params: Optional[Dict[str, Any]]) -> Any:
+    """Un intento; si no respondió tras el p95 reciente se lanza un segundo y gana el primero que responda."""
+    t0 = time.perf_counter()
+    delay = up.hedge_delay()
+    if delay is None or delay >= timeout:
+        out = _get_json(url, timeout, params)
+        up.on_success(time.perf_counter() - t0)
+        return out
+
+    primary = _hedge_pool.submit(_get_json, url, timeout, params)
+    done, _ = wait([primary], timeout=delay)
+    pending = {primary}
+    if not done:
+        up.count("hedges")
+        # El hedge usa lo que queda del timeout del intento: el intento no dura más que `timeout`
+        pending.add(_hedge_pool.submit(_get_json, url, timeout - delay, params))
+    error: Optional[BaseException] = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for fut in done:
+            try:
+                out = fut.result()
+            except Exception as exc:
+                error = exc
+                continue
+            if fut is not primary:
+                up.count("hedge_wins")
+            # El otro intento (si sigue) termina solo con su timeout; su resultado se descarta
+            up.on_success(time.perf_counter() - t0)
+            return out
+    raise error
+
+def _call(source: str, url: str, timeout: float, params: Optional[Dict[str, Any]] = None,
+          retries: int = RETRIES) -> Any:
+    """GET con circuit breaker, hedging y reintentos con backoff exponencial + full jitter."""
+    up = upstreams[source]
+    for attempt in range(retries + 1):
+        up.before_call()  # CircuitOpen: falla rápido, sin reintentar
+        try:
+            return _hedged_get(up, url, timeout, params)
+        except Exception as exc:
+            up.on_failure()
+            if attempt >= retries or not _retryable(exc):
+                raise
+            up.count("retries")
+            backoff_ms = min(RETRY_MAX_MS, RETRY_BASE_MS * 2 ** attempt)
+            logger.warning("%s falló (intento %d/%d): %s", source, attempt + 1, retries + 1, exc)
+            time.sleep(random.uniform(0, backoff_ms) / 1000.0)
+
+def upstreams_state() -> Dict[str, Dict[str, Any]]:
+    return {name: up.snapshot() for name, up in upstreams.items()}
+
+# ----------------------------------------------------------------------
+# Marcas de degradación por request
+# ----------------------------------------------------------------------
+_degraded: ContextVar[Optional[Dict[str, Any]]] = ContextVar("upstream_degraded", default=None)
+
+def note_degraded(errors: Optional[Dict[str, str]]) -> None:
+    """Registra en la request en curso (ver track_degraded) los orígenes que fallaron."""
+    holder = _degraded.get()
+    if holder is not None and errors:
+        holder["errors"].update(errors)
+
+def note_snapshot(name: str, info: Optional[Dict[str, Any]]) -> None:
+    """Registra que la request en curso se respondió con un snapshot en disco (ver app/snapshot.py)."""
+    holder = _degraded.get()
+    if holder is not None and info:
+        holder["snapshot"][name] = info
+
+def track_degraded(fn: Callable[..., Any]) -> Callable[..., Any]:
+    """
+    Decorador de handlers: si algún upstream falló al cargar los datos, la
+    respuesta lleva "degraded": true y "upstream_errors" (en vez de parecer
+    calculada sobre datos completos). Los jobs no reutilizan esos resultados.
+    Si se sirvió un snapshot en disco, "snapshot" indica cuál y su antigüedad.
+    """
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        token = _degraded.set({"errors": {}, "snapshot": {}})
+        try:
+            out = fn(*args, **kwargs)
+            holder = _degraded.get()
+        finally:
+            _degraded.reset(token)
+        errors, snap = holder["errors"], holder["snapshot"]
+        marks = {"degraded": bool(errors), **({"upstream_errors": errors} if errors else {}),
+                 **({"snapshot": snap} if snap else {})}
+        if isinstance(out, dict):
+            return {**out, **marks}
+        if isinstance(out, JSONResponse) and out.status_code == 200 and (errors or snap):
+            body = json.loads(out.body)
+            if isinstance(body, dict):
+                return JSONResponse({**body, **marks})
+        return out
+    return wrapper
+
+# ----------------------------------------------------------------------
+# Paginación
+# ----------------------------------------------------------------------
+_SOURCES = {
+    "plazos": (PLAZOS_ENDPOINT, PLAZOS_TIMEOUT_S, PLAZOS_PAGINATION),
+    "docs": (DOCS_ENDPOINT, DOCS_TIMEOUT_S, DOCS_PAGINATION),
+}
+
+def _page_meta(data: Any, page_size: int) -> Tuple[Optional[int], Optional[str]]:
+    """(total de páginas, cursor siguiente) si la respuesta los trae (raíz o "meta"/"pagination")."""
+    if not isinstance(data, dict):
+        return None, None
+    sources = [data] + [data[k] for k in ("meta", "pagination") if isinstance(data.get(k), dict)]
+    total_pages = next_cursor = None
+    for src in sources:
+        for k in ("total_pages", "totalPages", "last_page", "lastPage"):
+            if src.get(k) is not None and total_pages is None:
+                total_pages = int(src[k])
+        for k in ("total", "total_count", "totalCount"):
+            if isinstance(src.get(k), int) and total_pages is None:
+                total_pages = math.ceil(src[k] / page_size) if page_size else None
+        for k in ("next_cursor", "nextCursor", "cursor_next"):
+            if src.get(k) and next_cursor is None:
+                next_cursor = str(src[k])
+    return total_pages, next_cursor
+
+def _get_page(source: str, url: str, timeout: float, params: Dict[str, Any]) -> Any:
+    """Una página con sus propios reintentos: si falla, solo se vuelve a pedir esa página."""
+    return _call(source, url, timeout, params, retries=UPSTREAM_PAGE_RETRIES)
+
+def _fetch_paged_by_number(source: str, url: str, timeout: float, on_page: Callable[[List[Dict[str, Any]]], Any]) -> List[Any]:
+    size = UPSTREAM_PAGE_SIZE
+    first = UPSTREAM_FIRST_PAGE
+
+    def params(page: int) -> Dict[str, Any]:
+        return {UPSTREAM_PAGE_PARAM: page, UPSTREAM_SIZE_PARAM: size}
+
+    data = _get_page(source, url, timeout, params(first))
+    items = _normalize_docs(data)
+    # El upstream puede topar el tamaño por debajo de UPSTREAM_PAGE_SIZE: vale el observado
+    # (también para pasar un "total" de filas a páginas)
+    observed = len(items) or size
+    total_pages, _ = _page_meta(data, observed)
+    results: Dict[int, Any] = {first: on_page(items)}
+    if total_pages is not None and total_pages <= 1:
+        return [results[first]]
+    if total_pages is None and len(items) != size:
+        return [results[first]]  # sin total: una página corta es la última (o el upstream ignoró el tamaño)
+    size = observed
+
+    # Ventana de a lo sumo UPSTREAM_MAX_IN_FLIGHT páginas; cada una se aplana al llegar
+    # mientras las siguientes se descargan. Sin total conocido se avanza hasta una página corta.
+    last = first + min(total_pages, UPSTREAM_MAX_PAGES) - 1 if total_pages is not None else None
+    next_page, end = first + 1, last
+    in_flight: Dict[Future, int] = {}
+    while in_flight or end is None or next_page <= end:
+        while len(in_flight) < max(1, UPSTREAM_MAX_IN_FLIGHT) and (end is None or next_page <= end):
+            in_flight[_page_pool.submit(_get_page, source, url, timeout, params(next_page))] = next_page
+            next_page += 1
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for fut in done:
+            page = in_flight.pop(fut)
+            items = _normalize_docs(fut.result())
+            if end is not None and page > end:
+                continue  # más allá de la última página (descubierta por otra página corta)
+            if items:
+                results[page] = on_page(items)
+            if last is None and (len(items) < size or page >= first + UPSTREAM_MAX_PAGES - 1):
+                end = page if end is None else min(end, page)
+    return [results[p] for p in sorted(results) if end is None or p <= end]
+
+def _fetch_paged_by_cursor(source: str, url: str, timeout: float, on_page: Callable[[List[Dict[str, Any]]], Any]) -> List[Any]:
+    # El cursor siguiente viene en la respuesta: las descargas son secuenciales, pero la
+    # siguiente página se pide antes de aplanar la actual (red y aplanado se solapan)
+    results: List[Any] = []
+    fut = _page_pool.submit(_get_page, source, url, timeout, {UPSTREAM_SIZE_PARAM: UPSTREAM_PAGE_SIZE})
+    while fut is not None:
+        data = fut.result()
+        _, cursor = _page_meta(data, UPSTREAM_PAGE_SIZE)
+        items = _normalize_docs(data)
+        fut = None
+        if cursor and items:
+            fut = _page_pool.submit(_get_page, source, url, timeout,
+                                    {UPSTREAM_SIZE_PARAM: UPSTREAM_PAGE_SIZE, UPSTREAM_CURSOR_PARAM: cursor})
+        if items:
+            results.append(on_page(items))
+    return results
+
+def _fetch_pages(source: str, on_page: Callable[[List[Dict[str, Any]]], Any]) -> List[Any]:
+    url, timeout, mode = _SOURCES[source]
+    if mode == "page":
+        return _fetch_paged_by_number(source, url, timeout, on_page)
+    if mode == "cursor":
+        return _fetch_paged_by_cursor(source, url, timeout, on_page)
+    if mode != "none":
+        logger.warning("Paginación %r desconocida para %s (opciones: none, page, cursor)", mode, source)
+    return [on_page(_normalize_docs(_call(source, url, timeout)))]
+
+def fetch_pages(source: str, on_page: Optional[Callable[[List[Dict[str, Any]]], Any]] = None,
+                key: Hashable = None) -> List[Any]:
+    """
+    Trae todas las páginas de `source` ("plazos" | "docs") y aplica `on_page`
+    a los items de cada una en cuanto llega (p. ej. aplanar a DataFrame).
+    Devuelve los resultados en orden de página. Requests concurrentes con la
+    misma `key` comparten la descarga; los resultados no deben mutarse.
+    """
+    on_page = on_page or (lambda items: items)
+    return singleflight.upstreams.do((source, key), _fetch_pages, source, on_page)
+
+def _concat_items(pages: List[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    return pages[0] if len(pages) == 1 else [item for page in pages for item in page]
+
+def _fetch_plazos() -> Dict[str, Any]:
+    # Requests concurrentes comparten una sola llamada al upstream
+    return {"data": _concat_items(fetch_pages("plazos"))}
+
+def _fetch_docs() -> List[Dict[str, Any]]:
+    return _concat_items(fetch_pages("docs"))
+
+def fetch_plazos() -> Tuple[Dict[str, Any], Dict[str, str]]:
+    """Payload de /plazos y errores por origen (como fetch_sources): si falla, {"data": []} y el error."""
     try:
-        r = requests.get(PLAZOS_ENDPOINT, timeout=10)
-        r.raise_for_status()
-        return r.json()
+        return _fetch_plazos(), {}
     except Exception as exc:
-        # No queremos que un upstream caído provoque errores tipo None en el flujo.
         logger.exception("fetch_plazos failed for %s", PLAZOS_ENDPOINT)
-        return {"data": []}
+        return {"data": []}, {"plazos": str(exc)}
+
+def fetch_docs() -> Tuple[List[Dict[str, Any]], Dict[str, str]]:
+    """Documentos y errores por origen (como fetch_sources): si falla, [] y el error."""
+    try:
+        return _fetch_docs(), {}
+    except Exception as exc:
+        logger.exception("fetch_docs failed for %s", DOCS_ENDPOINT)
+        return [], {"docs": str(exc)}
 
-def fetch_docs() -> List[Dict[str, Any]]:
+def fetch_docs_pages(on_page: Callable[[List[Dict[str, Any]]], Any],
+                     key: Hashable = None) -> Tuple[List[Any], Dict[str, str]]:
+    """Como fetch_docs, pero transformando cada página al llegar (ver fetch_pages). Retorna (páginas, errores)."""
     try:
-        r = requests.get(DOCS_ENDPOINT, timeout=10)
-        r.raise_for_status()
-        data = r.json()
-        # Normalizar distintas formas de respuesta:
-        # - Si el endpoint devuelve {'data': [...]}, devolver la lista interna
-        # - Si devuelve directamente una lista, devolverla
-        # - Si devuelve otra cosa o null, devolver lista vacía
-        if isinstance(data, dict) and "data" in data:
-            return data.get("data") or []
-        if isinstance(data, list):
-            return data
-        return []
+        return fetch_pages("docs", on_page, key), {}
     except Exception as exc:
         logger.exception("fetch_docs failed for %s", DOCS_ENDPOINT)
-        return []
+        return [], {"docs": str(exc)}
+
+def _call_budget(timeout: float, retries: int = RETRIES) -> float:
+    """Peor caso de _call: todos los intentos agotan `timeout` y cada backoff su máximo (+1s de margen)."""
+    backoff_s = sum(min(RETRY_MAX_MS, RETRY_BASE_MS * 2 ** a) for a in range(retries)) / 1000.0
+    return (retries + 1) * timeout + backoff_s + 1.0
+
+def _total_timeout(source: str) -> float:
+    _, timeout, mode = _SOURCES[source]
+    return UPSTREAM_TOTAL_TIMEOUT_S if mode in ("page", "cursor") else _call_budget(timeout)
+
+def fetch_sources(
+    on_page: Optional[Dict[str, Callable[[List[Dict[str, Any]]], Any]]] = None, key: Hashable = None,
+) -> Tuple[Any, Any, Dict[str, str]]:
+    """
+    Trae plazos y documentos en paralelo (latencia = max de ambos, no la suma).
+    Falla parcial: si un upstream falla o excede su timeout, se usa vacío para
+    ese origen y el otro se devuelve igual.
+    Retorna (payload_plazos, docs, errores_por_origen).
+
+    Con `on_page` ({"plazos": fn, "docs": fn}) cada página se transforma al
+    llegar y se devuelve la lista de resultados por página (vacía si falló).
+    """
+    if on_page is None:
+        jobs = {
+            "plazos": (_pool.submit(_fetch_plazos), {"data": []}),
+            "docs": (_pool.submit(_fetch_docs), []),
+        }
+    else:
+        jobs = {name: (_pool.submit(fetch_pages, name, on_page[name], key), []) for name in ("plazos", "docs")}
+    results: Dict[str, Any] = {}
+    errors: Dict[str, str] = {}
+    for name, (fut, empty) in jobs.items():
+        timeout = _total_timeout(name)
+        try:
+            # requests aplica el timeout por operación; aquí se acota el total
+            results[name] = fut.result(timeout=timeout)
+        except FutureTimeout:
+            logger.warning("fetch %s excedió %.1fs", name, timeout)
+            errors[name] = f"timeout ({timeout:.1f}s)"
+            results[name] = empty
+        except Exception as exc:
+            logger.exception("fetch %s failed", name)
+            errors[name] = str(exc)
+            results[name] = empty
+    return results["plazos"], results["docs"], errors
@@ -0,0 +1,298 @@
+# app/cpu_budget.py
+"""
+Presupuesto de hilos de CPU acorde al límite del contenedor.
+
+Límite: cuota de cgroups (v2 cpu.max; v1 cpu.cfs_quota_us / cpu.cfs_period_us)
+redondeada hacia arriba y acotada por las CPUs de la afinidad del proceso. Un
+pod de 500m tiene 1 hilo. CPU_BUDGET lo fija a mano (0 = automático).
+
+Reparto: el presupuesto son fichas de un semáforo compartido entre el proceso
+API y los workers de jobs (se les pasa en el initializer del pool). Cada cómputo
+pesado toma una concesión: el líder de singleflight.fits, el tuning y el
+backtest. La concesión espera la primera ficha y suma, sin esperar, las libres
+hasta CPU_REQUEST_MAX. Nadie espera teniendo fichas, así que las concesiones
+no se bloquean entre sí. Dentro de la concesión:
+- n_jobs() da el n_jobs de scikit-learn / joblib.
+- Los threadpools nativos (BLAS y OpenMP vía threadpoolctl) y
+  torch.set_num_threads quedan en el mínimo de las concesiones activas del
+  proceso, porque son globales al proceso. Al terminar la última concesión
+  vuelven a la base del proceso (init: el presupuesto).
+Una concesión anidada en el mismo hilo reutiliza la de afuera, y quien espera
+el resultado de otro (idle(): seguidores de singleflight) devuelve sus fichas
+mientras espera.
+
+Si no hay fichas en CPU_WAIT_S segundos se sigue con 1 hilo fuera de
+presupuesto, y queda contado en stats() (por proceso y el total con los
+workers). Así un worker caído con fichas tomadas no bloquea el servicio.
+"""
+from typing import Any, Dict, Iterator, Optional
+from contextlib import contextmanager
+import itertools
+import math
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+try:
+    from threadpoolctl import threadpool_info, threadpool_limits
+    HAS_THREADPOOLCTL = True
+except ImportError:  # viene con scikit-learn; sin él solo se acota n_jobs
+    HAS_THREADPOOLCTL = False
+
+CPU_BUDGET = int(os.getenv("CPU_BUDGET", "0"))            # 0 = cuota de cgroups / afinidad
+CPU_REQUEST_MAX = int(os.getenv("CPU_REQUEST_MAX", "0"))  # hilos máx. por concesión (0 = todo el presupuesto)
+CPU_WAIT_S = float(os.getenv("CPU_WAIT_S", "10"))
+
+_CGROUP_V2 = "/sys/fs/cgroup/cpu.max"
+_CGROUP_V1 = ("/sys/fs/cgroup/cpu/cpu.cfs_quota_us", "/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+
+
+# ----------------------------------------------------------------------
+# Límite del contenedor
+# ----------------------------------------------------------------------
+def _read(path: str) -> Optional[str]:
+    try:
+        with open(path) as fh:
+            return fh.read().strip()
+    except OSError:
+        return None
+
+
+def cgroup_quota() -> Optional[float]:
+    """CPUs de la cuota de cgroups (0.5 = 500m); None si no hay límite o no se puede leer."""
+    try:
+        raw = _read(_CGROUP_V2)
+        if raw is not None:
+            quota, _, period = raw.partition(" ")
+            return None if quota == "max" or not period else int(quota) / int(period)
+        quota, period = (_read(p) for p in _CGROUP_V1)
+        if quota and period and int(quota) > 0:
+            return int(quota) / int(period)
+    except ValueError:
+        pass
+    return None
+
+
+def affinity_cpus() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # macOS / Windows
+        return os.cpu_count() or 1
+
+
+def cpu_limit() -> int:
+    """Hilos que el proceso puede usar a la vez (CPU_BUDGET o cuota redondeada hacia arriba)."""
+    if CPU_BUDGET > 0:
+        return CPU_BUDGET
+    cpus = affinity_cpus()
+    quota = cgroup_quota()
+    if quota is not None:
+        cpus = min(cpus, math.ceil(quota))
+    return max(1, cpus)
+
+
+BUDGET = cpu_limit()
+REQUEST_MAX = min(CPU_REQUEST_MAX, BUDGET) if CPU_REQUEST_MAX > 0 else BUDGET
+
+
+# ----------------------------------------------------------------------
+# Estado (por proceso; las fichas y el total fuera de presupuesto son compartidos)
+# ----------------------------------------------------------------------
+_lock = threading.Lock()
+_local = threading.local()
+_shared: Dict[str, Any] = {"tokens": None, "over": None}
+_active: Dict[int, int] = {}   # id de concesión -> hilos
+_ids = itertools.count()
+_native: Dict[str, Any] = {"limit": None, "limiter": None, "torch_base": None}
+_native_lock = threading.Lock()
+_stats = {"concesiones": 0, "esperas": 0, "espera_total_s": 0.0, "fuera_de_presupuesto": 0, "pico_en_uso": 0}
+
+
+def shared_tokens():
+    """Semáforo de fichas (se crea en el proceso API; los workers reciben el mismo vía attach)."""
+    with _lock:
+        if _shared["tokens"] is None:
+            _shared["tokens"] = multiprocessing.get_context("spawn").BoundedSemaphore(BUDGET)
+        return _shared["tokens"]
+
+
+def shared_over_budget():
+    """Contador de concesiones fuera de presupuesto del proceso API y los workers (sobrevive a reset_shared)."""
+    with _lock:
+        if _shared["over"] is None:
+            _shared["over"] = multiprocessing.get_context("spawn").Value("i", 0)
+        return _shared["over"]
+
+
+def reset_shared() -> None:
+    """Descarta el semáforo (p. ej. si murió un worker con fichas tomadas); las concesiones en curso liberan el viejo."""
+    with _lock:
+        _shared["tokens"] = None
+
+
+def attach(tokens, over=None) -> None:
+    """Initializer de los workers de jobs: usa las fichas y el contador del proceso API y acota los threadpools nativos."""
+    with _lock:
+        _shared["tokens"] = tokens
+        if over is not None:
+            _shared["over"] = over
+    init()
+
+
+def init() -> None:
+    """Acota los threadpools nativos al presupuesto: la base del proceso, también fuera de concesiones."""
+    with _native_lock:
+        if HAS_THREADPOOLCTL:
+            threadpool_limits(limits=BUDGET)  # sin `with` a propósito: es la base a la que vuelven las concesiones
+        torch = sys.modules.get("torch")
+        if torch is not None:
+            torch.set_num_threads(BUDGET)
+            _native["torch_base"] = BUDGET
+
+
+def _sync_native() -> None:
+    """Threadpools nativos al mínimo de las concesiones activas; sin concesiones, de vuelta a la base."""
+    with _native_lock:
+        with _lock:
+            limit = min(_active.values()) if _active else None
+        if _native["limit"] == limit:
+            return
+        if HAS_THREADPOOLCTL:
+            # Forma context manager de threadpoolctl con alcance de las concesiones activas (de varios
+            # hilos, por eso no es un `with`): se restaura el límite anterior antes de aplicar otro.
+            if _native["limiter"] is not None:
+                _native["limiter"].restore_original_limits()
+            _native["limiter"] = threadpool_limits(limits=limit) if limit is not None else None
+        torch = sys.modules.get("torch")  # solo si ya está cargado (routers/deep.py)
+        if torch is not None:
+            if _native["limit"] is None and _native["torch_base"] is None:
+                _native["torch_base"] = torch.get_num_threads()
+            torch.set_num_threads(limit if limit is not None else (_native["torch_base"] or BUDGET))
+        _native["limit"] = limit
+
+
+# ----------------------------------------------------------------------
+# Concesiones
+# ----------------------------------------------------------------------
+def _acquire(tokens, want: int) -> int:
+    """Espera la primera ficha (hasta CPU_WAIT_S) y suma sin esperar las libres hasta `want`; 0 = fuera de presupuesto."""
+    t0 = time.perf_counter()
+    got = 0
+    if tokens.acquire(block=False):
+        got = 1
+    else:
+        waited = tokens.acquire(timeout=CPU_WAIT_S)
+        got = 1 if waited else 0
+        with _lock:
+            _stats["esperas"] += 1
+            _stats["espera_total_s"] += time.perf_counter() - t0
+            _stats["fuera_de_presupuesto"] += 0 if waited else 1
+        if not waited:
+            over = shared_over_budget()
+            with over.get_lock():
+                over.value += 1
+    while got and got < want and tokens.acquire(block=False):
+        got += 1
+    return got
+
+
+def _activate(grant: Dict[str, Any]) -> None:
+    grant["n"] = max(grant["got"], 1)
+    with _lock:
+        _active[grant["key"]] = grant["n"]
+        _stats["pico_en_uso"] = max(_stats["pico_en_uso"], sum(_active.values()))
+    _sync_native()
+    _local.n = grant["n"]
+
+
+def _deactivate(grant: Dict[str, Any]) -> None:
+    _local.n = None
+    for _ in range(grant["got"]):
+        grant["tokens"].release()
+    grant["got"] = 0
+    with _lock:
+        _active.pop(grant["key"], None)
+    _sync_native()
+
+
+@contextmanager
+def threads(want: Optional[int] = None) -> Iterator[int]:
+    """Concesión de hasta `want` hilos (None = CPU_REQUEST_MAX); devuelve los concedidos (>= 1)."""
+    held = getattr(_local, "n", None)
+    if held is not None:
+        yield held
+        return
+
+    want = REQUEST_MAX if want is None or want <= 0 else min(want, REQUEST_MAX)
+    tokens = shared_tokens()
+    grant = {"tokens": tokens, "want": want, "got": _acquire(tokens, want)}
+    with _lock:
+        grant["key"] = next(_ids)
+        _stats["concesiones"] += 1
+    _activate(grant)
+    _local.grant = grant
+    try:
+        yield grant["n"]
+    finally:
+        _local.grant = None
+        _deactivate(grant)
+
+
+@contextmanager
+def idle() -> Iterator[None]:
+    """
+    Devuelve las fichas de la concesión del hilo mientras espera a otro (p. ej. el
+    líder de singleflight, que puede necesitarlas) y las vuelve a tomar al seguir.
+    """
+    grant = getattr(_local, "grant", None)
+    if grant is None or getattr(_local, "n", None) is None:
+        yield
+        return
+    _deactivate(grant)
+    try:
+        yield
+    finally:
+        grant["tokens"] = shared_tokens()
+        grant["got"] = _acquire(grant["tokens"], grant["want"])
+        _activate(grant)
+
+
+def n_jobs(requested: int = -1) -> int:
+    """n_jobs para scikit-learn / joblib: la concesión del hilo (el presupuesto fuera de una), acotada por `requested` (<= 0 = sin tope)."""
+    n = getattr(_local, "n", None) or BUDGET
+    return n if requested <= 0 else max(1, min(requested, n))
+
+
+def stats() -> Dict[str, Any]:
+    tokens, over = shared_tokens(), shared_over_budget()
+    with _lock:
+        active = list(_active.values())
+        out = {
+            "limite": {
+                "cgroup_cpus": cgroup_quota(),
+                "afinidad_cpus": affinity_cpus(),
+                "presupuesto": BUDGET,
+                "por_concesion": REQUEST_MAX,
+                "fuente": "CPU_BUDGET" if CPU_BUDGET > 0 else ("cgroup" if cgroup_quota() is not None else "afinidad"),
+            },
+            # Fichas libres entre el proceso API y los workers de jobs
+            "fichas_libres": tokens.get_value(),
+            "proceso": {
+                "pid": os.getpid(),
+                "en_uso": sum(active),
+                "concesiones_activas": len(active),
+                **{k: (round(v, 3) if isinstance(v, float) else v) for k, v in _stats.items()},
+            },
+            # Concesiones que siguieron sin ficha, del proceso API y los workers de jobs
+            "fuera_de_presupuesto_total": over.value,
+            "nativos": {"base": BUDGET, "limite": _native["limit"]},
+        }
+    if HAS_THREADPOOLCTL:
+        out["nativos"]["threadpools"] = [{"api": i["internal_api"], "hilos": i["num_threads"]}
+                                         for i in threadpool_info()]
+    torch = sys.modules.get("torch")
+    if torch is not None:
+        out["nativos"]["torch_hilos"] = torch.get_num_threads()
+    return out
@@ -1,10 +1,16 @@
 # app/features.py
-from typing import Optional, Tuple, List, Dict, Any
+from typing import Optional, Tuple, List, Dict, Any, Sequence
+from collections import OrderedDict
+from functools import partial
 from urllib.parse import unquote
+import os
+import threading
+import time
 import pandas as pd
 from dateutil import parser as dtparser
 
-from .clients import fetch_plazos, fetch_docs  # (fetch_plazos puede usarse en debug)
+from .clients import fetch_docs_pages, fetch_sources, note_degraded, note_snapshot
+from . import singleflight, artifacts, snapshot, http_cache
 import numpy as np
 # ----------------------------------------------------------------------
 # Fechas / tiempo
@@ -39,20 +45,55 @@ def to_naive_ts(series: pd.Series) -> pd.Series:
     # ahora es datetime64[ns, UTC] => lo pasamos a naive
     return s.dt.tz_convert(None)
 
+# ----------------------------------------------------------------------
+# Dtypes compactos
+# ----------------------------------------------------------------------
+# Columnas solo de presentación: no las usa ningún modelo, se cargan bajo demanda
+PLAZOS_TEXT_COLUMNS = ["expediente_titulo"]
+
+def compact_ids(series: pd.Series) -> pd.Series:
+    """
+    Ids numéricos a int32 si no hay nulos y caben; con nulos quedan float64
+    (los routers ya usan pd.notna antes de int()). Si hay ids no numéricos
+    (p. ej. ObjectId) la serie se devuelve sin tocar.
+    """
+    num = pd.to_numeric(series, errors="coerce")
+    if (num.isna() & series.notna()).any():
+        return series
+    if num.notna().all() and len(num) and (num % 1 == 0).all() and num.abs().max() < 2**31:
+        return num.astype("int32")
+    return num.astype("float64")
+
+def memory_report(df: pd.DataFrame) -> Dict[str, Any]:
+    """Bytes por columna (deep=True, incluye los strings) y total del DataFrame."""
+    usage = df.memory_usage(deep=True, index=True)
+    return {
+        "rows": int(len(df)),
+        "total_bytes": int(usage.sum()),
+        "columns": {
+            str(c): {"dtype": str(df[c].dtype) if c in df.columns else "index", "bytes": int(b)}
+            for c, b in usage.items()
+        },
+    }
+
 # ----------------------------------------------------------------------
 # Plazos
 # ----------------------------------------------------------------------
-def flatten_plazos(payload: Dict[str, Any]) -> pd.DataFrame:
+def flatten_plazos(payload: Dict[str, Any], include_text: bool = False) -> pd.DataFrame:
     """
     Convierte el JSON de /plazos en DataFrame y calcula features:
     - fecha_vencimiento / fecha_cumplimiento en datetime64[ns] naive
     - days_to_due, desc_len, estado_abierto, overdue_now
+
+    Dtypes compactos: expediente_estado y cliente_nombre categóricos, ids
+    int32, features float32/int32/int8/bool. Las columnas de presentación
+    (PLAZOS_TEXT_COLUMNS) solo se cargan con include_text=True.
     """
     rows = []
     for item in payload.get("data", []):
         expediente = item.get("expediente") or {}
-        cliente = (expediente or {}).get("cliente") or {}
-        rows.append({
+        cliente = expediente.get("cliente") or {}
+        row = {
             "id_plazo": item.get("id_plazo"),
             "descripcion": (item.get("descripcion") or "").strip(),
             "fecha_vencimiento": safe_parse_date(item.get("fecha_vencimiento")),
@@ -60,9 +101,13 @@ def flatten_plazos(payload: Dict[str, Any]) -> pd.DataFrame:
             "fecha_cumplimiento": safe_parse_date(item.get("fecha_cumplimiento")) if item.get("fecha_cumplimiento") else None,
             "expediente_id": expediente.get("id_expediente"),
             "expediente_estado": (expediente.get("estado") or "").upper().strip() if expediente else "",
-            "expediente_titulo": expediente.get("titulo") or "",
+            # Para filtrar por cliente (ver app/scored.py); pocos nombres distintos -> categórico
+            "id_cliente": cliente.get("id_cliente"),
             "cliente_nombre": cliente.get("nombre_completo") or "",
-        })
+        }
+        if include_text:
+            row["expediente_titulo"] = expediente.get("titulo") or ""
+        rows.append(row)
 
     df = pd.DataFrame(rows)
     if df.empty:
@@ -72,24 +117,36 @@ def flatten_plazos(payload: Dict[str, Any]) -> pd.DataFrame:
     df["fecha_vencimiento"]  = to_naive_ts(df["fecha_vencimiento"])
     df["fecha_cumplimiento"] = to_naive_ts(df["fecha_cumplimiento"])
 
-    # days_to_due robusto (Timedelta -> días)
+    df["id_plazo"] = compact_ids(df["id_plazo"])
+    df["expediente_id"] = compact_ids(df["expediente_id"])
+    df["id_cliente"] = compact_ids(df["id_cliente"])
+    df["cumplido"] = df["cumplido"].astype(bool)
+    # Pocos valores distintos (ABIERTO/CERRADO/...): categórico en vez de object
+    df["expediente_estado"] = df["expediente_estado"].astype("category")
+    df["cliente_nombre"] = df["cliente_nombre"].astype("category")
+
+    # days_to_due robusto (Timedelta -> días); float32 porque puede haber NaN
     today = now_ts()  # naive
     delta = df["fecha_vencimiento"] - today
-    df["days_to_due"] = delta.dt.days
+    df["days_to_due"] = delta.dt.days.astype("float32")
 
-    df["desc_len"] = df["descripcion"].astype(str).str.len()
-    df["estado_abierto"] = (df["expediente_estado"] == "ABIERTO").astype(int)
+    df["desc_len"] = df["descripcion"].str.len().astype("int32")
+    df["estado_abierto"] = (df["expediente_estado"] == "ABIERTO").astype("int8")
     df["overdue_now"] = (df["days_to_due"] < 0) & (~df["cumplido"])
     return df
 
 # ----------------------------------------------------------------------
 # Documentos
 # ----------------------------------------------------------------------
-def flatten_docs(docs: List[Dict[str, Any]]) -> pd.DataFrame:
+def flatten_docs(docs: List[Dict[str, Any]], include_filename: bool = True) -> pd.DataFrame:
     """
     Convierte el JSON de /admin/documentos en DataFrame y calcula:
     - created_at -> datetime64[ns] naive
     - size_mb, days_since_created
+
+    Dtypes compactos: file_ext categórico, ids int32, size_mb y
+    days_since_created float32. Con include_filename=False no se guarda
+    el nombre (los agregados por expediente solo necesitan file_ext).
     """
     # Defensive: si docs es None o vacío, devolver DataFrame vacío
     if not docs:
@@ -101,16 +158,18 @@ def flatten_docs(docs: List[Dict[str, Any]]) -> pd.DataFrame:
         filename = unquote(filename_raw)
         ext = filename.split(".")[-1].lower() if "." in filename else ""
         created = d.get("created_at")
-        rows.append({
+        row = {
             "doc_id": d.get("doc_id") or d.get("_id"),
-            "filename": filename,
             "file_ext": ext,
             "size": d.get("size"),
             "size_mb": (d.get("size") or 0) / (1024.0*1024.0),
             "id_cliente": d.get("id_cliente"),
             "id_expediente": d.get("id_expediente"),
             "created_at": safe_parse_date(created) if created else None,
-        })
+        }
+        if include_filename:
+            row["filename"] = filename
+        rows.append(row)
 
     df = pd.DataFrame(rows)
     if df.empty:
@@ -119,53 +178,400 @@ def flatten_docs(docs: List[Dict[str, Any]]) -> pd.DataFrame:
     # 🔧 A datetime64[ns] naive
     df["created_at"] = to_naive_ts(df["created_at"])
 
+    df["file_ext"] = df["file_ext"].astype("category")
+    df["size"] = compact_ids(df["size"])
+    df["size_mb"] = df["size_mb"].astype("float32")
+    df["id_cliente"] = compact_ids(df["id_cliente"])
+    df["id_expediente"] = compact_ids(df["id_expediente"])
+
     today = now_ts()  # naive
     delta = today - df["created_at"]
-    df["days_since_created"] = delta.dt.days
+    df["days_since_created"] = delta.dt.days.astype("float32")
+    return df
+
+# ----------------------------------------------------------------------
+# Carga por páginas: cada página se aplana al llegar (ver clients.fetch_pages)
+# ----------------------------------------------------------------------
+PLAZOS_CATEGORICAL = ["expediente_estado", "cliente_nombre"]
+PLAZOS_IDS = ["id_plazo", "expediente_id", "id_cliente"]
+DOCS_CATEGORICAL = ["file_ext"]
+DOCS_IDS = ["size", "id_cliente", "id_expediente"]
+
+def concat_pages(frames: List[pd.DataFrame], categorical: Sequence[str] = (),
+                 ids: Sequence[str] = ()) -> pd.DataFrame:
+    """
+    Une los DataFrames aplanados por página y restaura los dtypes compactos
+    del conjunto (categorías e ids), igual que aplanar todo de una vez.
+    Siempre devuelve un DataFrame propio (los frames pueden ser compartidos).
+    """
+    frames = [f for f in frames if not f.empty]
+    if not frames:
+        return pd.DataFrame()
+    if len(frames) == 1:
+        return frames[0].copy()
+    df = pd.concat(frames, ignore_index=True)
+    for c in categorical:
+        if c in df.columns:
+            df[c] = df[c].astype("category")
+    for c in ids:
+        if c in df.columns:
+            df[c] = compact_ids(df[c])
+    return df
+
+def flatten_plazos_page(items: List[Dict[str, Any]], include_text: bool = False) -> pd.DataFrame:
+    return flatten_plazos({"data": items}, include_text=include_text)
+
+def load_docs_frame(include_filename: bool = True) -> pd.DataFrame:
+    """
+    Documentos del upstream ya aplanados; con paginación el aplanado se solapa
+    con la descarga. Si el upstream falló, el error queda en
+    df.attrs["upstream_errors"], la request se marca como degradada y se
+    sirve el último snapshot completo (si hay uno reciente) en vez de vacío.
+    """
+    served = None
+    if _warm["serving"]:
+        served = _serve_snapshot("docs", _warm_errors(), max_age_s=SNAPSHOT_MAX_AGE_S)
+    if served is None:
+        frames, errors = fetch_docs_pages(partial(flatten_docs, include_filename=include_filename),
+                                          key=("frame", include_filename))
+        if errors:
+            served = _serve_snapshot("docs", errors, max_age_s=SNAPSHOT_MAX_AGE_S)
+    if served is not None:
+        return served if include_filename else served.drop(columns=["filename"], errors="ignore")
+    df = concat_pages(frames, DOCS_CATEGORICAL, DOCS_IDS)
+    df.attrs["upstream_errors"] = errors
+    df.attrs["fingerprint"] = singleflight.fingerprint(df)
+    note_degraded(errors)
+    http_cache.note_version("docs", df)
+    if include_filename:
+        snapshot.offer("docs", df)
     return df
 
 # ----------------------------------------------------------------------
 # Agregados por expediente
 # ----------------------------------------------------------------------
-def aggregate_docs_per_expediente(df_docs: pd.DataFrame) -> pd.DataFrame:
+AGG_DOCS_COLUMNS = [
+    "id_expediente", "docs_count_exp", "docs_total_size_mb", "days_since_last_doc",
+    "recent_docs_7d", "pdf_ratio_exp",
+]
+
+def _is_pdf(ext: pd.Series) -> np.ndarray:
+    """Máscara file_ext == 'pdf' (sin distinguir mayúsculas); con categóricos se evalúa por categoría."""
+    if isinstance(ext.dtype, pd.CategoricalDtype):
+        by_cat = np.append(np.asarray(ext.cat.categories.astype(str).str.lower() == "pdf"), False)
+        return by_cat[ext.cat.codes.to_numpy()]  # código -1 (NaN) -> último elemento (False)
+    return ext.astype(str).str.lower().eq("pdf").to_numpy()
+
+def _finish_docs_agg(base: pd.DataFrame, today: Optional[pd.Timestamp] = None) -> pd.DataFrame:
+    """
+    De (docs_count_exp, docs_total_size_mb, last_doc, pdf_count) por
+    id_expediente a las columnas finales de aggregate_docs_per_expediente.
+    """
+    agg = base.reset_index()
+    today = now_ts() if today is None else today  # naive
+    days = (today - agg["last_doc"]).dt.days
+    agg["days_since_last_doc"] = days
+    agg["recent_docs_7d"] = (days <= 7).astype(int)  # NaT -> NaN -> 0
+    agg["pdf_ratio_exp"] = np.where(
+        agg["docs_count_exp"] > 0,
+        agg["pdf_count"] / agg["docs_count_exp"].where(agg["docs_count_exp"] > 0, 1),
+        0.0,
+    )
+    return agg.drop(columns=["last_doc", "pdf_count"])
+
+def aggregate_docs_per_expediente(df_docs: pd.DataFrame, today: Optional[pd.Timestamp] = None) -> pd.DataFrame:
     """
     Agrega por id_expediente: conteo, total MB, días desde último doc,
-    recent_docs_7d (flag) y proporción de PDFs.
+    recent_docs_7d (flag) y proporción de PDFs. `today` (por defecto, hoy)
+    es la fecha de referencia de las features relativas (backtesting).
+
+    Un solo groupby con agregaciones nativas sobre columnas precalculadas
+    (sin lambdas por grupo ni apply por fila).
     """
     if df_docs.empty:
-        return pd.DataFrame(columns=[
-            "id_expediente", "docs_count_exp", "docs_total_size_mb", "days_since_last_doc",
-            "recent_docs_7d", "pdf_ratio_exp"
-        ])
-    agg = df_docs.groupby("id_expediente").agg(
-        docs_count_exp=("doc_id","count"),
-        docs_total_size_mb=("size_mb","sum"),
-        last_doc=("created_at","max"),
-        pdf_count=("file_ext", lambda s: (s.str.lower()=="pdf").sum()),
-    ).reset_index()
+        return pd.DataFrame(columns=AGG_DOCS_COLUMNS)
+    base = pd.DataFrame({
+        "id_expediente": df_docs["id_expediente"].to_numpy(),
+        "has_id": df_docs["doc_id"].notna().to_numpy(),  # count(doc_id) = no nulos
+        "size_mb": df_docs["size_mb"].to_numpy(),
+        "created_at": df_docs["created_at"].to_numpy(),
+        "is_pdf": _is_pdf(df_docs["file_ext"]),
+    })
+    base = base.groupby("id_expediente").agg(
+        docs_count_exp=("has_id", "sum"),
+        docs_total_size_mb=("size_mb", "sum"),
+        last_doc=("created_at", "max"),
+        pdf_count=("is_pdf", "sum"),
+    )
+    return _finish_docs_agg(base, today)
 
-    today = now_ts()  # naive
-    delta = today - agg["last_doc"]
-    agg["days_since_last_doc"] = delta.dt.days
-    agg["recent_docs_7d"] = agg["last_doc"].apply(lambda x: int(pd.notna(x) and (today - x).days <= 7))
-    agg["pdf_ratio_exp"] = np.where(
-    agg["docs_count_exp"] > 0,
-    agg["pdf_count"] / agg["docs_count_exp"],
-    0.0
-)
-    agg = agg.drop(columns=["last_doc","pdf_count"])
-    return agg
+# ----------------------------------------------------------------------
+# Línea de tiempo de documentos por expediente
+# ----------------------------------------------------------------------
+# Ventanas (días) que load_enriched_plazos agrega como features extra; vacío = ninguna
+ENRICH_DOC_WINDOWS = tuple(int(w) for w in os.getenv("ENRICH_DOC_WINDOWS", "").split(",") if w.strip())
+TIMELINE_CACHE_SIZE = int(os.getenv("TIMELINE_CACHE_SIZE", "2"))
+
+_SEG_SHIFT = 40  # segundos relativos en los 40 bits bajos (~34.000 años); expediente en los altos
+
+class DocTimelineIndex:
+    """
+    created_at ordenado por expediente en formato CSR (un solo array de
+    segundos + offsets por expediente). Cualquier conteo por ventana o
+    recencia sale de un np.searchsorted vectorizado: O(log n) por expediente,
+    sin groupby. Se construye una vez por snapshot de documentos
+    (ver timeline_index()).
+    """
+
+    def __init__(self, df_docs: pd.DataFrame):
+        ids = pd.Series(dtype="float64") if df_docs.empty else df_docs["id_expediente"]
+        created = pd.Series(dtype="datetime64[ns]") if df_docs.empty else pd.to_datetime(df_docs["created_at"])
+        ok = (ids.notna() & created.notna()).to_numpy()
+        # Segundos redondeados hacia arriba: con límites enteros, x > t <=> ceil(x) > t
+        ns = created.to_numpy().astype("datetime64[ns]").view(np.int64)[ok]
+        secs = -((-ns) // 10**9)
+        exp = ids.to_numpy()[ok]
+
+        self.base = int(secs.min()) if len(secs) else 0
+        self.expedientes, seg = np.unique(exp, return_inverse=True)
+        order = np.lexsort((secs, seg))
+        self.seconds = secs[order]
+        seg = seg[order].astype(np.int64)
+        self.offsets = np.searchsorted(seg, np.arange(len(self.expedientes) + 1))
+        self._keys = (seg << _SEG_SHIFT) | (self.seconds - self.base)
+
+    def __len__(self) -> int:
+        return len(self.seconds)
+
+    def _positions(self, t: pd.Timestamp) -> np.ndarray:
+        """Por expediente, índice del primer documento con created_at > t."""
+        rel = int(np.clip(t.value // 10**9 - self.base, -1, (1 << _SEG_SHIFT) - 1))
+        seg = np.arange(len(self.expedientes), dtype=np.int64)
+        if rel < 0:
+            return self.offsets[:-1].copy()
+        return np.searchsorted(self._keys, (seg << _SEG_SHIFT) | rel, side="right")
+
+    def count_within(self, days: int, today: Optional[pd.Timestamp] = None) -> np.ndarray:
+        """Documentos con (today - created_at).days <= days (misma regla que recent_docs_7d)."""
+        today = now_ts() if today is None else today
+        # (today - x).days <= d  <=>  x > today - (d + 1) días (a resolución de segundos)
+        t = today - pd.Timedelta(days=days + 1)
+        return self.offsets[1:] - self._positions(t)
+
+    def features(self, windows: Sequence[int], today: Optional[pd.Timestamp] = None) -> pd.DataFrame:
+        """
+        Por id_expediente: docs_last_{w}d para cada ventana, days_since_first_doc
+        y docs_per_week (documentos / semanas desde el primero, mínimo 1 semana).
+        """
+        today = now_ts() if today is None else today
+        cols: Dict[str, Any] = {"id_expediente": self.expedientes}
+        for w in windows:
+            cols[f"docs_last_{int(w)}d"] = self.count_within(int(w), today)
+        counts = np.diff(self.offsets)
+        first = pd.to_datetime(self.seconds[self.offsets[:-1]] if len(self.seconds) else [], unit="s")
+        days_first = (today - first).days.to_numpy()
+        cols["days_since_first_doc"] = days_first
+        cols["docs_per_week"] = counts / np.maximum(days_first / 7.0, 1.0)
+        return pd.DataFrame(cols)
+
+_timelines: "OrderedDict[str, DocTimelineIndex]" = OrderedDict()
+_timelines_lock = threading.Lock()
+
+def timeline_index(df_docs: pd.DataFrame) -> DocTimelineIndex:
+    """DocTimelineIndex del snapshot df_docs; se reutiliza mientras los documentos no cambien."""
+    key = singleflight.fingerprint(df_docs[["id_expediente", "created_at"]]) if not df_docs.empty else "empty"
+    with _timelines_lock:
+        if key in _timelines:
+            _timelines.move_to_end(key)
+            return _timelines[key]
+    idx = DocTimelineIndex(df_docs)
+    with _timelines_lock:
+        _timelines[key] = idx
+        while len(_timelines) > TIMELINE_CACHE_SIZE:
+            _timelines.popitem(last=False)
+    return idx
+
+def timeline_feature_names(windows: Sequence[int]) -> List[str]:
+    if not windows:
+        return []
+    return [f"docs_last_{int(w)}d" for w in windows] + ["days_since_first_doc", "docs_per_week"]
+
+# ----------------------------------------------------------------------
+# Matrices estandarizadas (compartidas entre workers vía artifacts)
+# ----------------------------------------------------------------------
+def standardized_matrix(X: np.ndarray, name: str) -> Dict[str, np.ndarray]:
+    """
+    Estandariza X como StandardScaler (media 0, desviación poblacional 1;
+    columnas constantes con escala 1). Devuelve {"Xs", "mean", "scale"};
+    con ARTIFACTS_DIR se guarda una vez por huella de datos y se carga mmap.
+    """
+    X = np.asarray(X, dtype=float)
+
+    def compute() -> Dict[str, np.ndarray]:
+        mean = X.mean(axis=0)
+        scale = X.std(axis=0)
+        scale[scale == 0.0] = 1.0
+        return {"Xs": (X - mean) / scale, "mean": mean, "scale": scale}
+
+    return artifacts.load_or_compute_arrays(f"matrix_{name}", singleflight.fingerprint(name, X), compute)
+
+# ----------------------------------------------------------------------
+# Matrices de features por snapshot (clustering, anomalías, autoencoders)
+# ----------------------------------------------------------------------
+FEATURE_MATRIX_CACHE_SIZE = int(os.getenv("FEATURE_MATRIX_CACHE_SIZE", "8"))
+ZERO_VAR_EPS = 1e-8
+
+DOCS_NUM_FEATS = ["size_mb", "days_since_created", "name_len", "is_pdf"]
+DOCS_BASE_COLS = ["doc_id", "filename", "file_ext", "id_expediente", "id_cliente"]
+
+def docs_with_features() -> Tuple[pd.DataFrame, List[str]]:
+    """Documentos con las derivadas numéricas (name_len, is_pdf) y DOCS_NUM_FEATS como float sin NaN."""
+    df = load_docs_frame()
+    if df.empty:
+        return df, []
+    df["name_len"] = df["filename"].astype(str).str.len().fillna(0).astype(float)
+    df["is_pdf"] = (df["file_ext"].astype(str).str.lower() == "pdf").astype(int)
+    for c in ["size_mb", "days_since_created"]:
+        if c not in df.columns:
+            df[c] = 0.0
+    df[DOCS_NUM_FEATS] = df[DOCS_NUM_FEATS].astype(float).fillna(0.0)
+    for c in DOCS_BASE_COLS:  # solo para el output
+        if c not in df.columns:
+            df[c] = None
+    return df, list(DOCS_NUM_FEATS)
+
+class FeatureMatrix:
+    """
+    Features numéricas de un snapshot, listas para los modelos: X (float64
+    C-contigua, NaN -> 0), Xs estandarizada (como StandardScaler), media,
+    desviación (ddof=0), escala (desviación con constantes -> 1) y máscara
+    de varianza ~0. Los arrays son de solo lectura: se comparten entre requests.
+    """
+
+    def __init__(self, X: np.ndarray, columns: Sequence[str], name: str):
+        self.columns = list(columns)
+        self.X = np.ascontiguousarray(X, dtype=float)
+        mat = standardized_matrix(self.X, name)
+        self.Xs, self.mean, self.scale = mat["Xs"], mat["mean"], mat["scale"]
+        self.std = self.X.std(axis=0)
+        self.zero_var = self.std <= ZERO_VAR_EPS
+        for arr in (self.X, self.Xs, self.mean, self.scale, self.std, self.zero_var):
+            arr.setflags(write=False)
+        self._subsets: Dict[Tuple[str, ...], "FeatureMatrix"] = {}
+
+    def __len__(self) -> int:
+        return self.X.shape[0]
+
+    def subset(self, columns: Sequence[str]) -> "FeatureMatrix":
+        """Mismas filas, solo `columns` (la estandarización es por columna: no se recalcula)."""
+        key = tuple(columns)
+        if key == tuple(self.columns):
+            return self
+        if key not in self._subsets:
+            pos = [self.columns.index(c) for c in key]
+            sub = object.__new__(FeatureMatrix)
+            sub.columns = list(key)
+            for attr in ("X", "Xs", "mean", "scale", "std", "zero_var"):
+                arr = np.ascontiguousarray(getattr(self, attr)[..., pos])
+                arr.setflags(write=False)
+                setattr(sub, attr, arr)
+            sub._subsets = {}
+            self._subsets[key] = sub
+        return self._subsets[key]
+
+    def varying(self) -> "FeatureMatrix":
+        """Sin las columnas de varianza ~0 (evitan inestabilidad en los autoencoders)."""
+        return self.subset([c for c, z in zip(self.columns, self.zero_var) if not z])
+
+    def row(self, i: int) -> Dict[str, float]:
+        return dict(zip(self.columns, self.X[i].tolist()))
+
+    def arrays(self) -> List[np.ndarray]:
+        """Arrays propios y de los subconjuntos cacheados (para /debug/memory)."""
+        out = [self.X, self.Xs, self.mean, self.scale, self.std, self.zero_var]
+        for sub in self._subsets.values():
+            out += sub.arrays()
+        return out
+
+_matrices: "OrderedDict[Tuple, FeatureMatrix]" = OrderedDict()
+_matrices_lock = threading.Lock()
+
+def feature_matrix(df: pd.DataFrame, columns: Sequence[str], name: str) -> FeatureMatrix:
+    """
+    FeatureMatrix de df[columns]. Si df viene de un loader (lleva su huella
+    en df.attrs["fingerprint"]) se reutiliza mientras los datos no cambien.
+    """
+    fp = df.attrs.get("fingerprint")
+    key = (name, tuple(columns), fp, len(df))
+
+    def build() -> FeatureMatrix:
+        return FeatureMatrix(df[list(columns)].to_numpy(dtype=float, na_value=0.0), columns, name)
+
+    if fp is None:
+        return build()
+    with _matrices_lock:
+        if key in _matrices:
+            _matrices.move_to_end(key)
+            return _matrices[key]
+    fm = singleflight.features.do(key, build)
+    with _matrices_lock:
+        _matrices[key] = fm
+        while len(_matrices) > FEATURE_MATRIX_CACHE_SIZE:
+            _matrices.popitem(last=False)
+    return fm
+
+def resident_matrices() -> Dict[str, List[np.ndarray]]:
+    """Arrays de las FeatureMatrix cacheadas, por clave (para /debug/memory)."""
+    with _matrices_lock:
+        return {f"{name}[{len(cols)} columnas] {fp}": fm.arrays() for (name, cols, fp, _), fm in _matrices.items()}
+
+def plazos_matrix() -> Tuple[pd.DataFrame, Optional[FeatureMatrix]]:
+    """(plazos enriquecidos, su FeatureMatrix sobre las features numéricas); None si no hay filas."""
+    df, num_feats = load_enriched_plazos()
+    return df, (feature_matrix(df, num_feats, "plazos") if not df.empty else None)
+
+def docs_matrix() -> Tuple[pd.DataFrame, Optional[FeatureMatrix]]:
+    """(documentos con derivadas, su FeatureMatrix sobre DOCS_NUM_FEATS); None si no hay filas."""
+    df, feats = docs_with_features()
+    return df, (feature_matrix(df, feats, "docs") if not df.empty else None)
 
 # ----------------------------------------------------------------------
 # Enriquecimiento de plazos con docs
 # ----------------------------------------------------------------------
-def enrich_plazos_with_docs(df_plazos: pd.DataFrame) -> Tuple[pd.DataFrame, list]:
+def enrich_plazos_with_docs(
+    df_plazos: pd.DataFrame, df_docs: Optional[pd.DataFrame] = None,
+    windows: Sequence[int] = (),
+) -> Tuple[pd.DataFrame, list]:
     """
     Une plazos con agregados de documentos por expediente.
     Retorna (df_enriquecido, lista_features_numericas)
+
+    Si no se pasa df_docs, se traen los documentos del upstream.
+    `windows` (días) agrega features de actividad desde DocTimelineIndex:
+    docs_last_{w}d por ventana, days_since_first_doc y docs_per_week.
+    Requests concurrentes con los mismos plazos comparten un solo enriquecimiento;
+    cada una recibe su propia copia (los routers mutan el DataFrame).
     """
-    df_docs = flatten_docs(fetch_docs())
-    agg = aggregate_docs_per_expediente(df_docs)
+    if df_docs is None:
+        df_docs = load_docs_frame(include_filename=False)
+    windows = tuple(sorted({int(w) for w in windows}))
+    key = singleflight.fingerprint(df_plazos, df_docs, windows)
+    df, num_feats = singleflight.enrichment.do(key, _enrich_plazos_with_docs, df_plazos, df_docs, windows)
+    df = df.copy()
+    df.attrs["upstream_errors"] = {**df_plazos.attrs.get("upstream_errors", {}),
+                                   **df_docs.attrs.get("upstream_errors", {})}
+    return df, list(num_feats)
+
+def _enrich_plazos_with_docs(
+    df_plazos: pd.DataFrame, df_docs: pd.DataFrame, windows: Sequence[int] = (),
+    today: Optional[pd.Timestamp] = None,
+) -> Tuple[pd.DataFrame, list]:
+    agg = aggregate_docs_per_expediente(df_docs, today)
+    extra = timeline_feature_names(windows)
+    if extra and not df_docs.empty:
+        # Con `today` explícito (backtesting) no se ensucia la caché de índices del snapshot vigente
+        index = timeline_index(df_docs) if today is None else DocTimelineIndex(df_docs)
+        agg = agg.merge(index.features(windows, today), how="left", on="id_expediente")
     df = df_plazos.merge(agg, how="left", left_on="expediente_id", right_on="id_expediente")
     df = df.drop(columns=["id_expediente"], errors="ignore")
 
@@ -173,10 +579,152 @@ def enrich_plazos_with_docs(df_plazos: pd.DataFrame) -> Tuple[pd.DataFrame, list
         "days_to_due", "desc_len", "estado_abierto",
         "docs_count_exp", "docs_total_size_mb", "days_since_last_doc",
         "recent_docs_7d", "pdf_ratio_exp"
-    ]
+    ] + extra
     # Completar NaN/ausentes para que los modelos no fallen
-    for c in ["docs_count_exp", "docs_total_size_mb", "days_since_last_doc", "recent_docs_7d", "pdf_ratio_exp"]:
+    for c in ["docs_count_exp", "docs_total_size_mb", "days_since_last_doc", "recent_docs_7d", "pdf_ratio_exp"] + extra:
         if c not in df.columns:
             df[c] = 0
-    df[num_feats] = df[num_feats].fillna(0)
+    # float32 alcanza para todas las features (conteos, días, ratios) y ocupa la mitad
+    df[num_feats] = df[num_feats].fillna(0).astype("float32")
     return df, num_feats
+
+def load_enriched_plazos() -> Tuple[pd.DataFrame, list]:
+    """
+    Pipeline completo para los routers: trae plazos y documentos en paralelo,
+    aplana y enriquece. Si /plazos no trae filas devuelve un DataFrame vacío;
+    si solo fallan los documentos, los agregados quedan en 0.
+    Los orígenes que fallaron quedan en df.attrs["upstream_errors"] (y la
+    request en curso se marca como degradada, ver clients.track_degraded);
+    en ese caso se usa el último snapshot completo si es reciente.
+    Las ventanas de ENRICH_DOC_WINDOWS se agregan como features extra.
+    """
+    if _warm["serving"]:
+        served = _serve_snapshot("plazos_enriched", _warm_errors(), max_age_s=SNAPSHOT_MAX_AGE_S)
+        if served is not None:
+            return served, list(served.attrs["num_feats"])
+    df, num_feats = singleflight.enrichment.do("plazos_enriched", _load_enriched_plazos)
+    note_degraded(df.attrs.get("upstream_errors"))
+    note_snapshot("plazos_enriched", df.attrs.get("snapshot"))
+    http_cache.note_version("plazos_enriched", df)
+    return df.copy(), list(num_feats)
+
+def _load_enriched_plazos() -> Tuple[pd.DataFrame, list]:
+    plazos_pages, docs_pages, errors = fetch_sources(
+        on_page={"plazos": flatten_plazos_page, "docs": partial(flatten_docs, include_filename=False)},
+        key="frames",
+    )
+    df_plazos = concat_pages(plazos_pages, PLAZOS_CATEGORICAL, PLAZOS_IDS)
+    if df_plazos.empty:
+        df, num_feats = df_plazos, []
+    else:
+        df, num_feats = _enrich_plazos_with_docs(
+            df_plazos, concat_pages(docs_pages, DOCS_CATEGORICAL, DOCS_IDS), ENRICH_DOC_WINDOWS)
+    if errors:
+        last = snapshot.load("plazos_enriched")
+        if last is not None and time.time() - last[1]["created_at"] <= SNAPSHOT_MAX_AGE_S:
+            # Último dato completo (datos viejos > datos incompletos); la respuesta sigue marcada
+            df, num_feats = last[0].copy(deep=False), list(last[1]["meta"]["num_feats"])
+            df.attrs = {"upstream_errors": errors, "snapshot": _snapshot_info(last[1])}
+            _refresh_relative_dates(df, num_feats)
+            return df, num_feats
+    df.attrs["upstream_errors"] = errors
+    df.attrs["fingerprint"] = singleflight.fingerprint(df)  # una vez por carga (ETag, matrices de features)
+    snapshot.offer("plazos_enriched", df, {"num_feats": num_feats})
+    return df, num_feats
+
+# ----------------------------------------------------------------------
+# Warm start (snapshots en disco, ver app/snapshot.py)
+# ----------------------------------------------------------------------
+SNAPSHOT_MAX_AGE_S = float(os.getenv("SNAPSHOT_MAX_AGE_S", "86400"))     # fallback ante upstream caído
+SNAPSHOT_RETRY_S = float(os.getenv("SNAPSHOT_RETRY_S", "30"))            # reintento del refresh inicial
+
+# serving: desde el arranque hasta el primer refresh completo se responde con el snapshot
+_warm: Dict[str, Any] = {"serving": False, "errors": {}, "started_at": None, "refreshed_at": None}
+
+# Features relativas a la fecha del snapshot que no se pueden recalcular sin los documentos
+# (los agregados por expediente no guardan las fechas de origen)
+_SNAPSHOT_DATED_FEATURES = ("days_since_last_doc", "recent_docs_7d", "days_since_first_doc", "docs_per_week")
+
+def _warm_errors() -> Dict[str, str]:
+    """
+    Marca de lo servido durante el warm start: nunca vacía, así la respuesta
+    queda degradada, sin ETag y fuera de las cachés de resultados (scored, jobs).
+    """
+    return {"warm_start": "Snapshot en disco hasta el primer refresh completo de los upstreams.",
+            **_warm["errors"]}
+
+def _snapshot_info(manifest: Dict[str, Any]) -> Dict[str, Any]:
+    """snapshot.info + las features que quedan relativas a la fecha del snapshot."""
+    dated = [c for c in _SNAPSHOT_DATED_FEATURES if c in manifest["meta"].get("num_feats", [])]
+    dated += [c for c in manifest["meta"].get("num_feats", []) if c.startswith("docs_last_")]
+    return {**snapshot.info(manifest), **({"features_a_fecha_del_snapshot": dated} if dated else {})}
+
+def _refresh_relative_dates(df: pd.DataFrame, num_feats: Sequence[str] = ()) -> None:
+    """
+    Recalcula respecto de hoy las columnas relativas que se derivan de fechas
+    guardadas en el frame. Las que son features del modelo (num_feats) se
+    completan con 0 como en _enrich_plazos_with_docs.
+    """
+    today = now_ts()  # naive
+    if "days_to_due" in df.columns and "fecha_vencimiento" in df.columns:
+        days = (df["fecha_vencimiento"] - today).dt.days.astype("float32")
+        df["days_to_due"] = days.fillna(0) if "days_to_due" in num_feats else days
+        if "overdue_now" in df.columns:
+            df["overdue_now"] = (days < 0) & (~df["cumplido"])
+    if "days_since_created" in df.columns and "created_at" in df.columns:
+        df["days_since_created"] = (today - df["created_at"]).dt.days.astype("float32")
+
+def _serve_snapshot(name: str, errors: Dict[str, str], max_age_s: Optional[float] = None) -> Optional[pd.DataFrame]:
+    """
+    Snapshot `name` marcado en la request (snapshot + errores); None si no hay o es viejo.
+    Copia superficial: las columnas siguen sobre el mmap (solo lectura) y lo que
+    agregue la request no toca la versión cacheada. Las columnas relativas a hoy
+    que salen de fechas del frame se recalculan; el resto queda listado en
+    snapshot.features_a_fecha_del_snapshot.
+    """
+    last = snapshot.load(name)
+    if last is None:
+        return None
+    df, manifest = last
+    if max_age_s is not None and time.time() - manifest["created_at"] > max_age_s:
+        return None
+    out = df.copy(deep=False)
+    _refresh_relative_dates(out, manifest["meta"].get("num_feats", []))
+    out.attrs = {"upstream_errors": dict(errors), "snapshot": _snapshot_info(manifest),
+                 "num_feats": list(manifest["meta"].get("num_feats", [])),
+                 "fingerprint": manifest.get("fingerprint")}
+    note_degraded(errors)
+    note_snapshot(name, out.attrs["snapshot"])
+    http_cache.note_version(name, out)
+    return out
+
+def _refresh_snapshots() -> None:
+    """Refresh en segundo plano hasta tener datos completos; entonces se deja de servir el snapshot."""
+    while True:
+        df, num_feats = singleflight.enrichment.do("plazos_enriched", _load_enriched_plazos)
+        frames, docs_errors = fetch_docs_pages(partial(flatten_docs, include_filename=True), key=("frame", True))
+        errors = {**df.attrs.get("upstream_errors", {}), **docs_errors}
+        if not errors:
+            snapshot.offer("docs", concat_pages(frames, DOCS_CATEGORICAL, DOCS_IDS))
+            _warm.update(serving=False, errors={}, refreshed_at=time.time())
+            return
+        _warm["errors"] = errors
+        time.sleep(SNAPSHOT_RETRY_S)
+
+def warm_start() -> Dict[str, Any]:
+    """
+    Al arrancar: si hay snapshots en disco se cargan (mmap) y se sirven de
+    inmediato mientras un hilo trae datos frescos de los upstreams.
+    """
+    if not snapshot.enabled():
+        return {"enabled": False}
+    loaded = {}
+    for name in ("plazos_enriched", "docs"):
+        last = snapshot.load(name)
+        loaded[name] = last is not None and time.time() - last[1]["created_at"] <= SNAPSHOT_MAX_AGE_S
+    _warm.update(serving=any(loaded.values()), started_at=time.time())
+    threading.Thread(target=_refresh_snapshots, name="snapshot-refresh", daemon=True).start()
+    return {"enabled": True, "loaded": loaded}
+
+def warm_state() -> Dict[str, Any]:
+    return dict(_warm)
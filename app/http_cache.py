@@ -0,0 +1,267 @@
+# app/http_cache.py
+"""
+Respuestas condicionales (ETag / If-None-Match -> 304) y compresión.
+
+ETag: huella fuerte de (ruta, query ordenada, día, ETAG_SALT, versiones de
+datos). Las versiones las anotan los loaders (features.load_enriched_plazos,
+features.load_docs_frame, ...) con note_version(); en cuanto la huella
+parcial coincide con If-None-Match se corta la request con 304, es decir,
+después de cargar los datos pero antes de ajustar/scorear modelos. Respuestas
+degradadas (algún upstream falló) no llevan ETag.
+
+Compresión: gzip (o brotli, si el paquete `brotli` está instalado y el
+cliente lo acepta) para cuerpos JSON/texto de al menos COMPRESS_MIN_SIZE
+bytes. La representación comprimida lleva el ETag con sufijo (-gzip / -br),
+que se ignora al comparar If-None-Match.
+"""
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from contextlib import contextmanager
+from contextvars import ContextVar
+from urllib.parse import parse_qsl
+import gzip
+import hashlib
+import os
+
+import pandas as pd
+
+from .singleflight import fingerprint
+
+try:
+    import brotli
+    HAS_BROTLI = True
+except Exception:
+    HAS_BROTLI = False
+
+ETAG_ENABLED = os.getenv("ETAG_ENABLED", "true").lower() in ("1", "true", "yes")
+ETAG_SALT = os.getenv("ETAG_SALT", "")                  # p. ej. versión del deploy: invalida ETags viejos
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "5"))
+
+_COMPRESSIBLE = (b"application/json", b"text/", b"application/javascript")
+_SUFFIXES = ("-gzip", "-br")
+
+# Estado de la request HTTP en curso (None fuera de requests, p. ej. en jobs)
+_request: ContextVar[Optional[Dict[str, Any]]] = ContextVar("http_cache_request", default=None)
+
+
+class NotModified(Exception):
+    def __init__(self, etag: str):
+        super().__init__(etag)
+        self.etag = etag
+
+
+# ----------------------------------------------------------------------
+# ETag
+# ----------------------------------------------------------------------
+def _parse_if_none_match(value: str) -> List[str]:
+    tags = []
+    for raw in value.split(","):
+        tag = raw.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        tag = tag.strip('"')
+        for suffix in _SUFFIXES:
+            if tag.endswith(suffix):
+                tag = tag[: -len(suffix)]
+        if tag:
+            tags.append(tag)
+    return tags
+
+
+def _etag(state: Dict[str, Any]) -> str:
+    from .features import today_local  # import tardío: features importa este módulo
+
+    h = hashlib.blake2b(digest_size=16)
+    # El día entra en la huella: las features dependen de "hoy" (días restantes, recencia)
+    h.update(repr((state["key"], str(today_local().date()), ETAG_SALT, state["versions"])).encode())
+    return h.hexdigest()
+
+
+def note_version(name: str, data: Any) -> None:
+    """
+    Anota la versión de un insumo de la respuesta (DataFrame -> su huella, u
+    otro valor vía repr). Si con eso el ETag coincide con If-None-Match, corta
+    la request con NotModified (-> 304). No hace nada fuera de una request.
+    """
+    state = _request.get()
+    if state is None:
+        return
+    if isinstance(data, pd.DataFrame):
+        if data.attrs.get("upstream_errors"):
+            state["cacheable"] = False
+            return
+        data = data.attrs.get("fingerprint") or fingerprint(data)
+    state["versions"].append((name, data))
+    check_not_modified()
+
+
+def check_not_modified() -> None:
+    """Corta con NotModified si el ETag parcial ya coincide con If-None-Match (salvo dentro de suspend_not_modified)."""
+    state = _request.get()
+    if state is None or state.get("suspended") or not state["cacheable"] or not state["if_none_match"]:
+        return
+    tag = _etag(state)
+    if tag in state["if_none_match"] or "*" in state["if_none_match"]:
+        raise NotModified(tag)
+
+
+@contextmanager
+def suspend_not_modified() -> Iterator[None]:
+    """
+    Sin cortes 304 dentro del bloque; las versiones se siguen anotando. Lo usa
+    el líder de singleflight: un NotModified ahí se propagaría a las requests
+    que esperan el mismo cómputo (sin If-None-Match) y se perdería el resultado.
+    Quien llama decide después con check_not_modified().
+    """
+    state = _request.get()
+    if state is None:
+        yield
+        return
+    prev = state.get("suspended", False)
+    state["suspended"] = True
+    try:
+        yield
+    finally:
+        state["suspended"] = prev
+
+
+def noted_versions() -> List[Tuple[str, Any]]:
+    """Versiones anotadas hasta ahora en la request (para reanotarlas al servir un resultado cacheado)."""
+    state = _request.get()
+    return list(state["versions"]) if state is not None and state["cacheable"] else []
+
+
+def replay(versions: List[Tuple[str, Any]]) -> None:
+    """Anota las versiones de un resultado cacheado que falten: mismo ETag que al calcularlo."""
+    state = _request.get()
+    if state is None:
+        return
+    for name, data in versions:
+        if (name, data) not in state["versions"]:
+            note_version(name, data)
+
+
+def current_etag() -> Optional[str]:
+    state = _request.get()
+    if state is None or not state["cacheable"] or not state["versions"]:
+        return None
+    return _etag(state)
+
+
+async def not_modified_handler(request, exc: NotModified):
+    from starlette.responses import Response
+
+    return Response(status_code=304, headers={"ETag": f'"{exc.etag}"', "Vary": "Accept-Encoding"})
+
+
+# ----------------------------------------------------------------------
+# Middlewares ASGI
+# ----------------------------------------------------------------------
+def _header(scope: Dict[str, Any], name: bytes) -> str:
+    for k, v in scope.get("headers", []):
+        if k == name:
+            return v.decode("latin-1")
+    return ""
+
+
+class ConditionalMiddleware:
+    """Prepara el estado de la request y agrega ETag a las respuestas 200 cacheables."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in ("GET", "HEAD") or not ETAG_ENABLED:
+            await self.app(scope, receive, send)
+            return
+        query = sorted(parse_qsl(scope.get("query_string", b"").decode("latin-1"), keep_blank_values=True))
+        state = {
+            "key": (scope["path"], tuple(query)),
+            "if_none_match": _parse_if_none_match(_header(scope, b"if-none-match")),
+            "versions": [],
+            "cacheable": True,
+        }
+        token = _request.set(state)  # los handlers sync corren con una copia de este contexto
+
+        async def send_with_etag(message):
+            if message["type"] == "http.response.start" and message["status"] == 200:
+                tag = current_etag()
+                if tag is not None:
+                    headers = [(k, v) for k, v in message.get("headers", []) if k != b"etag"]
+                    headers.append((b"etag", f'"{tag}"'.encode()))
+                    message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_etag)
+        finally:
+            _request.reset(token)
+
+
+def _encoding_for(accept: str) -> Optional[str]:
+    accepted = {part.split(";")[0].strip().lower() for part in accept.split(",")}
+    if HAS_BROTLI and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+class CompressionMiddleware:
+    """
+    Comprime cuerpos completos (no streaming) de al menos COMPRESS_MIN_SIZE
+    bytes con br o gzip según Accept-Encoding. Respuestas en streaming y
+    tipos no comprimibles pasan tal cual.
+    """
+
+    def __init__(self, app, minimum_size: int = COMPRESS_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        encoding = _encoding_for(_header(scope, b"accept-encoding")) if scope["type"] == "http" else None
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start: Dict[str, Any] = {}
+
+        async def send_compressed(message):
+            nonlocal start
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if message["type"] != "http.response.body" or not start:
+                await send(message)
+                return
+            headers: List[Tuple[bytes, bytes]] = list(start.get("headers", []))
+            first, start = start, {}
+            body = message.get("body", b"")
+            ctype = next((v for k, v in headers if k == b"content-type"), b"")
+            already = any(k == b"content-encoding" for k, _ in headers)
+            if (message.get("more_body") or already or len(body) < self.minimum_size
+                    or not ctype.startswith(_COMPRESSIBLE)):
+                await send(first)
+                await send(message)
+                return
+            body = compress(body, encoding)
+            out = []
+            for k, v in headers:
+                if k == b"content-length":
+                    continue
+                if k == b"etag":
+                    v = v[:-1] + f"-{encoding}".encode() + b'"' if v.endswith(b'"') else v
+                out.append((k, v))
+            out += [(b"content-encoding", encoding.encode()), (b"content-length", str(len(body)).encode()),
+                    (b"vary", b"Accept-Encoding")]
+            await send({**first, "headers": out})
+            await send({**message, "body": body})
+
+        await self.app(scope, receive, send_compressed)
@@ -0,0 +1,278 @@
+# app/jobs.py
+"""
+Jobs asíncronos para los cómputos pesados (KMeans, IsolationForest, CV,
+autoencoders). Se ejecutan en un pool de *procesos* acotado para no competir
+por el GIL con el event loop / threadpool de uvicorn (y no atrasar /health).
+
+- submit(task, params) -> Job (reutiliza uno pendiente o un resultado reciente
+  con la misma clave task+params)
+- get(job_id) -> Job | None
+
+Los parámetros se validan con la firma del handler GET correspondiente.
+"""
+from typing import Any, Callable, Dict, Optional
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import importlib
+import inspect
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+from pydantic import ValidationError, create_model
+
+from . import cpu_budget
+from .singleflight import fingerprint
+
+logger = logging.getLogger(__name__)
+
+JOBS_MAX_WORKERS = int(os.getenv("JOBS_MAX_WORKERS", "1"))
+JOBS_MAX_PENDING = int(os.getenv("JOBS_MAX_PENDING", "16"))
+JOBS_RESULT_TTL_S = float(os.getenv("JOBS_RESULT_TTL_S", "600"))
+JOBS_CACHE_SIZE = int(os.getenv("JOBS_CACHE_SIZE", "64"))
+
+# task -> "modulo:funcion" (handlers existentes; el worker los llama con sus defaults)
+TASKS: Dict[str, str] = {
+    "prob_riesgo": "app.routers.supervisado:prob_riesgo",
+    "tuning_supervisado": "app.routers.supervisado:tuning",
+    "backtest_supervisado": "app.routers.supervisado:backtest",
+    "clusters": "app.routers.nosupervisado:clusters",
+    "clusters_text": "app.routers.nosupervisado:clusters_text",
+    "anomalias": "app.routers.nosupervisado:anomalias",
+    "docs_clusters": "app.routers.docs_analytics:docs_clusters",
+    "docs_anomalias": "app.routers.docs_analytics:docs_anomalias",
+    "docs_near_duplicados": "app.routers.docs_analytics:docs_near_duplicados",
+    "reg_plazos_dias_restantes": "app.routers.regresion:reg_plazos_dias_restantes",
+    "reg_docs_size_mb": "app.routers.regresion:reg_docs_size_mb",
+    "deep_plazos_autoencoder": "app.routers.deep:deep_plazos_autoencoder",
+    "deep_docs_autoencoder": "app.routers.deep:deep_docs_autoencoder",
+}
+
+# task -> "modulo:funcion" que se aplica en el proceso API al recibir el resultado
+# (efectos que el worker no puede dejar en el proceso API, p. ej. la config promovida)
+ON_RESULT: Dict[str, str] = {
+    "tuning_supervisado": "app.tuning:apply_job_result",
+}
+
+
+class JobRejected(Exception):
+    """Cola llena (JOBS_MAX_PENDING) o task desconocida."""
+
+
+# ----------------------------------------------------------------------
+# Lado worker (proceso hijo)
+# ----------------------------------------------------------------------
+def _resolve(task: str) -> Callable[..., Any]:
+    mod_name, fn_name = TASKS[task].split(":")
+    return getattr(importlib.import_module(mod_name), fn_name)
+
+
+def call_with_defaults(fn: Callable[..., Any], params: Dict[str, Any]) -> Any:
+    """Llama a un handler resolviendo los defaults de Query(...) que no vengan en params."""
+    kwargs = {}
+    for name, p in inspect.signature(fn).parameters.items():
+        if name in params:
+            kwargs[name] = params[name]
+        elif p.default is not inspect.Parameter.empty:
+            kwargs[name] = getattr(p.default, "default", p.default)
+    return fn(**kwargs)
+
+
+_param_models: Dict[str, Any] = {}
+
+
+def validate_params(task: str, raw: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Valida/convierte los parámetros con la misma firma (tipos y límites de
+    Query) que el handler GET. Devuelve todos los parámetros, con defaults.
+    """
+    model = _param_models.get(task)
+    if model is None:
+        fields = {}
+        for name, p in inspect.signature(_resolve(task)).parameters.items():
+            if name == "async_":
+                continue
+            fields[name] = (p.annotation, p.default)
+        model = _param_models[task] = create_model(f"{task}_params", **fields)
+    unknown = set(raw) - set(model.model_fields)
+    if unknown:
+        raise HTTPException(status_code=422, detail=f"Parámetros desconocidos para {task}: {sorted(unknown)}")
+    try:
+        return model(**raw).model_dump()
+    except ValidationError as exc:
+        raise HTTPException(status_code=422, detail=exc.errors(include_url=False))
+
+
+def _run_task(task: str, params: Dict[str, Any]) -> Any:
+    # Dentro del worker siempre se calcula (aunque el handler encole por defecto)
+    out = call_with_defaults(_resolve(task), {**params, "async_": False})
+    # Algunos handlers devuelven JSONResponse; el resultado del job es el JSON
+    body = getattr(out, "body", None)
+    if isinstance(body, (bytes, bytearray)):
+        return json.loads(body)
+    return out
+
+
+# ----------------------------------------------------------------------
+# Lado API
+# ----------------------------------------------------------------------
+class Job:
+    __slots__ = ("id", "task", "params", "key", "created_at", "finished_at", "future")
+
+    def __init__(self, task: str, params: Dict[str, Any], key: str, future: Future):
+        self.id = uuid.uuid4().hex
+        self.task = task
+        self.params = params
+        self.key = key
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.future = future
+
+    @property
+    def status(self) -> str:
+        # Terminado recién cuando el proceso API procesó el resultado (ON_RESULT)
+        if not self.future.done() or self.finished_at is None:
+            return "en_ejecucion" if self.future.running() or self.future.done() else "pendiente"
+        return "error" if self.future.exception() is not None else "terminado"
+
+    def to_dict(self, with_result: bool = True) -> Dict[str, Any]:
+        out: Dict[str, Any] = {
+            "job_id": self.id,
+            "task": self.task,
+            "params": self.params,
+            "key": self.key,
+            "status": self.status,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "poll": f"/ml/jobs/{self.id}",
+        }
+        if with_result and self.future.done() and self.finished_at is not None:
+            exc = self.future.exception()
+            if exc is not None:
+                out["error"] = repr(exc)
+            else:
+                out["result"] = self.future.result()
+        return out
+
+
+_lock = threading.Lock()
+_pool: Optional[ProcessPoolExecutor] = None
+_jobs: Dict[str, Job] = {}
+_by_key: "OrderedDict[str, Job]" = OrderedDict()
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # spawn: el proceso API tiene hilos (uvicorn, pools); fork no es seguro
+        # Los workers comparten las fichas de CPU del proceso API (app/cpu_budget.py)
+        _pool = ProcessPoolExecutor(max_workers=JOBS_MAX_WORKERS,
+                                    mp_context=multiprocessing.get_context("spawn"),
+                                    initializer=cpu_budget.attach,
+                                    initargs=(cpu_budget.shared_tokens(), cpu_budget.shared_over_budget()))
+    return _pool
+
+
+def _reset_pool() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+    _pool = None
+    # Un worker muerto no devuelve sus fichas: el pool nuevo arranca con un semáforo nuevo
+    cpu_budget.reset_shared()
+
+
+def job_key(task: str, params: Dict[str, Any]) -> str:
+    return fingerprint(task, sorted(params.items()))
+
+
+def _evict_locked(now: float) -> None:
+    for key, job in list(_by_key.items()):
+        expired = job.finished_at is not None and now - job.finished_at > JOBS_RESULT_TTL_S
+        if expired or (len(_by_key) > JOBS_CACHE_SIZE and job.future.done()):
+            _by_key.pop(key, None)
+            _jobs.pop(job.id, None)
+    # Jobs fuera del índice por clave (p. ej. resultados degradados) expiran por TTL
+    for job_id, job in list(_jobs.items()):
+        if job.finished_at is not None and now - job.finished_at > JOBS_RESULT_TTL_S:
+            _jobs.pop(job_id, None)
+
+
+def submit(task: str, params: Dict[str, Any]) -> Job:
+    if task not in TASKS:
+        raise JobRejected(f"Task desconocida: {task}. Disponibles: {sorted(TASKS)}")
+    key = job_key(task, params)
+    with _lock:
+        now = time.time()
+        _evict_locked(now)
+        job = _by_key.get(key)
+        # Misma clave: se reutiliza el job en curso o el resultado vigente (no los fallidos)
+        if job is not None and not (job.future.done() and job.future.exception() is not None):
+            _by_key.move_to_end(key)
+            return job
+        pending = sum(1 for j in _jobs.values() if not j.future.done())
+        if pending >= JOBS_MAX_PENDING:
+            raise JobRejected(f"Cola de jobs llena ({pending}/{JOBS_MAX_PENDING}); reintenta más tarde.")
+        try:
+            future = _get_pool().submit(_run_task, task, params)
+        except BrokenProcessPool:
+            # Un worker murió (p. ej. OOM): se recrea el pool y se reintenta una vez
+            _reset_pool()
+            future = _get_pool().submit(_run_task, task, params)
+        job = Job(task, params, key, future)
+        _jobs[job.id] = job
+        _by_key[key] = job
+
+    def _done(_f: Future, job: Job = job) -> None:
+        if _f.exception() is not None:
+            logger.error("job %s (%s) falló: %r", job.id, job.task, _f.exception())
+        else:
+            if job.task in ON_RESULT and isinstance(_f.result(), dict):
+                mod_name, fn_name = ON_RESULT[job.task].split(":")
+                try:
+                    getattr(importlib.import_module(mod_name), fn_name)(_f.result())
+                except Exception:
+                    logger.exception("job %s (%s): no se pudo aplicar el resultado", job.id, job.task)
+            if isinstance(_f.result(), dict) and _f.result().get("degraded"):
+                # Calculado con un upstream caído: sigue consultable por id, pero no se reutiliza
+                with _lock:
+                    if _by_key.get(job.key) is job:
+                        _by_key.pop(job.key)
+        job.finished_at = time.time()
+    future.add_done_callback(_done)
+    return job
+
+
+def submit_response(task: str, params: Dict[str, Any]) -> JSONResponse:
+    """Respuesta 202 con el handle del job (usada por POST /ml/jobs y por `async=true`)."""
+    try:
+        job = submit(task, validate_params(task, params))
+    except JobRejected as exc:
+        return JSONResponse({"status": "rechazado", "detail": str(exc)}, status_code=429)
+    return JSONResponse(job.to_dict(with_result=False), status_code=202)
+
+
+def get(job_id: str) -> Optional[Job]:
+    with _lock:
+        return _jobs.get(job_id)
+
+
+def stats() -> Dict[str, Any]:
+    with _lock:
+        jobs = list(_jobs.values())
+    by_status: Dict[str, int] = {}
+    for j in jobs:
+        by_status[j.status] = by_status.get(j.status, 0) + 1
+    return {"max_workers": JOBS_MAX_WORKERS, "max_pending": JOBS_MAX_PENDING, "jobs": by_status}
+
+
+def shutdown() -> None:
+    with _lock:
+        _reset_pool()
@@ -6,6 +6,10 @@ from .routers.debug import router as dbg_router
 from .routers.docs_analytics import router as docs_router
 from .routers.regresion import router as reg_router
 from .routers.deep import router as deep_router
+from .routers.jobs import router as jobs_router
+from .routers.similares import router as sim_router
+from . import cpu_budget, features, jobs
+from .http_cache import CompressionMiddleware, ConditionalMiddleware, NotModified, not_modified_handler
 app = FastAPI(
     title="ML Plazos Service",
     description="Supervisado, no supervisado (plazos y docs) y planificador.",
@@ -21,6 +25,11 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# ETag/304 a partir de la huella de los datos + parámetros, y compresión de cuerpos grandes
+app.add_middleware(ConditionalMiddleware)
+app.add_middleware(CompressionMiddleware)
+app.add_exception_handler(NotModified, not_modified_handler)
+
 @app.get("/health")
 async def health():
     """Health endpoint, async-friendly for readiness/liveness probes.
@@ -50,4 +59,23 @@ app.include_router(docs_router)
 app.include_router(dbg_router)
 app.include_router(docs_router)
 app.include_router(reg_router)
-app.include_router(deep_router) 
\ No newline at end of file
+app.include_router(deep_router)
+app.include_router(jobs_router)
+app.include_router(sim_router)
+
+
+@app.on_event("startup")
+def _cpu_budget():
+    # BLAS/OpenMP/torch arrancan con un hilo por core del host; se acotan a la cuota del contenedor
+    cpu_budget.init()
+
+
+@app.on_event("startup")
+def _warm_start():
+    # Snapshots en disco (SNAPSHOT_DIR): se sirven de inmediato y se refrescan en segundo plano
+    features.warm_start()
+
+
+@app.on_event("shutdown")
+def _shutdown_jobs():
+    jobs.shutdown() 
\ No newline at end of file
@@ -1,51 +1,209 @@
-from typing import Optional, List, Tuple, Dict, Any
+from typing import Optional, List, Tuple, Dict, Any, Union
+import json
+import logging
 import math
+import os
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
 import pandas as pd
+import scipy.sparse as sp
+from joblib import Parallel, delayed
 from sklearn.pipeline import Pipeline
 from sklearn.compose import ColumnTransformer
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.linear_model import LogisticRegression
 from sklearn.preprocessing import StandardScaler
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.decomposition import TruncatedSVD
 from sklearn.ensemble import IsolationForest
 from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.metrics import davies_bouldin_score, silhouette_score
 from sklearn.impute import SimpleImputer
 from sklearn.preprocessing import StandardScaler
 from sklearn.pipeline import Pipeline
 from sklearn.compose import ColumnTransformer
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.linear_model import LogisticRegression
+from . import cpu_budget
+from .artifacts import ARTIFACTS_DIR
 from .features import today_local
+from . import singleflight
+from .singleflight import fingerprint, shared_fit
+from .text_features import TEXT_BACKEND, feature_names, make_text_vectorizer
+
+logger = logging.getLogger(__name__)
 
 MIN_TRAIN_ROWS = 5
 RANDOM_STATE = 42
 
-def build_train_labels(df: pd.DataFrame) -> pd.DataFrame:
+# Umbrales de prioridad_recomendada sobre riesgo_atraso
+RIESGO_ALTA = 0.66
+RIESGO_MEDIA = 0.33
+
+# Config del pipeline supervisado; /ml/supervisado/tuning promueve el ganador.
+# Con ARTIFACTS_DIR la config promovida se comparte entre workers/réplicas.
+SUPERVISED_DEFAULTS: Dict[str, Any] = {"max_features": 500, "ngram_range": [1, 2], "C": 1.0, "max_iter": 200}
+SUPERVISED_CONFIG_PATH = os.getenv(
+    "SUPERVISED_CONFIG_PATH", os.path.join(ARTIFACTS_DIR, "supervised_config.json") if ARTIFACTS_DIR else "")
+
+# k=auto: el barrido se evalúa sobre una submuestra acotada (costo independiente de n)
+KAUTO_SAMPLE = int(os.getenv("KAUTO_SAMPLE", "5000"))
+KAUTO_SILHOUETTE_SAMPLE = int(os.getenv("KAUTO_SILHOUETTE_SAMPLE", "2000"))
+KAUTO_N_INIT = int(os.getenv("KAUTO_N_INIT", "3"))
+KAUTO_N_JOBS = int(os.getenv("KAUTO_N_JOBS", "-1"))  # -1 = la concesión de CPU (app/cpu_budget.py)
+
+# Modo n grande: fit sobre una submuestra estratificada, scoring por chunks
+MAX_TRAIN_ROWS = int(os.getenv("MAX_TRAIN_ROWS", "50000"))
+SCORE_CHUNK_ROWS = int(os.getenv("SCORE_CHUNK_ROWS", "50000"))
+
+# ----------------------------------------------------------------------
+# Modo n grande
+# ----------------------------------------------------------------------
+def stratified_sample_idx(n: int, max_rows: int, strata=None, random_state: int = RANDOM_STATE) -> np.ndarray:
+    """
+    Índices ordenados de a lo sumo max_rows filas. Con `strata` (p. ej.
+    estado_abierto o file_ext) la muestra es proporcional por estrato, con al
+    menos una fila de cada uno. Reproducible con random_state.
+    """
+    if n <= max_rows:
+        return np.arange(n)
+    rng = np.random.default_rng(random_state)
+    if strata is None:
+        return np.sort(rng.choice(n, size=max_rows, replace=False))
+
+    codes, _ = pd.factorize(pd.Series(np.asarray(strata)), use_na_sentinel=False)
+    counts = np.bincount(codes)
+    quota = counts * (max_rows / n)
+    alloc = np.minimum(np.maximum(np.floor(quota).astype(int), 1), counts)
+    # Ajuste al total exacto: sobrantes a los de mayor fracción, excesos a los más grandes
+    for c in np.argsort(-(quota - np.floor(quota))):
+        if alloc.sum() >= max_rows:
+            break
+        if alloc[c] < counts[c]:
+            alloc[c] += 1
+    while alloc.sum() > max_rows:
+        alloc[np.argmax(alloc)] -= 1
+
+    order = np.argsort(codes, kind="stable")
+    bounds = np.concatenate([[0], np.cumsum(counts)])
+    picks = [rng.choice(order[bounds[c]:bounds[c + 1]], size=a, replace=False)
+             for c, a in enumerate(alloc) if a > 0]
+    return np.sort(np.concatenate(picks))
+
+def chunked_apply(fn, X, chunk_rows: int = SCORE_CHUNK_ROWS) -> np.ndarray:
+    """fn(X) por bloques de chunk_rows filas (memoria acotada al scorear todo el dataset)."""
+    n = X.shape[0]  # ndarray o matriz dispersa
+    if n <= chunk_rows:
+        return np.asarray(fn(X))
+    return np.concatenate([np.asarray(fn(X[i:i + chunk_rows])) for i in range(0, n, chunk_rows)])
+
+# ----------------------------------------------------------------------
+# Explicaciones vectorizadas (top-k features por fila)
+# ----------------------------------------------------------------------
+def zscore_matrix(X) -> np.ndarray:
+    """z = (x - media) / desviación por columna (ddof=1, como pandas); desviación 0 -> 1e-9."""
+    X = np.asarray(X, dtype=float)
+    sigma = X.std(axis=0, ddof=1) if len(X) > 1 else np.full(X.shape[1], np.nan)
+    sigma[sigma == 0] = 1e-9
+    return (X - X.mean(axis=0)) / sigma
+
+def top_k_features(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Por fila, índices de las k columnas de mayor score en orden descendente:
+    np.argpartition sobre toda la matriz + orden de solo esos k.
+    """
+    n, d = scores.shape
+    k = max(0, min(k, d))
+    if k < d:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        part = np.broadcast_to(np.arange(d), (n, d))
+    order = np.argsort(-np.take_along_axis(scores, part, axis=1), axis=1, kind="stable")
+    return np.take_along_axis(part, order, axis=1)
+
+def format_reasons(top_idx: np.ndarray, row: int, feats: List[str],
+                   columns: Dict[str, np.ndarray]) -> List[Dict[str, Any]]:
+    """[{"feature", <nombre>: valor, ...}] de una fila a partir de top_k_features."""
+    return [
+        {"feature": feats[j], **{name: float(arr[row, j]) for name, arr in columns.items()}}
+        for j in top_idx[row]
+    ]
+
+def outcome_labels(df: pd.DataFrame, today: Optional[pd.Timestamp] = None) -> pd.Series:
+    """
+    Etiqueta de atraso por fila (float: 1, 0 o NaN si aún no se conoce) a la fecha `today`:
+    - cumplido: 1 si se cumplió después del vencimiento (NaN sin alguna de las fechas)
+    - pendiente: 1 si ya venció; si no, NaN
+    """
+    today = pd.Timestamp.now().normalize() if today is None else today
+    fv, fc = df["fecha_vencimiento"], df["fecha_cumplimiento"]
+    cumplido = df["cumplido"].astype(bool).to_numpy()
+    done = np.where(fc.notna() & fv.notna(), (fc > fv).astype(float), np.nan)
+    pending = np.where(fv.notna() & (today > fv), 1.0, np.nan)
+    return pd.Series(np.where(cumplido, done, pending), index=df.index)
+
+def build_train_labels(df: pd.DataFrame, today: Optional[pd.Timestamp] = None) -> pd.DataFrame:
     if df.empty:
         return df
 
-    def label_row(row):
-        fv = row["fecha_vencimiento"]   # Timestamp o NaT
-        fc = row["fecha_cumplimiento"]  # Timestamp o NaT
-        cumplido = row["cumplido"]
-        todayd = pd.Timestamp.now().normalize()
-
-        if cumplido:
-            if pd.isna(fc) or pd.isna(fv):
-                return None
-            return 1 if fc > fv else 0
-        else:
-            if pd.isna(fv):
-                return None
-            return 1 if todayd > fv else None
-
-    y = df.apply(label_row, axis=1)
+    y = outcome_labels(df, today)
     df_lab = df.copy()
     df_lab["y"] = y
     df_lab = df_lab[~df_lab["y"].isna()]
     df_lab["y"] = df_lab["y"].astype(int)
     return df_lab
-def build_supervised_pipeline(num_feats: List[str]) -> Pipeline:
+# ----------------------------------------------------------------------
+# Config promovida del modelo supervisado
+# ----------------------------------------------------------------------
+_config_lock = threading.Lock()
+_config: Dict[str, Any] = {"params": dict(SUPERVISED_DEFAULTS), "metrics": None, "promoted_at": None}
+_config_mtime: Optional[float] = None
+
+def supervised_config() -> Dict[str, Any]:
+    """{"params", "metrics", "promoted_at"}; relee SUPERVISED_CONFIG_PATH si cambió (otro worker promovió)."""
+    global _config, _config_mtime
+    if SUPERVISED_CONFIG_PATH:
+        try:
+            mtime = os.path.getmtime(SUPERVISED_CONFIG_PATH)
+        except OSError:
+            mtime = None
+        if mtime is not None and mtime != _config_mtime:
+            try:
+                with open(SUPERVISED_CONFIG_PATH) as fh:
+                    data = json.load(fh)
+                with _config_lock:
+                    _config = {**data, "params": {**SUPERVISED_DEFAULTS, **data.get("params", {})}}
+                    _config_mtime = mtime
+            except (OSError, ValueError):
+                logger.exception("Config supervisada ilegible %s; se mantiene la actual", SUPERVISED_CONFIG_PATH)
+    with _config_lock:
+        return dict(_config)
+
+def promote_supervised_config(params: Dict[str, Any], metrics: Dict[str, Any]) -> bool:
+    """Fija la config del pipeline servido. Devuelve True si quedó persistida (compartida)."""
+    global _config
+    data = {"params": {**SUPERVISED_DEFAULTS, **params}, "metrics": metrics, "promoted_at": time.time()}
+    with _config_lock:
+        _config = data
+    if not SUPERVISED_CONFIG_PATH:
+        return False
+    tmp = f"{SUPERVISED_CONFIG_PATH}.tmp-{os.getpid()}"
+    try:
+        os.makedirs(os.path.dirname(SUPERVISED_CONFIG_PATH) or ".", exist_ok=True)
+        with open(tmp, "w") as fh:
+            json.dump(data, fh)
+        os.replace(tmp, SUPERVISED_CONFIG_PATH)  # atómico
+        return True
+    except OSError:
+        logger.exception("No se pudo persistir la config supervisada en %s", SUPERVISED_CONFIG_PATH)
+        return False
+
+def build_supervised_pipeline(num_feats: List[str], config: Optional[Dict[str, Any]] = None,
+                              memory=None) -> Pipeline:
+    """Pipeline texto + numéricas -> LogisticRegression con la config promovida (o `config`)."""
+    cfg = {**SUPERVISED_DEFAULTS, **(supervised_config()["params"] if config is None else config)}
     text_feat = "descripcion"
 
     num_pipe = Pipeline([
@@ -55,23 +213,29 @@ def build_supervised_pipeline(num_feats: List[str]) -> Pipeline:
 
     pre = ColumnTransformer(
         transformers=[
-            ("txt", TfidfVectorizer(max_features=500, ngram_range=(1, 2)), text_feat),
+            ("txt", make_text_vectorizer(max_features=int(cfg["max_features"]),
+                                         ngram_range=tuple(cfg["ngram_range"])), text_feat),
             ("num", num_pipe, num_feats),
         ],
         remainder="drop",
         sparse_threshold=0.3,
     )
 
-    clf = LogisticRegression(max_iter=200, random_state=42, class_weight="balanced")
-    return Pipeline([("pre", pre), ("clf", clf)])
+    clf = LogisticRegression(C=float(cfg["C"]), max_iter=int(cfg["max_iter"]), random_state=42,
+                             class_weight="balanced")
+    # memory: cachea el fit de "pre" (tokenización incluida) entre candidatos del tuning
+    return Pipeline([("pre", pre), ("clf", clf)], memory=memory)
 def ensure_supervised_model(df: pd.DataFrame, num_feats: List[str]) -> Tuple[Optional[Pipeline], str]:
     df_lab = build_train_labels(df)
     if df_lab.shape[0] < MIN_TRAIN_ROWS:
         return None, f"No hay suficientes datos etiquetados para entrenar (tengo {df_lab.shape[0]}/{MIN_TRAIN_ROWS}). Se usará una heurística."
     X = df_lab[["descripcion"] + num_feats]
     y = df_lab["y"]
-    pipe = build_supervised_pipeline(num_feats)
-    pipe.fit(X, y)
+    cfg = supervised_config()["params"]
+    # Mismo (features, config, datos) en requests concurrentes => un solo fit compartido
+    key = ("supervised", TEXT_BACKEND, tuple(num_feats), json.dumps(cfg, sort_keys=True))
+    pipe = shared_fit(key, df_lab[["descripcion"] + num_feats + ["y"]],
+                      lambda: build_supervised_pipeline(num_feats, cfg).fit(X, y))
     return pipe, f"Modelo entrenado con {len(y)} ejemplos (balance={y.mean():.2f} positivos)."
 
 def heuristic_risk(days_to_due: Optional[float]) -> float:
@@ -79,18 +243,20 @@ def heuristic_risk(days_to_due: Optional[float]) -> float:
         return 0.5
     return 1.0 / (1.0 + math.exp(0.5 * days_to_due))
 
-def score_supervised(df: pd.DataFrame, model: Optional[Pipeline], num_feats: List[str]) -> List[Dict[str, Any]]:
-    rows = []
-    if df.empty:
-        return rows
-    X_all = df[["descripcion"] + num_feats]
+def predict_risk(df: pd.DataFrame, model: Optional[Pipeline], num_feats: List[str]) -> np.ndarray:
+    """riesgo_atraso por fila (probabilidad del modelo, o heurística por days_to_due sin modelo)."""
     if model is not None:
-        proba = model.predict_proba(X_all)[:, 1]
-    else:
-        proba = df["days_to_due"].apply(heuristic_risk).values
-    for idx, r in df.iterrows():
+        return model.predict_proba(df[["descripcion"] + num_feats])[:, 1]
+    return df["days_to_due"].apply(heuristic_risk).values
+
+def risk_rows(df: pd.DataFrame, proba: np.ndarray, positions: Optional[np.ndarray] = None) -> List[Dict[str, Any]]:
+    """Filas de prob_riesgo; con `positions` solo esas (orden del DataFrame)."""
+    rows = []
+    positions = np.arange(len(df)) if positions is None else positions
+    for idx in positions:
+        r = df.iloc[idx]
         risk = float(proba[idx])
-        recomendacion = "ALTA" if risk >= 0.66 else "MEDIA" if risk >= 0.33 else "BAJA"
+        recomendacion = "ALTA" if risk >= RIESGO_ALTA else "MEDIA" if risk >= RIESGO_MEDIA else "BAJA"
         rows.append({
             "id_plazo": int(r["id_plazo"]),
             "expediente_id": int(r["expediente_id"]) if pd.notna(r["expediente_id"]) else None,
@@ -103,21 +269,82 @@ def score_supervised(df: pd.DataFrame, model: Optional[Pipeline], num_feats: Lis
         })
     return rows
 
-def build_unsupervised_features(df: pd.DataFrame, num_feats: List[str]):
+def score_supervised(df: pd.DataFrame, model: Optional[Pipeline], num_feats: List[str]) -> List[Dict[str, Any]]:
+    if df.empty:
+        return []
+    return risk_rows(df, predict_risk(df, model, num_feats))
+
+def build_unsupervised_features(df: pd.DataFrame, num_feats: List[str], max_features: int = 500):
+    """
+    TF-IDF de descripcion + numéricas escaladas (sin centrar), todo en CSR:
+    la memoria es proporcional a los no-ceros, nunca se densifica.
+    """
     text = df["descripcion"].fillna("")
-    tfidf = TfidfVectorizer(max_features=500, ngram_range=(1,2))
+    tfidf = make_text_vectorizer(max_features=max_features)
     X_text = tfidf.fit_transform(text)
     num = df[num_feats].fillna(0)
     scaler = StandardScaler(with_mean=False)
     X_num = scaler.fit_transform(num)
-    from scipy.sparse import hstack
-    X = hstack([X_text, X_num])
+    X = sp.hstack([X_text, sp.csr_matrix(X_num)], format="csr")
     return X, tfidf, scaler, num
 
 def kmeans_labels(X, k: int):
     km = KMeans(n_clusters=k, n_init=10, random_state=RANDOM_STATE)
     return km.fit_predict(X)
 
+def select_k(X, k_min: int = 2, k_max: int = 10, random_state: int = RANDOM_STATE) -> Dict[str, Any]:
+    """
+    Barre k en [k_min, k_max] en paralelo (hilos) sobre una submuestra de
+    KAUTO_SAMPLE filas: KMeans con KAUTO_N_INIT inicios por k, silhouette
+    (sobre KAUTO_SILHOUETTE_SAMPLE filas), Davies-Bouldin e inercia.
+    Elige el k de mayor silhouette (empates -> k menor). k_max se acota a
+    n_muestra - 1; si eso recorta el rango queda informado en "rango_recortado".
+    """
+    if k_min > k_max:
+        raise ValueError(f"k_min ({k_min}) > k_max ({k_max})")
+    X = np.asarray(X, dtype=float)
+    rng = np.random.default_rng(random_state)
+    S = X[rng.choice(len(X), size=KAUTO_SAMPLE, replace=False)] if len(X) > KAUTO_SAMPLE else X
+    hi = min(k_max, len(S) - 1)
+    ks = list(range(max(2, k_min), hi + 1))
+    info: Dict[str, Any] = {"criterio": "silhouette", "n_muestra": int(len(S)), "rango": [k_min, k_max]}
+    if hi < k_max:
+        info["rango_recortado"] = [ks[0], hi] if ks else None
+    if not ks:
+        info["detail"] = f"Con {len(S)} filas no hay k evaluable en [{k_min}, {k_max}]; se usa k=1."
+        return {"k": 1, **info, "curva": []}
+
+    def score(k: int) -> Dict[str, Any]:
+        km = KMeans(n_clusters=k, n_init=KAUTO_N_INIT, random_state=random_state).fit(S)
+        point = {"k": k, "silhouette": None, "davies_bouldin": None, "inertia": float(km.inertia_)}
+        if len(np.unique(km.labels_)) > 1:
+            point["silhouette"] = float(silhouette_score(
+                S, km.labels_, sample_size=min(len(S), KAUTO_SILHOUETTE_SAMPLE), random_state=random_state))
+            point["davies_bouldin"] = float(davies_bouldin_score(S, km.labels_))
+        return point
+
+    curve = Parallel(n_jobs=cpu_budget.n_jobs(KAUTO_N_JOBS), prefer="threads")(delayed(score)(k) for k in ks)
+    valid = [c for c in curve if c["silhouette"] is not None]
+    best = max(valid, key=lambda c: (round(c["silhouette"], 4), -c["k"]))["k"] if valid else ks[0]
+    return {"k": int(best), **info, "curva": curve}
+
+def resolve_k(k: Union[int, str], Xs, k_min: int, k_max: int, n_fit: Optional[int] = None,
+              random_state: int = RANDOM_STATE) -> Tuple[int, Optional[Dict[str, Any]]]:
+    """
+    k numérico o "auto" (select_k con `random_state`, compartido por datos vía shared_fit).
+    Devuelve (k, info_auto). k queda acotado a n_fit, las filas sobre las que se ajusta
+    el KMeans (por defecto todas).
+    """
+    n = len(Xs) if n_fit is None else min(n_fit, len(Xs))
+    if str(k).lower() != "auto":
+        return max(1, min(int(k), n)), None
+    info = shared_fit(("kauto", k_min, k_max, KAUTO_SAMPLE, KAUTO_N_INIT, random_state), Xs,
+                      lambda: select_k(Xs, k_min, k_max, random_state=random_state))
+    if info["k"] > n:
+        # info es compartido (shared_fit): se anota sobre una copia
+        info = {**info, "detail": f"k={info['k']} acotado a {n} (filas de entrenamiento)."}
+    return max(1, min(info["k"], n)), info
+
 def isolation_forest_flags(X):
     iso = IsolationForest(n_estimators=200, contamination="auto", random_state=RANDOM_STATE)
     return iso.fit_predict(X)  # -1 anomalía, 1 normal
@@ -142,3 +369,94 @@ def near_duplicate_pairs(names: pd.Series, sizes_mb: pd.Series, threshold: float
             if len(pairs) >= max_pairs:
                 return pairs
     return pairs
+
+# ----------------------------------------------------------------------
+# Clustering con texto (matriz dispersa por snapshot)
+# ----------------------------------------------------------------------
+TEXT_CLUSTER_BATCH = int(os.getenv("TEXT_CLUSTER_BATCH", "4096"))
+TEXT_MATRIX_CACHE_SIZE = int(os.getenv("TEXT_MATRIX_CACHE_SIZE", "4"))
+
+_text_matrices: "OrderedDict[Tuple, Any]" = OrderedDict()
+_text_matrices_lock = threading.Lock()
+
+def _cached_text(key: Tuple, build):
+    with _text_matrices_lock:
+        if key in _text_matrices:
+            _text_matrices.move_to_end(key)
+            return _text_matrices[key]
+    value = singleflight.features.do(key, build)
+    with _text_matrices_lock:
+        _text_matrices[key] = value
+        while len(_text_matrices) > TEXT_MATRIX_CACHE_SIZE:
+            _text_matrices.popitem(last=False)
+    return value
+
+def resident_text_matrices() -> Dict[str, List[Any]]:
+    """Matrices (CSR / proyecciones) del caché de texto, por clave (para /debug/memory)."""
+    with _text_matrices_lock:
+        items = list(_text_matrices.items())
+    return {f"{key[:-4]} {key[-4]}": [v for v in mat.values() if isinstance(v, np.ndarray) or sp.issparse(v)]
+            for key, mat in items}
+
+def text_cluster_matrix(df: pd.DataFrame, num_feats: List[str], max_features: int = 500,
+                        num_weight: float = 1.0, svd_components: int = 0,
+                        random_state: int = RANDOM_STATE) -> Dict[str, Any]:
+    """
+    Matriz de build_unsupervised_features del snapshot `df`, cacheada por su
+    huella: {"X" (CSR), "terms", "n_text", "data_key"}. Las columnas numéricas
+    se multiplican por num_weight (el TF-IDF tiene norma 1 por fila). Con
+    svd_components > 0 agrega "Z" = proyección TruncatedSVD, también cacheada;
+    el ajuste del SVD se comparte entre workers vía shared_fit.
+    "data_key" identifica la matriz sobre la que se agrupa (X o Z).
+    """
+    base_key = (df.attrs.get("fingerprint") or fingerprint(df[["descripcion"] + num_feats]),
+                tuple(num_feats), max_features, TEXT_BACKEND)
+
+    def build() -> Dict[str, Any]:
+        X, vec, _, _ = build_unsupervised_features(df, num_feats, max_features)
+        return {"X": X, "terms": feature_names(vec), "n_text": X.shape[1] - len(num_feats),
+                "data_key": fingerprint(base_key)}
+
+    mat = _cached_text(("text",) + base_key, build)
+    if num_weight != 1.0:
+        def weigh() -> Dict[str, Any]:
+            w = np.r_[np.ones(mat["n_text"]), np.full(len(num_feats), num_weight)]
+            return {**mat, "X": (mat["X"] @ sp.diags(w)).tocsr(), "data_key": fingerprint(mat["data_key"], num_weight)}
+        mat = _cached_text(("weighted", num_weight) + base_key, weigh)
+    if svd_components <= 0:
+        return mat
+    n_comp = max(1, min(svd_components, min(mat["X"].shape) - 1))
+
+    def project() -> Dict[str, Any]:
+        svd = shared_fit(("tsvd", n_comp, random_state), mat["data_key"],
+                         lambda: TruncatedSVD(n_components=n_comp, random_state=random_state).fit(mat["X"]))
+        return {**mat, "Z": chunked_apply(svd.transform, mat["X"]),
+                "svd_explained_variance": float(svd.explained_variance_ratio_.sum()),
+                "data_key": fingerprint(mat["data_key"], "tsvd", n_comp, random_state)}
+
+    return _cached_text(("svd", n_comp, random_state, num_weight) + base_key, project)
+
+def minibatch_kmeans(X, k: int, data_key: str, batch_size: int = TEXT_CLUSTER_BATCH,
+                     random_state: int = RANDOM_STATE) -> MiniBatchKMeans:
+    """MiniBatchKMeans (acepta CSR sin densificar), compartido por (k, datos) vía shared_fit."""
+    return shared_fit(("minibatch_kmeans", k, batch_size, random_state), data_key,
+                      lambda: MiniBatchKMeans(n_clusters=k, batch_size=batch_size, n_init=3,
+                                              random_state=random_state).fit(X))
+
+def cluster_means(M, labels: np.ndarray, k: int) -> np.ndarray:
+    """Media por cluster de las filas de M (densa o CSR) con un producto disperso indicador @ M: k x columnas."""
+    n = M.shape[0]
+    sizes = np.bincount(labels, minlength=k).astype(float)
+    member = sp.csr_matrix((1.0 / np.maximum(sizes[labels], 1.0), (labels, np.arange(n))), shape=(k, n))
+    out = member @ M
+    return out.toarray() if sp.issparse(out) else np.asarray(out)
+
+def cluster_top_terms(X_text, labels: np.ndarray, k: int, terms: Optional[np.ndarray],
+                      n_terms: int = 10) -> List[Optional[List[Dict[str, Any]]]]:
+    """Top términos por cluster según el TF-IDF medio de sus filas; None sin vocabulario (hashing)."""
+    if terms is None or X_text.shape[1] == 0:
+        return [None] * k
+    means = cluster_means(X_text, labels, k)  # k x términos (denso pero chico)
+    top = top_k_features(means, n_terms)
+    return [[{"term": str(terms[j]), "weight": round(float(means[c, j]), 6)} for j in top[c] if means[c, j] > 0]
+            for c in range(k)]
@@ -0,0 +1,251 @@
+# app/online_ols.py
+"""
+Mínimos cuadrados online para las regresiones lineales (dias_restantes,
+size_mb). Es el mismo modelo que SimpleImputer(median) -> StandardScaler ->
+LinearRegression, pero se resuelve a partir de estadísticas suficientes que
+se mantienen fila a fila entre snapshots.
+
+Por fila se guarda a = [o | m | y | 1]:
+- o: valores observados, desplazados por una constante por columna (media al
+  construir) para no perder precisión; 0 donde falta.
+- m: indicadora de faltante.
+G = AᵀA ((2d+2)²) es aditiva: agregar, quitar o cambiar una fila es sumar o
+restar aᵀa. Imputar con cualquier valor v es lineal (x = o + v·m). Por eso
+XᵀX, Xᵀy, medias y varianzas del imputado salen de G sin volver a las filas,
+y resolver cuesta O(d³).
+
+CV: cada fila cae en el fold hash(id) % splits, que es estable entre
+snapshots. Se guarda una G por fold y el entrenamiento del fold f usa
+G_total - G_f. Solo las métricas (R², MAE) recorren las filas de test.
+
+Las medianas del imputador no son aditivas. Se calculan sobre las filas
+(O(n) por columna) y solo para columnas con faltantes en el entrenamiento.
+
+Con cada snapshot nuevo se restan las filas borradas o cambiadas y se suman
+las nuevas o cambiadas (huella por fila). Se reconstruye cuando las filas
+tocadas desde la última construcción superan OLS_DELTA_MAX_FRAC, lo que
+también acota el error acumulado de sumar y restar.
+"""
+from typing import Any, Dict, List, Optional, Tuple
+import copy
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+from sklearn.metrics import mean_absolute_error, r2_score
+
+OLS_DELTA_MAX_FRAC = float(os.getenv("OLS_DELTA_MAX_FRAC", "0.25"))
+
+_EPS = np.finfo(np.float64).eps
+
+
+def row_keys(df: pd.DataFrame, id_col: str) -> np.ndarray:
+    """Clave estable por fila: hash de (id, ocurrencia del id), así ids repetidos o nulos no chocan."""
+    ids = df[id_col].reset_index(drop=True)
+    occ = ids.groupby(ids.to_numpy(), dropna=False, sort=False).cumcount()
+    return pd.util.hash_pandas_object(pd.DataFrame({"id": ids, "n": occ}), index=False).to_numpy()
+
+
+class OLSFit:
+    """Coeficientes en espacio estandarizado + lo necesario para predecir en el espacio original."""
+
+    def __init__(self, impute: np.ndarray, mean: np.ndarray, scale: np.ndarray, coef: np.ndarray,
+                 intercept: float):
+        self.impute, self.mean, self.scale = impute, mean, scale
+        self.coef, self.intercept = coef, intercept
+
+    def predict(self, X: np.ndarray) -> np.ndarray:
+        X = np.where(np.isnan(X), self.impute, X)
+        return ((X - self.mean) / self.scale) @ self.coef + self.intercept
+
+
+class OnlineOLS:
+    """Estadísticas suficientes (una G por fold) de un snapshot, actualizables por filas."""
+
+    def __init__(self, df: pd.DataFrame, feats: List[str], target: str, id_col: str, splits: int):
+        self.feats, self.target, self.id_col, self.splits = list(feats), target, id_col, splits
+        X, y = self._arrays(df)
+        self.shift = np.nan_to_num(np.nanmean(X, axis=0)) if len(X) else np.zeros(len(self.feats))
+        self.y_shift = float(y.mean()) if len(y) else 0.0
+        keys = row_keys(df, id_col)
+        self.O, self.M, self.y = self._encode(X, y)
+        self.fold = (keys % np.uint64(splits)).astype(np.int64)
+        self.alive = np.ones(len(keys), dtype=bool)
+        self.slot = dict(zip(keys.tolist(), range(len(keys))))
+        self.hashes = dict(zip(keys.tolist(), self._row_hashes(df).tolist()))
+        d = len(self.feats)
+        self.G = np.zeros((splits, 2 * d + 2, 2 * d + 2))
+        self._accumulate(np.arange(len(keys)), +1.0)
+        self.touched = 0
+        self.updates = 0
+        self.built_at = time.time()
+        self.last: Dict[str, Any] = {"modo": "completa", "filas_cambiadas": len(keys), "filas_borradas": 0}
+
+    # ------------------------------------------------------------------
+    # Filas
+    # ------------------------------------------------------------------
+    def _arrays(self, df: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+        return df[self.feats].to_numpy(dtype=np.float64), df[self.target].to_numpy(dtype=np.float64)
+
+    def _row_hashes(self, df: pd.DataFrame) -> np.ndarray:
+        return pd.util.hash_pandas_object(df[self.feats + [self.target]], index=False).to_numpy()
+
+    def _encode(self, X: np.ndarray, y: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        M = np.isnan(X)
+        return np.where(M, 0.0, X - self.shift), M, y - self.y_shift
+
+    def _accumulate(self, slots: np.ndarray, sign: float) -> None:
+        for f in np.unique(self.fold[slots]):
+            s = slots[self.fold[slots] == f]
+            A = np.hstack([self.O[s], self.M[s], self.y[s, None], np.ones((len(s), 1))])
+            self.G[f] += sign * (A.T @ A)
+
+    def __len__(self) -> int:
+        return int(self.alive.sum())
+
+    def clone(self) -> "OnlineOLS":
+        """Copia para actualizar sin afectar a quien use esta (O, M, y solo crecen por concatenación)."""
+        out = copy.copy(self)
+        out.G, out.alive = self.G.copy(), self.alive.copy()
+        out.slot, out.hashes = dict(self.slot), dict(self.hashes)
+        return out
+
+    def update(self, df: pd.DataFrame) -> bool:
+        """
+        Aplica un snapshot nuevo: resta filas borradas/cambiadas y suma nuevas/cambiadas.
+        Devuelve False si conviene reconstruir (demasiadas filas tocadas).
+        """
+        keys = row_keys(df, self.id_col)
+        new = dict(zip(keys.tolist(), self._row_hashes(df).tolist()))
+        changed = [k for k, h in new.items() if self.hashes.get(k) != h]
+        gone = [k for k in self.hashes if k not in new]
+        if self.touched + len(changed) + len(gone) > OLS_DELTA_MAX_FRAC * max(len(self), 1):
+            return False
+
+        old = np.array([self.slot.pop(k) for k in changed + gone if k in self.slot], dtype=np.int64)
+        if len(old):
+            self._accumulate(old, -1.0)
+            self.alive[old] = False
+        if changed:
+            pos = pd.Index(keys).get_indexer(np.array(changed, dtype=np.uint64))
+            X, y = self._arrays(df.iloc[pos])
+            O, M, yc = self._encode(X, y)
+            start = len(self.alive)
+            self.O, self.M, self.y = np.vstack([self.O, O]), np.vstack([self.M, M]), np.r_[self.y, yc]
+            self.fold = np.r_[self.fold, (keys[pos] % np.uint64(self.splits)).astype(np.int64)]
+            self.alive = np.r_[self.alive, np.ones(len(pos), dtype=bool)]
+            slots = np.arange(start, start + len(pos))
+            self.slot.update(zip(keys[pos].tolist(), slots.tolist()))
+            self._accumulate(slots, +1.0)
+        self.hashes = new
+        self.touched += len(changed) + len(gone)
+        self.updates += 1
+        self.last = {"modo": "incremental", "filas_cambiadas": len(changed), "filas_borradas": len(gone)}
+        return True
+
+    # ------------------------------------------------------------------
+    # Resolución
+    # ------------------------------------------------------------------
+    def fit(self, fold: Optional[int] = None) -> OLSFit:
+        """Modelo sobre todas las filas (fold=None) o sobre todas menos las del fold."""
+        G = self.G.sum(axis=0)
+        if fold is not None:
+            G = G - self.G[fold]
+        d = len(self.feats)
+
+        # Mediana de lo observado en el entrenamiento, solo donde hay faltantes
+        v = np.zeros(d)
+        empty = np.zeros(d, dtype=bool)
+        train = self.alive if fold is None else self.alive & (self.fold != fold)
+        for j in np.flatnonzero(G[d:2 * d, -1] > 0.5):
+            obs = self.O[train & ~self.M[:, j], j]
+            if len(obs):
+                v[j] = np.median(obs)
+            else:
+                empty[j] = True  # columna sin observados: el imputador la descarta, aquí coef 0
+
+        # Estadísticas del imputado: H = Tᵀ G T con x = o + v·m
+        T = np.zeros((2 * d + 2, d + 2))
+        T[np.arange(d), np.arange(d)] = 1.0
+        T[d + np.arange(d), np.arange(d)] = v
+        T[2 * d, d] = T[2 * d + 1, d + 1] = 1.0
+        H = T.T @ G @ T
+        n = H[-1, -1]
+        mu, ybar = H[:d, -1] / n, H[d, -1] / n
+        sq = np.diag(H)[:d] / n
+        var = np.maximum(sq - mu ** 2, 0.0)
+        # Constante (como _is_constant_feature de StandardScaler): varianza dentro del error de redondeo
+        const = empty | (var <= 100 * _EPS * sq)
+        scale = np.where(const, 1.0, np.sqrt(var))
+
+        cov = H[:d, :d] / n - np.outer(mu, mu)
+        cxy = H[:d, d] / n - mu * ybar
+        cov[const, :] = cov[:, const] = 0.0
+        cxy[const] = 0.0
+        # Mínima norma como lstsq de LinearRegression si hay colinealidad
+        coef = np.linalg.lstsq(cov / np.outer(scale, scale), cxy / scale, rcond=None)[0]
+        return OLSFit(v + self.shift, mu + self.shift, scale, coef, float(ybar + self.y_shift))
+
+    def test_rows(self, fold: int) -> Tuple[np.ndarray, np.ndarray]:
+        """X (con NaN donde falta) e y de las filas vivas del fold."""
+        s = np.flatnonzero(self.alive & (self.fold == fold))
+        X = np.where(self.M[s], np.nan, self.O[s] + self.shift)
+        return X, self.y[s] + self.y_shift
+
+    def cross_validate(self) -> Dict[str, List[float]]:
+        """R² y MAE por fold (NaN si el fold no alcanza para medir)."""
+        r2, mae = [], []
+        for f in range(self.splits):
+            X, y = self.test_rows(f)
+            if len(y) == 0 or len(y) == len(self):
+                r2.append(np.nan)
+                mae.append(np.nan)
+                continue
+            pred = self.fit(f).predict(X)
+            r2.append(float(r2_score(y, pred)) if len(y) >= 2 else np.nan)
+            mae.append(float(mean_absolute_error(y, pred)))
+        return {"r2": r2, "mae": mae}
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "filas": len(self),
+            "features": self.feats,
+            "splits": self.splits,
+            "actualizaciones": self.updates,
+            "filas_tocadas": self.touched,
+            "construido_hace_s": round(time.time() - self.built_at, 1),
+            "ultima": self.last,
+        }
+
+
+# ----------------------------------------------------------------------
+# Estado por endpoint
+# ----------------------------------------------------------------------
+_engines: Dict[Tuple[str, int], OnlineOLS] = {}
+_engines_lock = threading.Lock()
+
+
+def current(name: str, df: pd.DataFrame, feats: List[str], target: str, id_col: str, splits: int) -> OnlineOLS:
+    """Estadísticas al día con df: actualiza las del snapshot anterior o las reconstruye."""
+    key = (name, splits)
+    with _engines_lock:
+        eng = _engines.get(key)
+    # Quien esté resolviendo con la versión anterior la sigue usando mientras se actualiza la copia
+    if eng is not None and eng.feats == list(feats) and eng.target == target:
+        eng = eng.clone()
+        if not eng.update(df):
+            eng = None
+    else:
+        eng = None
+    if eng is None:
+        eng = OnlineOLS(df, feats, target, id_col, splits)
+    with _engines_lock:
+        _engines[key] = eng
+    return eng
+
+
+def stats() -> Dict[str, Any]:
+    with _engines_lock:
+        return {f"{name}:{splits}": eng.stats() for (name, splits), eng in _engines.items()}
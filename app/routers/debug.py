@@ -1,14 +1,22 @@
-from fastapi import APIRouter, Response
-from ..clients import fetch_plazos, PLAZOS_ENDPOINT, DOCS_ENDPOINT
-from ..features import flatten_plazos
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import APIRouter, Query
+from fastapi.responses import JSONResponse
+from ..clients import fetch_plazos, note_degraded, track_degraded, upstreams_state, PLAZOS_ENDPOINT, DOCS_ENDPOINT
+from ..features import flatten_plazos, memory_report, resident_matrices, warm_state
+from ..models import resident_text_matrices
+from .. import singleflight, artifacts, cpu_budget, online_ols, scored, similarity, snapshot
 import requests
+import scipy.sparse as sp
 
 router = APIRouter(prefix="/debug", tags=["debug"])
 
 
 @router.get("/plazos_dtypes")
+@track_degraded
 def plazos_dtypes():
-    df = flatten_plazos(fetch_plazos())
+    payload, errors = fetch_plazos()
+    note_degraded(errors)
+    df = flatten_plazos(payload, include_text=True)
     return {
         "columns": list(df.columns),
         "dtypes": {k: str(v) for k,v in df.dtypes.items()},
@@ -16,26 +24,111 @@ def plazos_dtypes():
     }
 
 
+def _nbytes(arr) -> int:
+    if sp.issparse(arr):
+        return int(arr.data.nbytes + arr.indices.nbytes + arr.indptr.nbytes)
+    return int(arr.nbytes)
+
+
+@router.get("/memory")
+def memory():
+    """
+    Bytes de lo que el proceso retiene: DataFrames del caché de scoring y de los
+    snapshots cargados (por columna) y matrices de features y de texto. No
+    consulta upstreams ni copia datos; lo compartido entre cachés se suma una vez.
+    """
+    counted = set()
+    total = 0
+    out = {}
+    for group, frames in (("scored", scored.resident_frames()), ("snapshot", snapshot.resident_frames())):
+        out[group] = {}
+        for name, df in frames.items():
+            out[group][name] = memory_report(df)
+            if id(df) not in counted:
+                counted.add(id(df))
+                total += out[group][name]["total_bytes"]
+    for group, entries in (("feature_matrices", resident_matrices()), ("text_matrices", resident_text_matrices())):
+        out[group] = {}
+        for name, arrays in entries.items():
+            out[group][name] = sum(_nbytes(a) for a in arrays)
+            fresh = [a for a in arrays if id(a) not in counted]
+            counted.update(id(a) for a in fresh)
+            total += sum(_nbytes(a) for a in fresh)
+    out["total_bytes"] = total
+    return out
+
+
 @router.get("/upstreams_status")
-def upstreams_status():
-    """Comprueba rápidamente conectividad a los endpoints configurados.
+def upstreams_status(
+    probe: bool = Query(True, description="Además del estado, hace un GET rápido a cada upstream"),
+):
+    """Estado de resiliencia de cada upstream y (opcional) prueba de conectividad.
 
-    Devuelve HTTP 200 si ambos upstreams responden con status < 400 en un timeout corto.
-    Devuelve HTTP 503 si alguno falla — útil como readinessProbe en Kubernetes.
+    Por upstream: estado del circuit breaker, latencias p50/p95, delay de hedge
+    y contadores (llamadas, errores, reintentos, hedges, cortocircuitos).
+    Devuelve HTTP 503 si algún probe falla o algún breaker está abierto —
+    útil como readinessProbe en Kubernetes.
     """
-    results = {}
-    overall_ok = True
-    for name, url in (("plazos", PLAZOS_ENDPOINT), ("docs", DOCS_ENDPOINT)):
+    def run_probe(url: str):
         try:
             r = requests.get(url, timeout=2)
-            ok = r.status_code < 400
-            results[name] = {"ok": ok, "status_code": r.status_code}
-            if not ok:
-                overall_ok = False
+            return {"ok": r.status_code < 400, "status_code": r.status_code}
         except Exception as e:
-            results[name] = {"ok": False, "error": str(e)}
-            overall_ok = False
+            return {"ok": False, "error": str(e)}
+
+    state = upstreams_state()
+    results = {name: {"breaker": s} for name, s in state.items()}
+    if probe:
+        # Ambos upstreams en paralelo: el probe tarda el máximo de los dos, no la suma
+        targets = (("plazos", PLAZOS_ENDPOINT), ("docs", DOCS_ENDPOINT))
+        with ThreadPoolExecutor(max_workers=len(targets)) as pool:
+            futures = {name: pool.submit(run_probe, url) for name, url in targets}
+            for name, fut in futures.items():
+                results[name].update(fut.result())
+    overall_ok = all(r.get("ok", True) and r["breaker"]["state"] != "open" for r in results.values())
 
     if overall_ok:
         return results
-    return Response(content=str(results), status_code=503, media_type="application/json")
+    return JSONResponse(content=results, status_code=503)
+
+
+@router.get("/singleflight")
+def singleflight_stats():
+    """Contadores de coalescing: cómputos ejecutados vs. compartidos por grupo."""
+    return singleflight.stats()
+
+
+@router.get("/artifacts")
+def artifacts_stats():
+    """Estado del almacén de artefactos compartido (ARTIFACTS_DIR)."""
+    return artifacts.stats()
+
+
+@router.get("/snapshots")
+def snapshots_stats():
+    """Snapshots last-good en disco (SNAPSHOT_DIR) y estado del warm start."""
+    return {**snapshot.stats(), "warm": warm_state()}
+
+
+@router.get("/similares")
+def similares_stats():
+    """Índice de plazos similares en memoria (tamaño, listas IVF, delta pendiente); null si aún no se construyó."""
+    return {"indice": similarity.stats()}
+
+
+@router.get("/scored")
+def scored_stats():
+    """Resultados scoreados en caché (endpoint, parámetros, filas, antigüedad) y aciertos por camino."""
+    return scored.stats()
+
+
+@router.get("/regresion")
+def regresion_stats():
+    """Estadísticas suficientes de las regresiones lineales (filas, actualizaciones incrementales, última)."""
+    return online_ols.stats()
+
+
+@router.get("/cpu")
+def cpu_stats():
+    """Presupuesto de hilos: límite del contenedor, fichas libres, concesiones/esperas y threadpools nativos."""
+    return cpu_budget.stats()
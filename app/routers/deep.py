@@ -1,11 +1,14 @@
 # app/routers/deep.py
 from fastapi import APIRouter, Query
-from typing import List, Dict, Any, Tuple
+from typing import List, Dict, Any, Optional, Tuple
 import numpy as np
 import pandas as pd
 
-from ..clients import fetch_plazos, fetch_docs
-from ..features import flatten_plazos, enrich_plazos_with_docs, flatten_docs
+from ..clients import track_degraded
+from ..features import FeatureMatrix, docs_matrix, plazos_matrix
+from ..singleflight import shared_fit
+from ..models import stratified_sample_idx, chunked_apply, top_k_features, format_reasons, MAX_TRAIN_ROWS
+from .. import jobs
 
 # Intentar PyTorch; si falla, usamos sklearn como fallback
 try:
@@ -16,8 +19,7 @@ try:
 except Exception:
     HAS_TORCH = False
 
-# Fallback (y también lo usamos para escalado si quieres)
-from sklearn.preprocessing import StandardScaler
+# Fallback
 from sklearn.neural_network import MLPRegressor
 
 router = APIRouter(prefix="/ml/deep", tags=["ml-deep"])
@@ -26,56 +28,31 @@ router = APIRouter(prefix="/ml/deep", tags=["ml-deep"])
 # -----------------------------
 # Utilidades comunes
 # -----------------------------
-def _prep_X_from_plazos() -> Tuple[pd.DataFrame, List[str], pd.DataFrame]:
-    """Carga plazos, enriquece con docs, devuelve df con columnas numericas limpias."""
-    payload = fetch_plazos()
-    df_plazos = flatten_plazos(payload)
-    if df_plazos.empty:
-        return pd.DataFrame(), [], df_plazos
-
-    df, num_feats = enrich_plazos_with_docs(df_plazos)
-    if df.empty:
-        return pd.DataFrame(), [], df_plazos
-
-    # Tomar solo features numéricas (ya vienen en num_feats); rellenar NaN con 0.0
-    X = df[num_feats].copy().astype(float).fillna(0.0)
-
-    # Filtrar columnas sin varianza para evitar inestabilidad
-    stds = X.std(ddof=0)
-    keep = stds[stds > 1e-8].index.tolist()
-    X = X[keep]
-    return X, keep, df
-
-
-def _prep_X_from_docs() -> Tuple[pd.DataFrame, List[str], pd.DataFrame]:
-    """Carga docs, crea features simples para DL."""
-    docs = fetch_docs()
-    df = flatten_docs(docs)
-    if df.empty:
-        return pd.DataFrame(), [], df
-
-    # Features sencillas para empezar
-    df["name_len"] = df["filename"].astype(str).str.len().astype(float)
-    df["is_pdf"] = (df["file_ext"].str.lower() == "pdf").astype(float)
-
-    num_feats = ["days_since_created", "name_len", "is_pdf"]
-    # Asegurar que existen
-    for c in num_feats:
-        if c not in df.columns:
-            df[c] = 0.0
+DEEP_DOCS_FEATS = ["days_since_created", "name_len", "is_pdf"]
+
+
+def _prep_X_from_plazos() -> Tuple[Optional[FeatureMatrix], pd.DataFrame]:
+    """Plazos enriquecidos y su matriz de features sin columnas de varianza ~0 (inestables)."""
+    df, fm = plazos_matrix()
+    return (fm.varying() if fm is not None else None), df
 
-    X = df[num_feats].copy().astype(float).fillna(0.0)
 
-    stds = X.std(ddof=0)
-    keep = stds[stds > 1e-8].index.tolist()
-    X = X[keep]
-    return X, keep, df
+def _prep_X_from_docs() -> Tuple[Optional[FeatureMatrix], pd.DataFrame]:
+    """Documentos y la matriz de features simples para DL (sin varianza ~0)."""
+    df, fm = docs_matrix()
+    return (fm.subset(DEEP_DOCS_FEATS).varying() if fm is not None else None), df
 
 
-def _scale_fit_transform(X: pd.DataFrame) -> Tuple[np.ndarray, StandardScaler]:
-    scaler = StandardScaler(with_mean=True, with_std=True)
-    Xs = scaler.fit_transform(X.values.astype(float))
-    return Xs, scaler
+def _reconstruction_reasons(out: Dict[str, Any], fm: FeatureMatrix, k: int):
+    """
+    Explicación de cada fila por error de reconstrucción por feature: top-k
+    columnas (argpartition sobre toda la matriz) con su error y su peso en el total.
+    """
+    E = out["feature_errors"]
+    share = E / np.maximum(E.sum(axis=1, keepdims=True), 1e-12)
+    top_idx = top_k_features(E, k)
+    columns = {"value": fm.X, "recon_error": E, "share": share}
+    return lambda idx: format_reasons(top_idx, idx, fm.columns, columns)
 
 
 # -----------------------------
@@ -107,12 +84,14 @@ if HAS_TORCH:
             return out
 
 
-def _train_ae_torch(Xs: np.ndarray, hidden: int, bottleneck: int, epochs: int, lr: float) -> Tuple[np.ndarray, float]:
+def _train_ae_torch(Xs: np.ndarray, hidden: int, bottleneck: int, epochs: int, lr: float,
+                    random_state: int = 42) -> Tuple[Dict[str, np.ndarray], float]:
     """
     Entrena un autoencoder en PyTorch (CPU). Devuelve:
-    - errores de reconstrucción por fila (MSE)
+    - pesos (state_dict como ndarrays, para poder guardarlos en artifacts)
     - loss final
     """
+    torch.manual_seed(random_state)
     device = torch.device("cpu")
     X_tensor = torch.tensor(Xs, dtype=torch.float32, device=device)
 
@@ -129,14 +108,21 @@ def _train_ae_torch(Xs: np.ndarray, hidden: int, bottleneck: int, epochs: int, l
         loss.backward()
         opt.step()
 
+    weights = {k: v.detach().cpu().numpy() for k, v in model.state_dict().items()}
+    return weights, float(loss.item())
+
+
+def _reconstruct_torch(weights: Dict[str, np.ndarray], Xs: np.ndarray, hidden: int, bottleneck: int) -> np.ndarray:
+    model = AE(d_in=Xs.shape[1], h=hidden, bottleneck=bottleneck)
+    # torch.tensor copia: los pesos pueden venir memory-mapped en solo lectura
+    model.load_state_dict({k: torch.tensor(np.asarray(v)) for k, v in weights.items()})
     model.eval()
     with torch.no_grad():
-        recon = model(X_tensor).cpu().numpy()
-    errs = ((Xs - recon) ** 2).mean(axis=1)
-    return errs, float(loss.item())
+        return model(torch.tensor(Xs, dtype=torch.float32)).numpy()
 
 
-def _train_ae_sklearn(Xs: np.ndarray, hidden: int, bottleneck: int, epochs: int, lr: float) -> Tuple[np.ndarray, float]:
+def _train_ae_sklearn(Xs: np.ndarray, hidden: int, bottleneck: int, epochs: int, lr: float,
+                      random_state: int = 42) -> Tuple[MLPRegressor, None]:
     """
     Fallback con sklearn: usamos MLPRegressor para "reconstruir" X->X
     Arquitectura simétrica [hidden, bottleneck, hidden] con activación ReLU.
@@ -149,30 +135,45 @@ def _train_ae_sklearn(Xs: np.ndarray, hidden: int, bottleneck: int, epochs: int,
         solver="adam",
         learning_rate_init=lr,
         max_iter=max(epochs, 50),
-        random_state=42,
+        random_state=random_state,
     )
     mlp.fit(Xs, Xs)
-    recon = mlp.predict(Xs)
-    errs = ((Xs - recon) ** 2).mean(axis=1)
-    # "loss final" aproximado
-    loss = float(errs.mean())
-    return errs, loss
+    return mlp, None
 
 
-def _run_autoencoder(X: pd.DataFrame, features: List[str], epochs: int, hidden: int, bottleneck: int, lr: float) -> Dict[str, Any]:
-    if X.empty or len(features) == 0:
+def _run_autoencoder(fm: Optional[FeatureMatrix], epochs: int, hidden: int, bottleneck: int, lr: float,
+                     strata=None, max_train: int = MAX_TRAIN_ROWS, random_state: int = 42) -> Dict[str, Any]:
+    if fm is None or len(fm) == 0 or len(fm.columns) == 0:
         return {"status": "sin_datos", "detail": "No hay features válidas (varianza ~0 o dataset vacío)."}
 
-    # Escalar
-    Xs, scaler = _scale_fit_transform(X)
+    # Ya escalada (compartida con clusters/anomalías del mismo snapshot)
+    Xs = fm.Xs
+
+    # n grande: entrenar con una submuestra estratificada; la reconstrucción de todo va por chunks
+    train_idx = stratified_sample_idx(len(Xs), max_train, strata, random_state)
+    X_train = Xs[train_idx]
+
+    # Entrenar una sola vez por (backend, hiperparámetros, datos); los pesos quedan en artifacts
+    if HAS_TORCH:
+        train, backend = _train_ae_torch, "torch"
+    else:
+        train, backend = _train_ae_sklearn, "sklearn-fallback"
+    fitted, loss = shared_fit(("autoencoder", backend, hidden, bottleneck, epochs, lr, random_state), X_train,
+                              lambda: train(X_train, hidden=hidden, bottleneck=bottleneck, epochs=epochs, lr=lr,
+                                            random_state=random_state))
 
-    # Entrenar
     if HAS_TORCH:
-        errs, loss = _train_ae_torch(Xs, hidden=hidden, bottleneck=bottleneck, epochs=epochs, lr=lr)
-        backend = "torch"
+        def reconstruct(chunk: np.ndarray) -> np.ndarray:
+            return _reconstruct_torch(fitted, chunk, hidden=hidden, bottleneck=bottleneck)
     else:
-        errs, loss = _train_ae_sklearn(Xs, hidden=hidden, bottleneck=bottleneck, epochs=epochs, lr=lr)
-        backend = "sklearn-fallback"
+        reconstruct = fitted.predict
+    # Error de reconstrucción por feature (n x d): su media por fila es el score y
+    # por columna explica qué features reconstruye peor el autoencoder
+    feature_errors = chunked_apply(lambda chunk: (chunk - reconstruct(chunk)) ** 2, Xs)
+    errs = feature_errors.mean(axis=1)
+    if loss is None:
+        # "loss final" aproximado (sobre las filas de entrenamiento)
+        loss = float(errs[train_idx].mean())
 
     # Normalizar scores a [0,1] para presentación
     e_min, e_max = float(errs.min()), float(errs.max())
@@ -181,14 +182,17 @@ def _run_autoencoder(X: pd.DataFrame, features: List[str], epochs: int, hidden:
 
     return {
         "backend": backend,
-        "n_samples": int(X.shape[0]),
-        "n_features": int(X.shape[1]),
-        "features": features,
+        "n_samples": int(fm.X.shape[0]),
+        "n_train": int(len(train_idx)),
+        "random_state": random_state,
+        "n_features": int(fm.X.shape[1]),
+        "features": fm.columns,
         "train_loss": loss,
         "errors_raw_mean": float(errs.mean()),
         "scores_min": float(scores.min()),
         "scores_max": float(scores.max()),
         "scores": scores.tolist(),  # (orden corresponde a X.index)
+        "feature_errors": feature_errors,
     }
 
 
@@ -197,24 +201,37 @@ def _run_autoencoder(X: pd.DataFrame, features: List[str], epochs: int, hidden:
 # -----------------------------
 
 @router.get("/plazos/autoencoder")
+@track_degraded
 def deep_plazos_autoencoder(
     epochs: int = Query(120, ge=20, le=2000, description="Épocas de entrenamiento"),
     hidden: int = Query(8, ge=2, le=128, description="Neuronas capa oculta"),
     bottleneck: int = Query(3, ge=1, le=64, description="Dimensión del embebido"),
     lr: float = Query(1e-2, gt=0, le=1e-1, description="Learning rate"),
     top: int = Query(20, ge=1, description="Cuántos casos devolver ordenados por score"),
+    explain: bool = Query(False, description="Agrega por fila las features con mayor error de reconstrucción"),
+    k_reasons: int = Query(3, ge=1, le=10, description="Cantidad de features a devolver cuando explain=true"),
+    max_train: int = Query(MAX_TRAIN_ROWS, ge=100, description="Máximo de filas para entrenar (submuestreo estratificado); se scorea todo el dataset"),
+    random_state: int = Query(42, description="Semilla del submuestreo y del modelo (reproducibilidad)"),
+    async_: bool = Query(False, alias="async", description="Encola el cálculo como job (ver /ml/jobs) y devuelve su handle"),
 ) -> Dict[str, Any]:
     """
     Autoencoder de plazos (features numéricas de enrich_plazos_with_docs).
     Devuelve los casos con **mayor score** (peor reconstrucción) como posibles **anomalías**.
     """
-    X, feats, df = _prep_X_from_plazos()
-    out = _run_autoencoder(X, feats, epochs=epochs, hidden=hidden, bottleneck=bottleneck, lr=lr)
+    if async_:
+        return jobs.submit_response("deep_plazos_autoencoder", {"epochs": epochs, "hidden": hidden, "bottleneck": bottleneck, "lr": lr, "top": top,
+                                                                "explain": explain, "k_reasons": k_reasons, "max_train": max_train, "random_state": random_state})
+
+    fm, df = _prep_X_from_plazos()
+    strata = df["estado_abierto"].to_numpy() if "estado_abierto" in df.columns else None
+    out = _run_autoencoder(fm, epochs=epochs, hidden=hidden, bottleneck=bottleneck, lr=lr,
+                           strata=strata, max_train=max_train, random_state=random_state)
     if out.get("status") == "sin_datos":
         return out
 
     # Armar salida ordenada por score desc
     scores = np.array(out["scores"])
+    reasons = _reconstruction_reasons(out, fm, k_reasons) if explain else None
     order = np.argsort(-scores)
     order = order[: min(top, len(order))]
 
@@ -230,36 +247,51 @@ def deep_plazos_autoencoder(
             "expediente_id": int(df.iloc[idx]["expediente_id"]) if ("expediente_id" in df.columns and pd.notna(df.iloc[idx]["expediente_id"])) else None,
             "descripcion": df.iloc[idx].get("descripcion"),
             "deep_anomaly_score": float(scores[idx]),
-            "features": {f: float(X.iloc[idx][f]) for f in feats},
+            "features": fm.row(idx),
         }
+        if explain:
+            r["reasons"] = reasons(idx)
         rows.append(r)
 
     return {
         "status": "ok",
         "task": "plazos_autoencoder",
-        **{k: v for k, v in out.items() if k not in ["scores"]},
+        **{k: v for k, v in out.items() if k not in ["scores", "feature_errors"]},
         "top": rows,
     }
 
 
 @router.get("/docs/autoencoder")
+@track_degraded
 def deep_docs_autoencoder(
     epochs: int = Query(120, ge=20, le=2000),
     hidden: int = Query(8, ge=2, le=128),
     bottleneck: int = Query(2, ge=1, le=64),
     lr: float = Query(1e-2, gt=0, le=1e-1),
     top: int = Query(20, ge=1),
+    explain: bool = Query(False, description="Agrega por fila las features con mayor error de reconstrucción"),
+    k_reasons: int = Query(3, ge=1, le=10, description="Cantidad de features a devolver cuando explain=true"),
+    max_train: int = Query(MAX_TRAIN_ROWS, ge=100, description="Máximo de filas para entrenar (submuestreo estratificado); se scorea todo el dataset"),
+    random_state: int = Query(42, description="Semilla del submuestreo y del modelo (reproducibilidad)"),
+    async_: bool = Query(False, alias="async", description="Encola el cálculo como job (ver /ml/jobs) y devuelve su handle"),
 ) -> Dict[str, Any]:
     """
     Autoencoder de documentos (features simples: days_since_created, name_len, is_pdf).
     Señala documentos “raros” por su vector de features.
     """
-    X, feats, df = _prep_X_from_docs()
-    out = _run_autoencoder(X, feats, epochs=epochs, hidden=hidden, bottleneck=bottleneck, lr=lr)
+    if async_:
+        return jobs.submit_response("deep_docs_autoencoder", {"epochs": epochs, "hidden": hidden, "bottleneck": bottleneck, "lr": lr, "top": top,
+                                                              "explain": explain, "k_reasons": k_reasons, "max_train": max_train, "random_state": random_state})
+
+    fm, df = _prep_X_from_docs()
+    strata = df["file_ext"].to_numpy() if "file_ext" in df.columns else None
+    out = _run_autoencoder(fm, epochs=epochs, hidden=hidden, bottleneck=bottleneck, lr=lr,
+                           strata=strata, max_train=max_train, random_state=random_state)
     if out.get("status") == "sin_datos":
         return out
 
     scores = np.array(out["scores"])
+    reasons = _reconstruction_reasons(out, fm, k_reasons) if explain else None
     order = np.argsort(-scores)
     order = order[: min(top, len(order))]
 
@@ -277,13 +309,15 @@ def deep_docs_autoencoder(
             "id_expediente": int(df.iloc[idx]["id_expediente"]) if pd.notna(df.iloc[idx]["id_expediente"]) else None,
             "id_cliente": int(df.iloc[idx]["id_cliente"]) if pd.notna(df.iloc[idx]["id_cliente"]) else None,
             "deep_anomaly_score": float(scores[idx]),
-            "features": {f: float(X.iloc[idx][f]) for f in feats},
+            "features": fm.row(idx),
         }
+        if explain:
+            r["reasons"] = reasons(idx)
         rows.append(r)
 
     return {
         "status": "ok",
         "task": "docs_autoencoder",
-        **{k: v for k, v in out.items() if k not in ["scores"]},
+        **{k: v for k, v in out.items() if k not in ["scores", "feature_errors"]},
         "top": rows,
     }
@@ -1,87 +1,62 @@
 # app/routers/docs_analytics.py
-from fastapi import APIRouter, Query
-from typing import List, Dict, Any, Tuple
+from fastapi import APIRouter, HTTPException, Query
+from typing import List, Dict, Any, Optional, Tuple
 import itertools
 import difflib
 import numpy as np
 import pandas as pd
-from sklearn.preprocessing import StandardScaler
 from sklearn.cluster import KMeans
 from sklearn.ensemble import IsolationForest
 
-from ..clients import fetch_docs
-from ..features import flatten_docs
+from ..clients import track_degraded
+from ..features import docs_matrix, docs_with_features
+from ..scored import DOCS_FILTER_COLUMNS, ScoredFrame, anomaly_top, data_version, parse_filtros, scored
+from ..singleflight import shared_fit
+from ..models import resolve_k, stratified_sample_idx, chunked_apply, MAX_TRAIN_ROWS
+from .. import cpu_budget, jobs
 
 router = APIRouter(prefix="/docs", tags=["docs-analytics"])
 
 
-# ============== Helpers de explicabilidad (z-score) ==============
-def _fit_mu_sigma(X: pd.DataFrame) -> Tuple[pd.Series, pd.Series]:
-    mu = X.mean()
-    sigma = X.std().replace(0, 1e-9)  # evita división por 0
-    return mu, sigma
-
-def _top_k_reasons(x_row: pd.Series, mu: pd.Series, sigma: pd.Series, feats: List[str], k: int = 3):
-    z = (x_row[feats] - mu[feats]) / sigma[feats]
-    absz = z.abs().sort_values(ascending=False)
-    top = []
-    for f in absz.index[:k]:
-        top.append({"feature": f, "value": float(x_row[f]), "zscore": float(z[f])})
-    return top
-
-
-# ============== Prepara features numéricas de documentos ==============
-def _docs_with_features() -> Tuple[pd.DataFrame, List[str]]:
-    docs = fetch_docs()                 # -> lista de dicts
-    df = flatten_docs(docs)             # -> doc_id, filename, file_ext, size_mb, days_since_created, ...
-
-    if df.empty:
-        return df, []
-
-    # Derivadas robustas
-    df["name_len"] = df["filename"].astype(str).str.len().fillna(0).astype(float)
-    df["is_pdf"] = (df["file_ext"].astype(str).str.lower() == "pdf").astype(int)
-    # Asegurar numéricas clave que ya vienen de flatten_docs
-    for c in ["size_mb", "days_since_created"]:
-        if c not in df.columns:
-            df[c] = 0.0
-
-    # Set de features numéricas para clustering/anomalías
-    num_feats = ["size_mb", "days_since_created", "name_len", "is_pdf"]
-    df[num_feats] = df[num_feats].astype(float).fillna(0.0)
-
-    # Normaliza metadatos básicos (solo para el output)
-    base_cols = ["doc_id", "filename", "file_ext", "id_expediente", "id_cliente"]
-    for c in base_cols:
-        if c not in df.columns:
-            df[c] = None
-
-    return df, num_feats
-
-
 # =======================
 # 1) K-MEANS (DOCUMENTOS)
 # =======================
 @router.get("/no_supervisado/clusters")
-def docs_clusters(k: int = Query(3, ge=1, description="Número de clusters")) -> Dict[str, Any]:
-    df, feats = _docs_with_features()
+@track_degraded
+def docs_clusters(
+    k: str = Query("3", pattern=r"^(auto|[1-9][0-9]*)$", description="Número de clusters o 'auto' (barrido k_min..k_max)"),
+    k_min: int = Query(2, ge=2, le=50, description="k=auto: menor k a evaluar"),
+    k_max: int = Query(10, ge=2, le=50, description="k=auto: mayor k a evaluar"),
+    max_train: int = Query(MAX_TRAIN_ROWS, ge=100, description="Máximo de filas para entrenar (submuestreo estratificado); se scorea todo el dataset"),
+    random_state: int = Query(42, description="Semilla del submuestreo y del modelo (reproducibilidad)"),
+    async_: bool = Query(False, alias="async", description="Encola el cálculo como job (ver /ml/jobs) y devuelve su handle"),
+) -> Dict[str, Any]:
+    if k_min > k_max:
+        raise HTTPException(status_code=422, detail=f"k_min ({k_min}) no puede ser mayor que k_max ({k_max}).")
+    if async_:
+        return jobs.submit_response("docs_clusters", {"k": k, "k_min": k_min, "k_max": k_max,
+                                                      "max_train": max_train, "random_state": random_state})
+
+    df, fm = docs_matrix()
     if df.empty:
         return {"status": "sin_datos", "detail": "No hay documentos en el endpoint origen."}
 
-    X = df[feats].astype(float).fillna(0.0)
-    n = len(X)
+    feats = fm.columns
+    n = len(fm)
     if n == 0:
         return {"status": "sin_datos", "detail": "No hay filas con features numéricas."}
 
-    k = max(1, min(k, n))
-
-    scaler = StandardScaler(with_mean=True, with_std=True)
-    Xs = scaler.fit_transform(X.values)
-
-    km = KMeans(n_clusters=k, n_init=10, random_state=42)
-    labels = km.fit_predict(Xs)
-
-    centers_original = scaler.inverse_transform(km.cluster_centers_)
+    Xs = fm.Xs
+    # n grande: fit sobre submuestra estratificada, asignación de todas las filas por chunks
+    train_idx = stratified_sample_idx(n, max_train, df["file_ext"].to_numpy() if "file_ext" in df.columns else None, random_state)
+    X_train = Xs[train_idx]
+    # KMeans se ajusta sobre X_train: k no puede superar sus filas
+    k, k_auto = resolve_k(k, Xs, k_min, k_max, n_fit=len(train_idx), random_state=random_state)
+    km = shared_fit(("kmeans", k, 10, random_state), X_train,
+                    lambda: KMeans(n_clusters=k, n_init=10, random_state=random_state).fit(X_train))
+    labels = chunked_apply(km.predict, Xs)
+
+    centers_original = km.cluster_centers_ * fm.scale + fm.mean
     centers_df = pd.DataFrame(centers_original, columns=feats)
 
     sizes = pd.Series(labels).value_counts().sort_index()
@@ -102,7 +77,7 @@ def docs_clusters(k: int = Query(3, ge=1, description="Número de clusters")) ->
 
     out_rows: List[Dict[str, Any]] = []
     for idx, row in df.reset_index(drop=True).iterrows():
-        feat_dict = {f: float(X.iloc[idx][f]) for f in feats}
+        feat_dict = fm.row(idx)
         out_rows.append({
             "doc_id": row["doc_id"],
             "filename": row["filename"],
@@ -116,7 +91,10 @@ def docs_clusters(k: int = Query(3, ge=1, description="Número de clusters")) ->
     return {
         "status": "ok",
         "k": k,
+        "k_auto": k_auto,
         "n_samples": n,
+        "n_train": int(len(train_idx)),
+        "random_state": random_state,
         "features": feats,
         "clusters": clusters_summary,
         "assignments": out_rows
@@ -127,69 +105,88 @@ def docs_clusters(k: int = Query(3, ge=1, description="Número de clusters")) ->
 # 2) ISOLATION FOREST (DOCS)
 # ===========================
 @router.get("/no_supervisado/anomalias")
+@track_degraded
 def docs_anomalias(
     contaminacion: float = Query(0.15, gt=0.0, lt=0.5, description="Proporción esperada de anomalías (0-0.5)"),
     max_lista: int = Query(50, ge=1, description="Máximo de filas a devolver"),
     explain: bool = Query(False, description="Devuelve top-3 razones (z-scores) por fila"),
     k_reasons: int = Query(3, ge=1, le=10, description="Cantidad de razones si explain=true"),
+    max_train: int = Query(MAX_TRAIN_ROWS, ge=100, description="Máximo de filas para entrenar (submuestreo estratificado); se scorea todo el dataset"),
+    random_state: int = Query(42, description="Semilla del submuestreo y del modelo (reproducibilidad)"),
+    expediente_id: Optional[int] = Query(None, description="Solo documentos de este expediente"),
+    id_cliente: Optional[int] = Query(None, description="Solo documentos de este cliente"),
+    async_: bool = Query(False, alias="async", description="Encola el cálculo como job (ver /ml/jobs) y devuelve su handle"),
 ) -> Dict[str, Any]:
-    df, feats = _docs_with_features()
-    if df.empty:
-        return {"status": "sin_datos", "detail": "No hay documentos en el endpoint origen."}
-
-    X = df[feats].astype(float).fillna(0.0)
-    n = len(X)
-    if n < 2:
-        return {"status": "insuficiente", "detail": "Se requieren al menos 2 filas para detectar anomalías.", "n_samples": n}
-
-    scaler = StandardScaler(with_mean=True, with_std=True)
-    Xs = scaler.fit_transform(X.values)
-
-    iso = IsolationForest(
-        n_estimators=200,
-        max_samples="auto",
-        contamination=contaminacion,
-        random_state=42,
-        n_jobs=-1,
-    )
-    labels = iso.fit_predict(Xs)    # -1 anómalo, 1 normal
-    scores = iso.score_samples(Xs)  # más alto => más normal
-
-    raw = -scores
-    rmin, rmax = float(raw.min()), float(raw.max())
-    denom = (rmax - rmin) if (rmax > rmin) else 1e-9
-    norm = (raw - rmin) / denom
-
-    mu, sigma = _fit_mu_sigma(X) if explain else (None, None)
-
-    rows: List[Dict[str, Any]] = []
-    for idx, row in df.reset_index(drop=True).iterrows():
-        feat_dict = {f: float(X.iloc[idx][f]) for f in feats}
-        base = {
-            "doc_id": row["doc_id"],
-            "filename": row["filename"],
-            "file_ext": row["file_ext"],
-            "id_expediente": int(row["id_expediente"]) if pd.notna(row["id_expediente"]) else None,
-            "id_cliente": int(row["id_cliente"]) if pd.notna(row["id_cliente"]) else None,
-            "es_anomalo": bool(labels[idx] == -1),
-            "anomaly_score": float(norm[idx]),
-            "iforest_raw": float(raw[idx]),
-            "features": feat_dict,
-        }
-        if explain:
-            base["reasons"] = _top_k_reasons(X.iloc[idx], mu, sigma, feats, k=k_reasons)
-        rows.append(base)
-
-    rows_sorted = sorted(rows, key=lambda r: r["anomaly_score"], reverse=True)[:max_lista]
-
-    total_anomalos = int(sum(1 for r in rows if r["es_anomalo"]))
+    if async_:
+        return jobs.submit_response("docs_anomalias", {"contaminacion": contaminacion, "max_lista": max_lista, "explain": explain, "k_reasons": k_reasons,
+                                                       "max_train": max_train, "random_state": random_state,
+                                                       "expediente_id": expediente_id, "id_cliente": id_cliente})
+    filtros = parse_filtros(expediente_id, id_cliente)
+
+    def load():
+        df, fm = docs_matrix()
+        return (df, fm), data_version(df)
+
+    def score(data):
+        df, fm = data
+        if df.empty:
+            return ScoredFrame(df, {"response": {"status": "sin_datos", "detail": "No hay documentos en el endpoint origen."}},
+                               DOCS_FILTER_COLUMNS)
+
+        n = len(fm)
+        if n < 2:
+            return ScoredFrame(df, {"response": {"status": "insuficiente", "detail": "Se requieren al menos 2 filas para detectar anomalías.", "n_samples": n}},
+                               DOCS_FILTER_COLUMNS)
+
+        Xs = fm.Xs
+
+        train_idx = stratified_sample_idx(n, max_train, df["file_ext"].to_numpy() if "file_ext" in df.columns else None, random_state)
+        X_train = Xs[train_idx]
+
+        def _fit_iforest():
+            iso = IsolationForest(
+                n_estimators=200,
+                max_samples="auto",
+                contamination=contaminacion,
+                random_state=random_state,
+                n_jobs=cpu_budget.n_jobs(),
+            )
+            return iso.fit(X_train)
+
+        iso = shared_fit(("iforest", contaminacion, 200, random_state), X_train, _fit_iforest)
+        scores = chunked_apply(iso.score_samples, Xs)    # más alto => más normal
+        labels = np.where(scores - iso.offset_ < 0, -1, 1)  # == iso.predict(Xs): -1 anómalo, 1 normal
+
+        raw = -scores
+        rmin, rmax = float(raw.min()), float(raw.max())
+        denom = (rmax - rmin) if (rmax > rmin) else 1e-9
+        norm = (raw - rmin) / denom
+        return ScoredFrame(df, {
+            "response": {
+                "status": "ok",
+                "n_samples": n,
+                "n_train": int(len(train_idx)),
+                "random_state": random_state,
+                "contaminacion": contaminacion,
+                "num_anomalos": int((labels == -1).sum()),
+                "features": fm.columns,
+            },
+            "fm": fm, "labels": labels, "raw": raw, "norm": norm,
+        }, DOCS_FILTER_COLUMNS)
+
+    sf = scored("docs_anomalias", (contaminacion, max_train, random_state), load, score)
+    if "norm" not in sf.meta:
+        return dict(sf.meta["response"])
+    return {**sf.meta["response"], **anomaly_top(sf, filtros, max_lista, explain, k_reasons, _doc_base)}
+
+
+def _doc_base(row: pd.Series) -> Dict[str, Any]:
     return {
-        "status": "ok",
-        "n_samples": n,
-        "contaminacion": contaminacion,
-        "num_anomalos": total_anomalos,
-        "features": feats,
-        "top": rows_sorted
+        "doc_id": row["doc_id"],
+        "filename": row["filename"],
+        "file_ext": row["file_ext"],
+        "id_expediente": int(row["id_expediente"]) if pd.notna(row["id_expediente"]) else None,
+        "id_cliente": int(row["id_cliente"]) if pd.notna(row["id_cliente"]) else None,
     }
 
 
@@ -197,11 +194,13 @@ def docs_anomalias(
 # 3) Near-duplicados por nombre + tamaño
 # =======================================
 @router.get("/near_duplicados")
+@track_degraded
 def docs_near_duplicados(
     threshold: float = Query(0.85, ge=0.0, le=1.0, description="Umbral de similitud combinada (0-1)"),
     max_pairs: int = Query(50, ge=1, description="Máximo de pares a devolver"),
     w_name: float = Query(0.7, ge=0.0, le=1.0, description="Peso similitud de nombre"),
     w_size: float = Query(0.3, ge=0.0, le=1.0, description="Peso similitud de tamaño"),
+    async_: bool = Query(False, alias="async", description="Encola el cálculo como job (ver /ml/jobs) y devuelve su handle"),
 ) -> Dict[str, Any]:
     """
     Calcula pares de documentos potencialmente duplicados combinando:
@@ -209,12 +208,15 @@ def docs_near_duplicados(
     - Similitud de tamaño: 1 - |a-b| / max(a,b)
     score = w_name * name_sim + w_size * size_sim
     """
+    if async_:
+        return jobs.submit_response("docs_near_duplicados", {"threshold": threshold, "max_pairs": max_pairs, "w_name": w_name, "w_size": w_size})
+
     if not np.isclose(w_name + w_size, 1.0):
         # normaliza si no suma 1
         total = max(w_name + w_size, 1e-9)
         w_name, w_size = w_name / total, w_size / total
 
-    df, feats = _docs_with_features()
+    df, feats = docs_with_features()
     if df.empty or len(df) < 2:
         return {"status": "sin_datos", "detail": "No hay suficientes documentos."}
 
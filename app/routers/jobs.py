@@ -0,0 +1,44 @@
+# app/routers/jobs.py
+from fastapi import APIRouter, HTTPException, Request
+from typing import Dict, Any
+import json
+
+from .. import jobs
+
+router = APIRouter(prefix="/ml/jobs", tags=["ml-jobs"])
+
+
+@router.get("")
+def jobs_index() -> Dict[str, Any]:
+    """Tasks disponibles y estado del pool de procesos."""
+    return {"tasks": sorted(jobs.TASKS), **jobs.stats()}
+
+
+@router.post("/{task}", status_code=202)
+async def submit_job(task: str, request: Request):
+    """
+    Encola un cómputo pesado en el pool de procesos y devuelve el handle (202).
+    Parámetros: query string (p. ej. `?k=4`) y/o body JSON; mismos que el GET
+    equivalente. Jobs con la misma clave (task+params) se reutilizan.
+    """
+    if task not in jobs.TASKS:
+        raise HTTPException(status_code=404, detail=f"Task desconocida: {task}. Disponibles: {sorted(jobs.TASKS)}")
+    params: Dict[str, Any] = dict(request.query_params)
+    if await request.body():
+        try:
+            body = await request.json()
+        except (json.JSONDecodeError, UnicodeDecodeError) as exc:
+            raise HTTPException(status_code=400, detail=f"Body JSON inválido: {exc}")
+        if not isinstance(body, dict):
+            raise HTTPException(status_code=422, detail="El body debe ser un objeto JSON con parámetros.")
+        params.update(body)
+    return jobs.submit_response(task, params)
+
+
+@router.get("/{job_id}")
+def get_job(job_id: str) -> Dict[str, Any]:
+    """Estado del job; incluye `result` cuando status=terminado (o `error`)."""
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job no encontrado (o expirado).")
+    return job.to_dict()
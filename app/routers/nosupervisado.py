@@ -1,79 +1,72 @@
 # app/routers/no_supervisado.py
-from fastapi import APIRouter, Query
-from typing import List, Dict, Any, Tuple
+from fastapi import APIRouter, HTTPException, Query
+from fastapi.responses import JSONResponse
+from typing import List, Dict, Any, Optional, Tuple
+import math
 import numpy as np
 import pandas as pd
-from sklearn.preprocessing import StandardScaler
 from sklearn.cluster import KMeans
 from sklearn.ensemble import IsolationForest
 
-from ..clients import fetch_plazos
-from ..features import flatten_plazos, enrich_plazos_with_docs
+from ..clients import track_degraded
+from ..features import plazos_matrix
+from ..scored import ScoredFrame, anomaly_top, data_version, parse_filtros, scored
+from ..singleflight import shared_fit
+from ..models import (
+    resolve_k, stratified_sample_idx, chunked_apply, MAX_TRAIN_ROWS,
+    text_cluster_matrix, minibatch_kmeans, cluster_means, cluster_top_terms, TEXT_CLUSTER_BATCH,
+)
+from .. import cpu_budget, jobs
 
 router = APIRouter(prefix="/ml/no_supervisado", tags=["ml-no-supervisado"])
 
-
-# =========================
-# Helpers de "explicaciones"
-# =========================
-def _fit_mu_sigma(X: pd.DataFrame) -> Tuple[pd.Series, pd.Series]:
-    """
-    Promedio y desviación estándar por feature para z-score.
-    Reemplaza desviación 0 por un epsilon para evitar divisiones por cero.
-    """
-    mu = X.mean()
-    sigma = X.std().replace(0, 1e-9)
-    return mu, sigma
-
-
-def _top_k_reasons(
-    x_row: pd.Series, mu: pd.Series, sigma: pd.Series, feats: List[str], k: int = 3
-) -> List[Dict[str, Any]]:
-    """
-    Devuelve las k features con mayor |z-score| para una fila (explicación simple).
-    z = (x - mu) / sigma
-    """
-    z = (x_row[feats] - mu[feats]) / sigma[feats]
-    absz = z.abs().sort_values(ascending=False)
-    top = []
-    for f in absz.index[: k]:
-        top.append({"feature": f, "value": float(x_row[f]), "zscore": float(z[f])})
-    return top
+_DATE = r"^[0-9]{4}-[0-9]{2}-[0-9]{2}$"
 
 
 # =====================
 # K-MEANS CLUSTERS
 # =====================
 @router.get("/clusters")
-def clusters(k: int = Query(3, ge=1, description="Número de clusters")) -> Dict[str, Any]:
-    payload = fetch_plazos()
-    df_plazos = flatten_plazos(payload)
-    if df_plazos.empty:
-        return {"status": "sin_datos", "detail": "No hay plazos en el endpoint origen."}
+@track_degraded
+def clusters(
+    k: str = Query("3", pattern=r"^(auto|[1-9][0-9]*)$", description="Número de clusters o 'auto' (barrido k_min..k_max)"),
+    k_min: int = Query(2, ge=2, le=50, description="k=auto: menor k a evaluar"),
+    k_max: int = Query(10, ge=2, le=50, description="k=auto: mayor k a evaluar"),
+    max_train: int = Query(MAX_TRAIN_ROWS, ge=100, description="Máximo de filas para entrenar (submuestreo estratificado); se scorea todo el dataset"),
+    random_state: int = Query(42, description="Semilla del submuestreo y del modelo (reproducibilidad)"),
+    async_: bool = Query(False, alias="async", description="Encola el cálculo como job (ver /ml/jobs) y devuelve su handle"),
+) -> Dict[str, Any]:
+    if k_min > k_max:
+        raise HTTPException(status_code=422, detail=f"k_min ({k_min}) no puede ser mayor que k_max ({k_max}).")
+    if async_:
+        return jobs.submit_response("clusters", {"k": k, "k_min": k_min, "k_max": k_max,
+                                                 "max_train": max_train, "random_state": random_state})
 
-    df, num_feats = enrich_plazos_with_docs(df_plazos)
+    df, fm = plazos_matrix()
     if df.empty:
-        return {"status": "sin_datos", "detail": "Sin filas tras enriquecimiento."}
+        return {"status": "sin_datos", "detail": "No hay plazos en el endpoint origen."}
 
     base_cols = ["id_plazo", "expediente_id", "descripcion"]
     for c in base_cols:
         if c not in df.columns:
             df[c] = None
 
-    X = df[num_feats].copy().astype(float).fillna(0.0)
-    n = len(X)
+    num_feats = fm.columns
+    n = len(fm)
     if n == 0:
         return {"status": "sin_datos", "detail": "No hay filas con features numéricas."}
 
-    k = max(1, min(k, n))
-
-    scaler = StandardScaler(with_mean=True, with_std=True)
-    Xs = scaler.fit_transform(X.values)
+    Xs = fm.Xs
+    # n grande: fit sobre submuestra estratificada, asignación de todas las filas por chunks
+    train_idx = stratified_sample_idx(n, max_train, df["estado_abierto"].to_numpy() if "estado_abierto" in df.columns else None, random_state)
+    X_train = Xs[train_idx]
+    # KMeans se ajusta sobre X_train: k no puede superar sus filas
+    k, k_auto = resolve_k(k, Xs, k_min, k_max, n_fit=len(train_idx), random_state=random_state)
+    km = shared_fit(("kmeans", k, 10, random_state), X_train,
+                    lambda: KMeans(n_clusters=k, n_init=10, random_state=random_state).fit(X_train))
+    labels = chunked_apply(km.predict, Xs)
 
-    km = KMeans(n_clusters=k, n_init=10, random_state=42)
-    labels = km.fit_predict(Xs)
-
-    centers_original = scaler.inverse_transform(km.cluster_centers_)
+    centers_original = km.cluster_centers_ * fm.scale + fm.mean
     centers_df = pd.DataFrame(centers_original, columns=num_feats)
 
     sizes = pd.Series(labels).value_counts().sort_index()
@@ -94,7 +87,7 @@ def clusters(k: int = Query(3, ge=1, description="Número de clusters")) -> Dict
 
     out_rows: List[Dict[str, Any]] = []
     for idx, row in df.reset_index(drop=True).iterrows():
-        feat_dict = {f: float(X.iloc[idx][f]) for f in num_feats}
+        feat_dict = fm.row(idx)
         out_rows.append({
             "id_plazo": int(row["id_plazo"]) if pd.notna(row["id_plazo"]) else None,
             "expediente_id": int(row["expediente_id"]) if pd.notna(row["expediente_id"]) else None,
@@ -106,98 +99,197 @@ def clusters(k: int = Query(3, ge=1, description="Número de clusters")) -> Dict
     return {
         "status": "ok",
         "k": k,
+        "k_auto": k_auto,
         "n_samples": n,
+        "n_train": int(len(train_idx)),
+        "random_state": random_state,
         "features": num_feats,
         "clusters": clusters_summary,
         "assignments": out_rows
     }
 
 
+# =====================
+# K-MEANS CON TEXTO (matriz dispersa)
+# =====================
+@router.get("/clusters_text")
+@track_degraded
+def clusters_text(
+    k: int = Query(5, ge=2, le=100, description="Número de clusters"),
+    max_features: int = Query(500, ge=10, le=50000, description="Términos TF-IDF (backend tfidf)"),
+    peso_numericas: Optional[float] = Query(None, ge=0.0, description="Peso de las features numéricas frente al texto (default 1/sqrt(n_features))"),
+    svd: int = Query(0, ge=0, le=500, description="Componentes TruncatedSVD antes de agrupar (0 = sobre la matriz dispersa)"),
+    top_terms: int = Query(10, ge=1, le=50, description="Términos por cluster"),
+    batch_size: int = Query(TEXT_CLUSTER_BATCH, ge=256, description="Filas por mini-batch"),
+    random_state: int = Query(42, description="Semilla del SVD y del modelo (reproducibilidad)"),
+    async_: bool = Query(False, alias="async", description="Encola el cálculo como job (ver /ml/jobs) y devuelve su handle"),
+) -> Dict[str, Any]:
+    """
+    Agrupa plazos por descripcion (TF-IDF) + features numéricas con
+    MiniBatchKMeans sobre la matriz dispersa (memoria ~ no-ceros, nunca se
+    densifica) u, opcionalmente, sobre su proyección TruncatedSVD. Devuelve
+    los términos más pesados de cada cluster.
+    """
+    if async_:
+        return jobs.submit_response("clusters_text", {"k": k, "max_features": max_features, "peso_numericas": peso_numericas,
+                                                      "svd": svd, "top_terms": top_terms, "batch_size": batch_size,
+                                                      "random_state": random_state})
+
+    df, fm = plazos_matrix()
+    if df.empty:
+        return {"status": "sin_datos", "detail": "No hay plazos en el endpoint origen."}
+
+    base_cols = ["id_plazo", "expediente_id", "descripcion"]
+    for c in base_cols:
+        if c not in df.columns:
+            df[c] = None
+
+    num_feats = fm.columns
+    n = len(fm)
+    k = max(1, min(k, n))
+    weight = peso_numericas if peso_numericas is not None else 1.0 / math.sqrt(max(len(num_feats), 1))
+    mat = text_cluster_matrix(df, num_feats, max_features=max_features, num_weight=weight,
+                              svd_components=svd, random_state=random_state)
+    M = mat.get("Z", mat["X"])
+    km = minibatch_kmeans(M, k, mat["data_key"], batch_size=batch_size, random_state=random_state)
+    labels = chunked_apply(km.predict, M)
+
+    terms = cluster_top_terms(mat["X"][:, :mat["n_text"]], labels, k, mat["terms"], top_terms)
+    centers = cluster_means(fm.X, labels, k)
+    sizes = np.bincount(labels, minlength=k)
+    clusters_summary = [{
+        "cluster": i,
+        "size": int(sizes[i]),
+        "top_terms": terms[i],
+        "center": dict(zip(num_feats, centers[i].tolist())),
+    } for i in range(k)]
+
+    ids = df["id_plazo"].to_numpy()
+    exps = df["expediente_id"].to_numpy()
+    descs = df["descripcion"].to_numpy()
+    out_rows = [{
+        "id_plazo": int(ids[i]) if pd.notna(ids[i]) else None,
+        "expediente_id": int(exps[i]) if pd.notna(exps[i]) else None,
+        "descripcion": descs[i],
+        "cluster": int(labels[i]),
+    } for i in range(n)]
+
+    return {
+        "status": "ok",
+        "k": k,
+        "n_samples": n,
+        "n_terms": int(mat["n_text"]),
+        "nnz": int(mat["X"].nnz),
+        "peso_numericas": weight,
+        "svd": ({"n_components": int(M.shape[1]), "explained_variance": round(mat["svd_explained_variance"], 4)}
+                if "Z" in mat else None),
+        "random_state": random_state,
+        "features": num_feats,
+        "inertia": float(km.inertia_),
+        "clusters": clusters_summary,
+        "assignments": out_rows,
+    }
+
+
 # =====================
 # ISOLATION FOREST (ANOMALÍAS)
 # =====================
 @router.get("/anomalias")
+@track_degraded
 def anomalias(
     contaminacion: float = Query(0.15, gt=0.0, lt=0.5, description="Proporción esperada de anomalías (0-0.5)"),
     max_lista: int = Query(50, ge=1, description="Máximo de filas a devolver ordenadas por score de anomalía"),
     explain: bool = Query(False, description="Devuelve top-3 razones (z-scores) por fila"),
     k_reasons: int = Query(3, ge=1, le=10, description="Cantidad de razones a devolver cuando explain=true"),
+    max_train: int = Query(MAX_TRAIN_ROWS, ge=100, description="Máximo de filas para entrenar (submuestreo estratificado); se scorea todo el dataset"),
+    random_state: int = Query(42, description="Semilla del submuestreo y del modelo (reproducibilidad)"),
+    expediente_id: Optional[int] = Query(None, description="Solo plazos de este expediente"),
+    id_cliente: Optional[int] = Query(None, description="Solo plazos de este cliente"),
+    cliente: Optional[str] = Query(None, min_length=2, description="Solo clientes cuyo nombre contiene este texto"),
+    vence_desde: Optional[str] = Query(None, pattern=_DATE, description="Vencimiento desde (YYYY-MM-DD, inclusive)"),
+    vence_hasta: Optional[str] = Query(None, pattern=_DATE, description="Vencimiento hasta (YYYY-MM-DD, inclusive)"),
+    async_: bool = Query(False, alias="async", description="Encola el cálculo como job (ver /ml/jobs) y devuelve su handle"),
 ) -> Dict[str, Any]:
     """
     Marca plazos anómalos combinando features numéricas (días al vencimiento, docs, etc.).
     - es_anomalo: True si IsolationForest => -1
     - anomaly_score: [0,1], mayor => más anómalo (normalizado desde score_samples)
     - explain=true: agrega "reasons" con top-k z-scores por fila
+    - filtros: el modelo se ajusta sobre todos los plazos; `top` se arma solo con los que coinciden
     """
-    payload = fetch_plazos()
-    df_plazos = flatten_plazos(payload)
-    if df_plazos.empty:
-        return {"status": "sin_datos", "detail": "No hay plazos en el endpoint origen."}
+    if async_:
+        return jobs.submit_response("anomalias", {"contaminacion": contaminacion, "max_lista": max_lista, "explain": explain, "k_reasons": k_reasons,
+                                                  "max_train": max_train, "random_state": random_state,
+                                                  "expediente_id": expediente_id, "id_cliente": id_cliente, "cliente": cliente,
+                                                  "vence_desde": vence_desde, "vence_hasta": vence_hasta})
+    try:
+        filtros = parse_filtros(expediente_id, id_cliente, cliente, vence_desde, vence_hasta)
+    except ValueError as exc:
+        return JSONResponse({"status": "error", "detail": f"Fecha inválida: {exc}"}, status_code=400)
 
-    df, num_feats = enrich_plazos_with_docs(df_plazos)
-    if df.empty:
-        return {"status": "sin_datos", "detail": "Sin filas tras enriquecimiento."}
+    def load():
+        df, fm = plazos_matrix()
+        return (df, fm), data_version(df)
 
-    base_cols = ["id_plazo", "expediente_id", "descripcion"]
-    for c in base_cols:
-        if c not in df.columns:
-            df[c] = None
+    def score(data):
+        df, fm = data
+        if df.empty:
+            return ScoredFrame(df, {"response": {"status": "sin_datos", "detail": "No hay plazos en el endpoint origen."}})
 
-    X = df[num_feats].copy().astype(float).fillna(0.0)
-    n = len(X)
-    if n < 2:
-        return {"status": "insuficiente", "detail": "Se requieren al menos 2 filas para detectar anomalías.", "n_samples": n}
-
-    scaler = StandardScaler(with_mean=True, with_std=True)
-    Xs = scaler.fit_transform(X.values)
-
-    iso = IsolationForest(
-        n_estimators=200,
-        max_samples="auto",
-        contamination=contaminacion,
-        random_state=42,
-        n_jobs=-1,
-    )
-    labels = iso.fit_predict(Xs)  # -1 anómalo, 1 normal
-    scores = iso.score_samples(Xs)  # más alto => más normal
-
-    # Convertir a "anomaly_score" (más grande => más anómalo), normalizado [0,1]
-    raw = -scores  # invertir: más grande => más anómalo
-    rmin, rmax = float(raw.min()), float(raw.max())
-    denom = (rmax - rmin) if (rmax > rmin) else 1e-9
-    norm = (raw - rmin) / denom
-
-    # Preparar explicaciones (z-scores) si se pide
-    reasons_mu, reasons_sigma = _fit_mu_sigma(X) if explain else (None, None)
-
-    rows: List[Dict[str, Any]] = []
-    for idx, row in df.reset_index(drop=True).iterrows():
-        feat_dict = {f: float(X.iloc[idx][f]) for f in num_feats}
-        base = {
-            "id_plazo": int(row["id_plazo"]) if pd.notna(row["id_plazo"]) else None,
-            "expediente_id": int(row["expediente_id"]) if pd.notna(row["expediente_id"]) else None,
-            "descripcion": row["descripcion"],
-            "es_anomalo": bool(labels[idx] == -1),
-            "anomaly_score": float(norm[idx]),
-            "iforest_raw": float(raw[idx]),
-            "features": feat_dict,
-        }
-        if explain:
-            base["reasons"] = _top_k_reasons(
-                X.iloc[idx], reasons_mu, reasons_sigma, num_feats, k=k_reasons
+        base_cols = ["id_plazo", "expediente_id", "descripcion"]
+        for c in base_cols:
+            if c not in df.columns:
+                df[c] = None
+
+        n = len(fm)
+        if n < 2:
+            return ScoredFrame(df, {"response": {"status": "insuficiente", "detail": "Se requieren al menos 2 filas para detectar anomalías.", "n_samples": n}})
+
+        Xs = fm.Xs
+
+        train_idx = stratified_sample_idx(n, max_train, df["estado_abierto"].to_numpy() if "estado_abierto" in df.columns else None, random_state)
+        X_train = Xs[train_idx]
+
+        def _fit_iforest():
+            iso = IsolationForest(
+                n_estimators=200,
+                max_samples="auto",
+                contamination=contaminacion,
+                random_state=random_state,
+                n_jobs=cpu_budget.n_jobs(),
             )
-        rows.append(base)
+            return iso.fit(X_train)
 
-    # Ordenar por score descendente y truncar
-    rows_sorted = sorted(rows, key=lambda r: r["anomaly_score"], reverse=True)
-    rows_sorted = rows_sorted[:max_lista]
+        iso = shared_fit(("iforest", contaminacion, 200, random_state), X_train, _fit_iforest)
+        scores = chunked_apply(iso.score_samples, Xs)    # más alto => más normal
+        labels = np.where(scores - iso.offset_ < 0, -1, 1)  # == iso.predict(Xs): -1 anómalo, 1 normal
 
-    total_anomalos = int(sum(1 for r in rows if r["es_anomalo"]))
+        raw = -scores  # invertir: más grande => más anómalo
+        rmin, rmax = float(raw.min()), float(raw.max())
+        denom = (rmax - rmin) if (rmax > rmin) else 1e-9
+        norm = (raw - rmin) / denom
+        return ScoredFrame(df, {
+            "response": {
+                "status": "ok",
+                "n_samples": n,
+                "n_train": int(len(train_idx)),
+                "random_state": random_state,
+                "contaminacion": contaminacion,
+                "num_anomalos": int((labels == -1).sum()),
+                "features": fm.columns,
+            },
+            "fm": fm, "labels": labels, "raw": raw, "norm": norm,
+        })
+
+    sf = scored("anomalias", (contaminacion, max_train, random_state), load, score)
+    if "norm" not in sf.meta:
+        return dict(sf.meta["response"])
+    return {**sf.meta["response"], **anomaly_top(sf, filtros, max_lista, explain, k_reasons, _plazo_base)}
+
+
+def _plazo_base(row: pd.Series) -> Dict[str, Any]:
     return {
-        "status": "ok",
-        "n_samples": n,
-        "contaminacion": contaminacion,
-        "num_anomalos": total_anomalos,
-        "features": num_feats,
-        "top": rows_sorted
+        "id_plazo": int(row["id_plazo"]) if pd.notna(row["id_plazo"]) else None,
+        "expediente_id": int(row["expediente_id"]) if pd.notna(row["expediente_id"]) else None,
+        "descripcion": row["descripcion"],
     }
@@ -1,20 +1,20 @@
 # app/routers/regresion.py
 from fastapi import APIRouter, Query
-from typing import List, Dict, Any, Tuple
+from fastapi.responses import JSONResponse
+from typing import List, Dict, Any, Optional, Tuple
 import numpy as np
 import pandas as pd
 
-from sklearn.pipeline import Pipeline
-from sklearn.impute import SimpleImputer
-from sklearn.preprocessing import StandardScaler
-from sklearn.linear_model import LinearRegression
-from sklearn.model_selection import KFold, cross_val_score
-
-from ..clients import fetch_plazos, fetch_docs
-from ..features import flatten_plazos, enrich_plazos_with_docs, flatten_docs
+from ..clients import track_degraded
+from ..features import load_enriched_plazos, docs_with_features
+from ..online_ols import OnlineOLS, current
+from ..scored import DOCS_FILTER_COLUMNS, ScoredFrame, data_version, echo, parse_filtros, scored
+from .. import jobs
 
 router = APIRouter(tags=["regresion"])
 
+_DATE = r"^[0-9]{4}-[0-9]{2}-[0-9]{2}$"
+
 # --------------------------
 # Helpers comunes y features
 # --------------------------
@@ -24,54 +24,125 @@ def _safe_kfold(n: int, k: int) -> int:
         return 1
     return max(2, min(k, n))
 
-def _pipe_lr() -> Pipeline:
-    return Pipeline(steps=[
-        ("imputer", SimpleImputer(strategy="median")),
-        ("scaler", StandardScaler(with_mean=True, with_std=True)),
-        ("reg", LinearRegression())
-    ])
+def _fit_online(name: str, df: pd.DataFrame, feats: List[str], target: str, id_col: str,
+                kfold: int) -> Tuple[OnlineOLS, np.ndarray, Dict[str, Any]]:
+    """
+    Imputer(mediana) + scaler + LinearRegression desde estadísticas suficientes
+    (app/online_ols.py): CV por folds estables hash(id) % splits, ajuste final y
+    predicciones para todas las filas.
+    """
+    eng = current(name, df, feats, target, id_col, _safe_kfold(len(df), kfold))
+    cv = eng.cross_validate()
+    fit = eng.fit()
+    y_pred = fit.predict(df[feats].to_numpy(dtype=np.float64))
+    return eng, y_pred, {"cv": cv, "fit": fit}
+
+def _nan_stat(fn, values: np.ndarray) -> Optional[float]:
+    """nanmean/nanstd de métricas por fold; None si ningún fold pudo medirse."""
+    if np.isnan(values).all():
+        return None
+    return float(fn(values))
+
+# --------------------------
+# Filas de predicción (solo las posiciones pedidas; ver app/scored.py)
+# --------------------------
+def _prediction_rows(sf: ScoredFrame, positions: Optional[np.ndarray], row_fn) -> List[Dict[str, Any]]:
+    df, y, y_pred = sf.df, sf.meta["y_true"], sf.meta["y_pred"]
+    feats = sf.meta["row_features"]
+    X = sf.meta.get("X")
+    out_rows: List[Dict[str, Any]] = []
+    for i in (range(len(df)) if positions is None else positions):
+        row = {**row_fn(df.iloc[i]), "y_true": float(y[i]), "y_pred": float(y_pred[i]),
+               "residual": float(y[i] - y_pred[i])}
+        if feats:
+            row["features"] = {f: float(X[i, j]) for j, f in enumerate(feats)}
+        out_rows.append(row)
+    return out_rows
+
+def _render(sf: ScoredFrame, filtros: Dict[str, Any], row_fn) -> Dict[str, Any]:
+    out = dict(sf.meta["response"])
+    if "y_true" in sf.meta:
+        out["predictions"] = _prediction_rows(sf, sf.select(filtros), row_fn)
+        if echo(filtros):
+            out["filtros"] = echo(filtros)
+    return out
+
+def _plazo_row(r: pd.Series) -> Dict[str, Any]:
+    return {
+        "id_plazo": int(r["id_plazo"]) if pd.notna(r["id_plazo"]) else None,
+        "expediente_id": int(r["expediente_id"]) if ("expediente_id" in r and pd.notna(r["expediente_id"])) else None,
+        "descripcion": r.get("descripcion"),
+    }
+
+def _doc_row(r: pd.Series) -> Dict[str, Any]:
+    return {
+        "doc_id": r["doc_id"],
+        "filename": r["filename"],
+        "file_ext": r["file_ext"],
+        "id_expediente": int(r["id_expediente"]) if pd.notna(r["id_expediente"]) else None,
+        "id_cliente": int(r["id_cliente"]) if pd.notna(r["id_cliente"]) else None,
+    }
 
 # ====================================
 # 1) REGRESIÓN PARA PLAZOS (days_to_due)
 # ====================================
 @router.get("/ml/regresion/plazos/dias_restantes")
-def reg_plazos_dias_restantes(kfold: int = Query(5, ge=2, le=20)) -> Dict[str, Any]:
+@track_degraded
+def reg_plazos_dias_restantes(
+    kfold: int = Query(5, ge=2, le=20),
+    expediente_id: Optional[int] = Query(None, description="Solo plazos de este expediente"),
+    id_cliente: Optional[int] = Query(None, description="Solo plazos de este cliente"),
+    cliente: Optional[str] = Query(None, min_length=2, description="Solo clientes cuyo nombre contiene este texto"),
+    vence_desde: Optional[str] = Query(None, pattern=_DATE, description="Vencimiento desde (YYYY-MM-DD, inclusive)"),
+    vence_hasta: Optional[str] = Query(None, pattern=_DATE, description="Vencimiento hasta (YYYY-MM-DD, inclusive)"),
+    async_: bool = Query(False, alias="async", description="Encola el cálculo como job (ver /ml/jobs) y devuelve su handle"),
+) -> Dict[str, Any]:
     """
     Regresión lineal para predecir days_to_due sin fuga de objetivo:
     - Quita 'days_to_due' de las features (estaba en num_feats).
     - CV robusto con nanmean/nanstd para R² (algunos folds pueden quedar con var(y)=0).
+    Los filtros solo recortan `predictions` (el modelo y la CV son sobre todos los plazos).
     """
-    # 1) Cargar y enriquecer
-    payload = fetch_plazos()
-    df_plazos = flatten_plazos(payload)
-    if df_plazos.empty:
-        return {"status": "sin_datos", "detail": "No hay plazos en el endpoint origen."}
+    if async_:
+        return jobs.submit_response("reg_plazos_dias_restantes", {
+            "kfold": kfold, "expediente_id": expediente_id, "id_cliente": id_cliente, "cliente": cliente,
+            "vence_desde": vence_desde, "vence_hasta": vence_hasta,
+        })
+    try:
+        filtros = parse_filtros(expediente_id, id_cliente, cliente, vence_desde, vence_hasta)
+    except ValueError as exc:
+        return JSONResponse({"status": "error", "detail": f"Fecha inválida: {exc}"}, status_code=400)
+
+    def load():
+        df, num_feats_all = load_enriched_plazos()
+        return (df, num_feats_all), data_version(df)
 
-    df, num_feats_all = enrich_plazos_with_docs(df_plazos)
-    if df.empty or ("days_to_due" not in df.columns):
-        return {"status": "sin_datos", "detail": "No hay features numéricas o target 'days_to_due'."}
+    sf = scored("reg_plazos_dias_restantes", kfold, load, lambda data: _fit_plazos_dias_restantes(*data, kfold))
+    return _render(sf, filtros, _plazo_row)
+
+def _fit_plazos_dias_restantes(df: pd.DataFrame, num_feats_all: List[str], kfold: int) -> ScoredFrame:
+    # 1) Cargar y enriquecer
+    if df.empty:
+        return ScoredFrame(df, {"response": {"status": "sin_datos", "detail": "No hay plazos en el endpoint origen."}})
+    if "days_to_due" not in df.columns:
+        return ScoredFrame(df, {"response": {"status": "sin_datos", "detail": "No hay features numéricas o target 'days_to_due'."}})
 
     # 2) Definir features SIN el target para evitar leakage
     num_feats = [f for f in num_feats_all if f != "days_to_due"]
     if not num_feats:
         # Si por alguna razón no quedan features, usamos baseline
+        y = df["days_to_due"].astype(float).to_numpy()
         pred = float(df["days_to_due"].astype(float).mean())
-        preds = [{
-            "id_plazo": int(df.iloc[i]["id_plazo"]) if pd.notna(df.iloc[i]["id_plazo"]) else None,
-            "expediente_id": int(df.iloc[i]["expediente_id"]) if ("expediente_id" in df.columns and pd.notna(df.iloc[i]["expediente_id"])) else None,
-            "descripcion": df.iloc[i].get("descripcion"),
-            "y_true": float(df.iloc[i]["days_to_due"]),
-            "y_pred": pred,
-            "residual": float(df.iloc[i]["days_to_due"] - pred)
-        } for i in range(len(df))]
-        return {
-            "status": "fallback_sin_features",
-            "reason": "No hay features distintas del target; baseline por media.",
-            "n_samples": len(df),
-            "features": num_feats,
-            "baseline_mean_days_to_due": pred,
-            "predictions": preds
-        }
+        return ScoredFrame(df, {
+            "response": {
+                "status": "fallback_sin_features",
+                "reason": "No hay features distintas del target; baseline por media.",
+                "n_samples": len(df),
+                "features": num_feats,
+                "baseline_mean_days_to_due": pred,
+            },
+            "y_true": y, "y_pred": np.full(len(df), pred), "row_features": [],
+        })
 
     # 3) X, y
     X = df[num_feats].copy().astype(float)
@@ -81,106 +152,78 @@ def reg_plazos_dias_restantes(kfold: int = Query(5, ge=2, le=20)) -> Dict[str, A
     if n < 3 or y.nunique() < 2:
         # Fallback si datos insuficientes o sin variación
         pred = float(y.mean()) if n > 0 else 0.0
-        preds = [{
-            "id_plazo": int(df.iloc[i]["id_plazo"]) if pd.notna(df.iloc[i]["id_plazo"]) else None,
-            "expediente_id": int(df.iloc[i]["expediente_id"]) if ("expediente_id" in df.columns and pd.notna(df.iloc[i]["expediente_id"])) else None,
-            "descripcion": df.iloc[i].get("descripcion"),
-            "y_true": float(y.iloc[i]),
-            "y_pred": pred,
-            "residual": float(y.iloc[i] - pred)
-        } for i in range(n)]
-        return {
-            "status": "fallback",
-            "reason": "Datos insuficientes o target casi constante",
-            "n_samples": n,
-            "features": num_feats,
-            "baseline_mean_days_to_due": pred,
-            "predictions": preds
-        }
-
-    # 4) CV + entrenamiento
-    cv_splits = _safe_kfold(n, kfold)
-    cv = KFold(n_splits=cv_splits, shuffle=True, random_state=42)
-    pipe = _pipe_lr()
-
-    # R² puede dar NaN en algún fold si var(y_train)=0 → usar nanmean/nanstd
-    r2_scores = cross_val_score(pipe, X, y, cv=cv, scoring="r2")
-    mae_scores = -cross_val_score(pipe, X, y, cv=cv, scoring="neg_mean_absolute_error")
-
-    pipe.fit(X, y)
-    y_pred = pipe.predict(X)
-
-    reg = pipe.named_steps["reg"]
-    coefs = {f: float(c) for f, c in zip(num_feats, reg.coef_)}
-    intercept = float(reg.intercept_)
-
-    out_rows: List[Dict[str, Any]] = []
-    for i in range(n):
-        out_rows.append({
-            "id_plazo": int(df.iloc[i]["id_plazo"]) if pd.notna(df.iloc[i]["id_plazo"]) else None,
-            "expediente_id": int(df.iloc[i]["expediente_id"]) if ("expediente_id" in df.columns and pd.notna(df.iloc[i]["expediente_id"])) else None,
-            "descripcion": df.iloc[i].get("descripcion"),
-            "y_true": float(y.iloc[i]),
-            "y_pred": float(y_pred[i]),
-            "residual": float(y.iloc[i] - y_pred[i]),
-            "features": {f: float(X.iloc[i][f]) for f in num_feats}
+        return ScoredFrame(df, {
+            "response": {
+                "status": "fallback",
+                "reason": "Datos insuficientes o target casi constante",
+                "n_samples": n,
+                "features": num_feats,
+                "baseline_mean_days_to_due": pred,
+            },
+            "y_true": y.to_numpy(), "y_pred": np.full(n, pred), "row_features": [],
         })
 
-    return {
-        "status": "ok",
-        "model": "LinearRegression (impute+scale) sin leakage",
-        "n_samples": n,
-        "features": num_feats,
-        "cv": {
-            "splits": cv_splits,
-            "r2_folds": [None if np.isnan(v) else float(v) for v in r2_scores],
-            "r2_mean": (None if np.isnan(np.nanmean(r2_scores)) else float(np.nanmean(r2_scores))),
-            "r2_std": (None if np.isnan(np.nanstd(r2_scores)) else float(np.nanstd(r2_scores))),
-            "mae_mean": float(np.mean(mae_scores)),
-            "mae_std": float(np.std(mae_scores)),
+    # 4) CV + entrenamiento (estadísticas suficientes; R² puede dar NaN en algún fold → nanmean/nanstd)
+    eng, y_pred, res = _fit_online("reg_plazos_dias_restantes", df, num_feats, "days_to_due", "id_plazo", kfold)
+    r2_scores, mae_scores = np.array(res["cv"]["r2"]), np.array(res["cv"]["mae"])
+    coefs = {f: float(c) for f, c in zip(num_feats, res["fit"].coef)}
+    intercept = res["fit"].intercept
+
+    return ScoredFrame(df, {
+        "response": {
+            "status": "ok",
+            "model": "LinearRegression (impute+scale) sin leakage",
+            "n_samples": n,
+            "features": num_feats,
+            "cv": {
+                "splits": eng.splits,
+                "r2_folds": [None if np.isnan(v) else float(v) for v in r2_scores],
+                "r2_mean": _nan_stat(np.nanmean, r2_scores),
+                "r2_std": _nan_stat(np.nanstd, r2_scores),
+                "mae_mean": _nan_stat(np.nanmean, mae_scores),
+                "mae_std": _nan_stat(np.nanstd, mae_scores),
+            },
+            "coefficients_std_space": coefs,
+            "intercept_std_space": intercept,
+            "actualizacion": eng.last,
         },
-        "coefficients_std_space": coefs,
-        "intercept_std_space": intercept,
-        "predictions": out_rows
-    }
+        "y_true": y.to_numpy(), "y_pred": y_pred, "row_features": num_feats, "X": X.to_numpy(),
+    })
 
 # ==================================
 # 2) REGRESIÓN PARA DOCS (size_mb)
 # ==================================
-def _docs_with_features() -> Tuple[pd.DataFrame, List[str]]:
-    docs = fetch_docs()
-    df = flatten_docs(docs)
-    if df.empty:
-        return df, []
-
-    # Features numéricas sencillas
-    df["name_len"] = df["filename"].astype(str).str.len().fillna(0).astype(float)
-    df["is_pdf"] = (df["file_ext"].astype(str).str.lower() == "pdf").astype(int)
-
-    for c in ["size_mb", "days_since_created"]:
-        if c not in df.columns:
-            df[c] = 0.0
-    num_feats = ["days_since_created", "name_len", "is_pdf"]
-
-    # Campos base p/salida
-    for c in ["doc_id", "filename", "file_ext", "id_expediente", "id_cliente"]:
-        if c not in df.columns:
-            df[c] = None
-
-    # Tipos correctos
-    df[num_feats + ["size_mb"]] = df[num_feats + ["size_mb"]].astype(float).fillna(0.0)
-    return df, num_feats
-
 @router.get("/docs/regresion/size_mb")
-def reg_docs_size_mb(kfold: int = Query(5, ge=2, le=20)) -> Dict[str, Any]:
+@track_degraded
+def reg_docs_size_mb(
+    kfold: int = Query(5, ge=2, le=20),
+    expediente_id: Optional[int] = Query(None, description="Solo documentos de este expediente"),
+    id_cliente: Optional[int] = Query(None, description="Solo documentos de este cliente"),
+    async_: bool = Query(False, alias="async", description="Encola el cálculo como job (ver /ml/jobs) y devuelve su handle"),
+) -> Dict[str, Any]:
     """
     Entrena una regresión lineal para predecir size_mb de los documentos, usando:
     - days_since_created, name_len, is_pdf
-    Devuelve CV (R2, MAE), coeficientes (espacio estandarizado) y predicciones por doc.
+    Devuelve CV (R2, MAE), coeficientes (espacio estandarizado) y predicciones por doc
+    (los filtros solo recortan `predictions`).
     """
-    df, feats = _docs_with_features()
+    if async_:
+        return jobs.submit_response("reg_docs_size_mb", {"kfold": kfold, "expediente_id": expediente_id,
+                                                         "id_cliente": id_cliente})
+    filtros = parse_filtros(expediente_id, id_cliente)
+
+    def load():
+        df, feats = docs_with_features()
+        return (df, feats), data_version(df)
+
+    sf = scored("reg_docs_size_mb", kfold, load, lambda data: _fit_docs_size_mb(*data, kfold))
+    return _render(sf, filtros, _doc_row)
+
+def _fit_docs_size_mb(df: pd.DataFrame, feats: List[str], kfold: int) -> ScoredFrame:
     if df.empty:
-        return {"status": "sin_datos", "detail": "No hay documentos en el endpoint origen."}
+        return ScoredFrame(df, {"response": {"status": "sin_datos", "detail": "No hay documentos en el endpoint origen."}},
+                           DOCS_FILTER_COLUMNS)
+    feats = [f for f in feats if f != "size_mb"]  # size_mb es el target
 
     X = df[feats].copy().astype(float)
     y = df["size_mb"].astype(float)
@@ -188,67 +231,39 @@ def reg_docs_size_mb(kfold: int = Query(5, ge=2, le=20)) -> Dict[str, Any]:
 
     if n < 3 or y.nunique() < 2:
         pred = float(y.mean()) if n > 0 else 0.0
-        preds = [{
-            "doc_id": df.iloc[i]["doc_id"],
-            "filename": df.iloc[i]["filename"],
-            "file_ext": df.iloc[i]["file_ext"],
-            "id_expediente": int(df.iloc[i]["id_expediente"]) if pd.notna(df.iloc[i]["id_expediente"]) else None,
-            "id_cliente": int(df.iloc[i]["id_cliente"]) if pd.notna(df.iloc[i]["id_cliente"]) else None,
-            "y_true": float(y.iloc[i]),
-            "y_pred": pred,
-            "residual": float(y.iloc[i] - pred)
-        } for i in range(n)]
-        return {
-            "status": "fallback",
-            "reason": "Datos insuficientes o target casi constante",
-            "n_samples": n,
-            "features": feats,
-            "baseline_mean_size_mb": pred,
-            "predictions": preds
-        }
-
-    cv_splits = _safe_kfold(n, kfold)
-    cv = KFold(n_splits=cv_splits, shuffle=True, random_state=42)
-    pipe = _pipe_lr()
-
-    r2_scores = cross_val_score(pipe, X, y, cv=cv, scoring="r2")
-    mae_scores = -cross_val_score(pipe, X, y, cv=cv, scoring="neg_mean_absolute_error")
-
-    pipe.fit(X, y)
-    y_pred = pipe.predict(X)
+        return ScoredFrame(df, {
+            "response": {
+                "status": "fallback",
+                "reason": "Datos insuficientes o target casi constante",
+                "n_samples": n,
+                "features": feats,
+                "baseline_mean_size_mb": pred,
+            },
+            "y_true": y.to_numpy(), "y_pred": np.full(n, pred), "row_features": [],
+        }, DOCS_FILTER_COLUMNS)
 
-    reg = pipe.named_steps["reg"]
-    coefs = {f: float(c) for f, c in zip(feats, reg.coef_)}
-    intercept = float(reg.intercept_)
+    eng, y_pred, res = _fit_online("reg_docs_size_mb", df, feats, "size_mb", "doc_id", kfold)
+    r2_scores, mae_scores = np.array(res["cv"]["r2"]), np.array(res["cv"]["mae"])
+    coefs = {f: float(c) for f, c in zip(feats, res["fit"].coef)}
+    intercept = res["fit"].intercept
 
-    out_rows: List[Dict[str, Any]] = []
-    for i in range(n):
-        out_rows.append({
-            "doc_id": df.iloc[i]["doc_id"],
-            "filename": df.iloc[i]["filename"],
-            "file_ext": df.iloc[i]["file_ext"],
-            "id_expediente": int(df.iloc[i]["id_expediente"]) if pd.notna(df.iloc[i]["id_expediente"]) else None,
-            "id_cliente": int(df.iloc[i]["id_cliente"]) if pd.notna(df.iloc[i]["id_cliente"]) else None,
-            "y_true": float(y.iloc[i]),
-            "y_pred": float(y_pred[i]),
-            "residual": float(y.iloc[i] - y_pred[i]),
-            "features": {f: float(X.iloc[i][f]) for f in feats}
-        })
-
-    return {
-        "status": "ok",
-        "model": "LinearRegression (impute+scale)",
-        "n_samples": n,
-        "features": feats,
-        "target": "size_mb",
-        "cv": {
-            "splits": cv_splits,
-            "r2_mean": float(np.mean(r2_scores)),
-            "r2_std": float(np.std(r2_scores)),
-            "mae_mean": float(np.mean(mae_scores)),
-            "mae_std": float(np.std(mae_scores)),
+    return ScoredFrame(df, {
+        "response": {
+            "status": "ok",
+            "model": "LinearRegression (impute+scale)",
+            "n_samples": n,
+            "features": feats,
+            "target": "size_mb",
+            "cv": {
+                "splits": eng.splits,
+                "r2_mean": _nan_stat(np.nanmean, r2_scores),
+                "r2_std": _nan_stat(np.nanstd, r2_scores),
+                "mae_mean": _nan_stat(np.nanmean, mae_scores),
+                "mae_std": _nan_stat(np.nanstd, mae_scores),
+            },
+            "coefficients_std_space": coefs,
+            "intercept_std_space": intercept,
+            "actualizacion": eng.last,
         },
-        "coefficients_std_space": coefs,
-        "intercept_std_space": intercept,
-        "predictions": out_rows
-    }
+        "y_true": y.to_numpy(), "y_pred": y_pred, "row_features": feats, "X": X.to_numpy(),
+    }, DOCS_FILTER_COLUMNS)
@@ -0,0 +1,75 @@
+# app/routers/similares.py
+from fastapi import APIRouter, Path, Query
+from typing import Any, Dict
+import time
+
+import numpy as np
+import pandas as pd
+
+from ..clients import track_degraded
+from ..features import load_enriched_plazos, today_local
+from ..similarity import SIM_NPROBE, current_index, indexable
+
+router = APIRouter(prefix="/ml/plazos", tags=["ml-similares"])
+
+
+def _fecha(v) -> Any:
+    return None if pd.isna(v) else pd.Timestamp(v).date().isoformat()
+
+
+def _plazo(row: pd.Series, today: pd.Timestamp) -> Dict[str, Any]:
+    """Ficha del plazo con su desenlace (misma regla que build_train_labels)."""
+    fv, fc, cumplido = row.get("fecha_vencimiento"), row.get("fecha_cumplimiento"), bool(row.get("cumplido"))
+    if cumplido:
+        atrasado = None if pd.isna(fc) or pd.isna(fv) else bool(fc > fv)
+    else:
+        atrasado = True if not pd.isna(fv) and today > fv else None
+    exp = row.get("expediente_id")
+    return {
+        "id_plazo": int(row["id_plazo"]),
+        "expediente_id": None if pd.isna(exp) else int(exp),
+        "descripcion": row.get("descripcion"),
+        "cumplido": cumplido,
+        "atrasado": atrasado,
+        "fecha_vencimiento": _fecha(fv),
+        "fecha_cumplimiento": _fecha(fc),
+    }
+
+
+# =====================
+# PLAZOS SIMILARES
+# =====================
+@router.get("/{id_plazo}/similares")
+@track_degraded
+def similares(
+    id_plazo: int = Path(..., description="Plazo de referencia"),
+    k: int = Query(10, ge=1, le=100, description="Cantidad de vecinos"),
+    nprobe: int = Query(SIM_NPROBE, ge=1, le=1024, description="Listas IVF a revisar (más = más exacto y más lento)"),
+) -> Dict[str, Any]:
+    df, num_feats = load_enriched_plazos()
+    if df.empty:
+        return {"status": "sin_datos", "detail": "No hay plazos en el endpoint origen."}
+
+    idx = current_index(df, num_feats)
+    q = idx.vector(id_plazo)
+    if q is None:
+        return {"status": "no_encontrado", "detail": f"El plazo {id_plazo} no existe."}
+
+    t0 = time.perf_counter()
+    ids, sims = idx.search(q, k, nprobe=nprobe, exclude=id_plazo)
+    query_ms = round((time.perf_counter() - t0) * 1000, 2)
+
+    wanted = [id_plazo] + ids.tolist()
+    rows = indexable(df[pd.to_numeric(df["id_plazo"], errors="coerce").isin(wanted)]).set_index("id_plazo", drop=False)
+    today = today_local()
+    vecinos = [{**_plazo(rows.loc[i], today), "similitud": round(float(s), 4)}
+               for i, s in zip(ids.tolist(), sims.tolist())]
+    atrasados = [v["atrasado"] for v in vecinos if v["atrasado"] is not None]
+    return {
+        "status": "ok",
+        "plazo": _plazo(rows.loc[id_plazo], today),
+        "k": len(vecinos),
+        "tasa_atraso_vecinos": round(float(np.mean(atrasados)), 4) if atrasados else None,
+        "vecinos": vecinos,
+        "indice": {**idx.stats(), "nprobe": nprobe, "query_ms": query_ms},
+    }
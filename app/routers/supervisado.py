@@ -1,16 +1,143 @@
-from fastapi import APIRouter
+from typing import Optional
+import json
+
+import numpy as np
+import pandas as pd
+from fastapi import APIRouter, Query
 from fastapi.responses import JSONResponse
-from ..clients import fetch_plazos
-from ..features import flatten_plazos, enrich_plazos_with_docs
-from ..models import ensure_supervised_model, score_supervised
+from ..clients import track_degraded
+from ..features import ENRICH_DOC_WINDOWS, load_docs_frame, load_enriched_plazos, today_local
+from ..models import MAX_TRAIN_ROWS, ensure_supervised_model, predict_risk, risk_rows, supervised_config
+from ..scored import ScoredFrame, data_version, echo, parse_filtros, scored
+from .. import cpu_budget, http_cache, jobs
 
 router = APIRouter(prefix="/ml/supervisado", tags=["supervisado"])
 
+_INT_LIST = r"^[0-9]+(,[0-9]+)*$"
+_FLOAT_LIST = r"^[0-9]+(\.[0-9]+)?(,[0-9]+(\.[0-9]+)?)*$"
+_DATE = r"^[0-9]{4}-[0-9]{2}-[0-9]{2}$"
+
+
+def _parse_list(raw: str, cast):
+    return [cast(x) for x in raw.split(",") if x]
+
+
 @router.get("/prob_riesgo")
-def prob_riesgo():
-    payload = fetch_plazos()
-    df = flatten_plazos(payload)
-    df, num_feats = enrich_plazos_with_docs(df)
-    model, status = ensure_supervised_model(df, num_feats)
-    data = score_supervised(df, model, num_feats)
-    return JSONResponse({"status": status, "total": len(data), "data": data})
+@track_degraded
+def prob_riesgo(
+    expediente_id: Optional[int] = Query(None, description="Solo plazos de este expediente"),
+    id_cliente: Optional[int] = Query(None, description="Solo plazos de este cliente"),
+    cliente: Optional[str] = Query(None, min_length=2, description="Solo clientes cuyo nombre contiene este texto"),
+    vence_desde: Optional[str] = Query(None, pattern=_DATE, description="Vencimiento desde (YYYY-MM-DD, inclusive)"),
+    vence_hasta: Optional[str] = Query(None, pattern=_DATE, description="Vencimiento hasta (YYYY-MM-DD, inclusive)"),
+    async_: bool = Query(False, alias="async", description="Encola el cálculo como job (ver /ml/jobs) y devuelve su handle"),
+):
+    if async_:
+        return jobs.submit_response("prob_riesgo", {
+            "expediente_id": expediente_id, "id_cliente": id_cliente, "cliente": cliente,
+            "vence_desde": vence_desde, "vence_hasta": vence_hasta,
+        })
+    try:
+        filtros = parse_filtros(expediente_id, id_cliente, cliente, vence_desde, vence_hasta)
+    except ValueError as exc:
+        return JSONResponse({"status": "error", "detail": f"Fecha inválida: {exc}"}, status_code=400)
+
+    # El modelo depende de la config además de los datos: va al ETag y a la clave del resultado
+    cfg = json.dumps(supervised_config()["params"], sort_keys=True)
+
+    def load():
+        df, num_feats = load_enriched_plazos()
+        http_cache.note_version("supervised_config", cfg)
+        return (df, num_feats), data_version(df)
+
+    def score(data):
+        df, num_feats = data
+        model, status = ensure_supervised_model(df, num_feats)
+        proba = predict_risk(df, model, num_feats) if not df.empty else np.zeros(0)
+        return ScoredFrame(df, {"status": status, "proba": proba})
+
+    sf = scored("prob_riesgo", cfg, load, score)
+    data = risk_rows(sf.df, sf.meta["proba"], sf.select(filtros))
+    out = {"status": sf.meta["status"], "total": len(data), "data": data}
+    if echo(filtros):
+        out["filtros"] = echo(filtros)
+    return JSONResponse(out)
+
+
+@router.get("/config")
+def config():
+    """Config del pipeline servido (defaults o la última promovida por /tuning) y sus métricas de CV."""
+    return supervised_config()
+
+
+@router.post("/tuning")
+@track_degraded
+def tuning(
+    max_features: str = Query("250,500,1000,2000", pattern=_INT_LIST, description="Candidatos TF-IDF max_features"),
+    ngram_max: str = Query("1,2", pattern=_INT_LIST, description="n-gramas (1, n) a probar"),
+    C: str = Query("0.1,1,10", pattern=_FLOAT_LIST, description="Regularización inversa de la LogisticRegression"),
+    max_iter: str = Query("200", pattern=_INT_LIST),
+    cv: int = Query(3, ge=2, le=10),
+    factor: int = Query(3, ge=2, le=10, description="Successive halving: se queda 1/factor de candidatos por ronda"),
+    promote: bool = Query(True, description="Promueve el ganador si no empeora a la config actual"),
+    async_: bool = Query(True, alias="async", description="Encola la búsqueda como job (ver /ml/jobs)"),
+):
+    """
+    Búsqueda de hiperparámetros (successive halving) del modelo de riesgo con
+    caché de transformaciones entre candidatos. Pensado para uso admin/offline:
+    es POST porque promueve la config servida y por defecto corre como job
+    (la promoción se aplica también en el proceso API). Ver app/tuning.py.
+    """
+    if async_:
+        return jobs.submit_response("tuning_supervisado", {
+            "max_features": max_features, "ngram_max": ngram_max, "C": C, "max_iter": max_iter,
+            "cv": cv, "factor": factor, "promote": promote,
+        })
+
+    from ..tuning import param_grid, tune_supervised
+
+    grid = param_grid(_parse_list(max_features, int), _parse_list(ngram_max, int),
+                      _parse_list(C, float), _parse_list(max_iter, int))
+    df, num_feats = load_enriched_plazos()
+    # Con un upstream caído los datos están incompletos: se reporta pero no se promueve
+    degraded = bool(df.attrs.get("upstream_errors"))
+    with cpu_budget.threads():
+        return tune_supervised(df, num_feats, grid, cv=cv, factor=factor, promote=promote and not degraded)
+
+
+@router.post("/backtest")
+@track_degraded
+def backtest(
+    desde: Optional[str] = Query(None, pattern=_DATE, description="Primera fecha de corte (YYYY-MM-DD); por defecto 52 semanas antes de `hasta`"),
+    hasta: Optional[str] = Query(None, pattern=_DATE, description="Última fecha de corte; por defecto hoy - horizonte_dias (desenlaces ya conocidos)"),
+    cada_dias: int = Query(7, ge=1, le=365, description="Separación entre fechas de corte"),
+    horizonte_dias: int = Query(30, ge=1, le=365, description="Se evalúan los plazos abiertos que vencían dentro de este horizonte"),
+    max_train: int = Query(MAX_TRAIN_ROWS, ge=100, description="Máximo de filas de entrenamiento por fecha (submuestreo estratificado)"),
+    async_: bool = Query(True, alias="async", description="Encola el backtest como job (ver /ml/jobs)"),
+):
+    """
+    Backtest point-in-time de prob_riesgo: por cada fecha de corte se
+    reconstruyen features y etiquetas con lo que se sabía entonces, se entrena
+    y se mide AUC, precisión en ALTA y calibración sobre los plazos que se
+    resolvieron después. Es POST porque por defecto encola un job pesado. Ver app/backtest.py.
+    """
+    if async_:
+        return jobs.submit_response("backtest_supervisado", {
+            "desde": desde, "hasta": hasta, "cada_dias": cada_dias,
+            "horizonte_dias": horizonte_dias, "max_train": max_train,
+        })
+
+    from ..backtest import as_of_dates, run_backtest
+
+    try:
+        end = pd.Timestamp(hasta) if hasta else today_local() - pd.Timedelta(days=horizonte_dias)
+        start = pd.Timestamp(desde) if desde else end - pd.Timedelta(weeks=52)
+    except ValueError as exc:
+        return JSONResponse({"status": "error", "detail": f"Fecha inválida: {exc}"}, status_code=400)
+    if start > end:
+        return JSONResponse({"status": "error", "detail": "`desde` es posterior a `hasta`."}, status_code=400)
+    df, _ = load_enriched_plazos()
+    df_docs = load_docs_frame(include_filename=False)
+    with cpu_budget.threads():
+        return run_backtest(df, df_docs, as_of_dates(start, end, cada_dias), horizonte_dias=horizonte_dias,
+                            windows=ENRICH_DOC_WINDOWS, max_train=max_train)
@@ -0,0 +1,285 @@
+# app/scored.py
+"""
+Resultados ya scoreados por snapshot + índices para servir filtros
+(expediente_id, id_cliente, cliente, vence_desde/vence_hasta) en
+O(filas que coinciden).
+
+Cada endpoint de scoring (prob_riesgo, regresiones, anomalías) guarda su
+resultado completo como ScoredFrame: el DataFrame del snapshot con las
+columnas de score y los campos que no dependen de las filas (CV,
+coeficientes, ...). Sobre él, índices construidos la primera vez que se
+usan:
+
+- hash por id (expediente_id / id_expediente, id_cliente): valor -> posiciones
+- cliente: substring del nombre sobre las categorías de cliente_nombre
+  (pocos nombres distintos) -> posiciones
+- fecha_vencimiento: posiciones ordenadas por fecha; un rango es un searchsorted
+
+Los routers arman la respuesta solo para las posiciones seleccionadas.
+
+Reutilización: durante SCORED_FRESH_S segundos desde la última verificación
+se sirve el ScoredFrame sin tocar los upstreams; pasado ese tiempo se recargan
+los datos y, si la huella (datos + config) no cambió, se reutiliza sin
+reentrenar. Resultados sobre datos degradados no se guardan.
+"""
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+from collections import OrderedDict
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from . import http_cache, singleflight
+from .models import format_reasons, top_k_features, zscore_matrix
+
+SCORED_FRESH_S = float(os.getenv("SCORED_FRESH_S", "30"))     # 0 = verificar la huella en cada request
+SCORED_CACHE_SIZE = int(os.getenv("SCORED_CACHE_SIZE", "8"))
+
+# Filtro -> columna según el tipo de fila
+PLAZOS_FILTER_COLUMNS = {"expediente_id": "expediente_id", "id_cliente": "id_cliente"}
+DOCS_FILTER_COLUMNS = {"expediente_id": "id_expediente", "id_cliente": "id_cliente"}
+
+
+class ScoredFrame:
+    """Resultado completo de un endpoint sobre un snapshot, con índices perezosos para filtrar."""
+
+    def __init__(self, df: pd.DataFrame, meta: Optional[Dict[str, Any]] = None,
+                 filter_columns: Optional[Dict[str, str]] = None):
+        self.df = df.reset_index(drop=True)
+        self.meta = meta or {}
+        self.filter_columns = filter_columns or PLAZOS_FILTER_COLUMNS
+        self.version: Hashable = None
+        self.versions: List[Tuple[str, Any]] = []
+        self.checked_at = time.time()
+        self._lock = threading.Lock()
+        self._hash: Dict[str, Dict[Any, np.ndarray]] = {}
+        self._due: Optional[Tuple[np.ndarray, np.ndarray]] = None
+        self._derived: Dict[str, Any] = {}
+
+    def __len__(self) -> int:
+        return len(self.df)
+
+    def cached(self, name: str, build: Callable[[], Any]) -> Any:
+        """Derivado del resultado calculado la primera vez que se pide (p. ej. z-scores para explain)."""
+        with self._lock:
+            if name in self._derived:
+                return self._derived[name]
+        value = build()
+        with self._lock:
+            return self._derived.setdefault(name, value)
+
+    # ------------------------------------------------------------------
+    # Índices
+    # ------------------------------------------------------------------
+    def _hash_index(self, col: str) -> Dict[Any, np.ndarray]:
+        with self._lock:
+            index = self._hash.get(col)
+        if index is None:
+            values = self.df[col]
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                values = pd.Series(values.cat.codes.to_numpy())
+            # groupby(...).indices: valor -> posiciones ordenadas (nulos fuera)
+            index = values.groupby(values.to_numpy(), sort=False).indices
+            with self._lock:
+                self._hash[col] = index
+        return index
+
+    def _due_index(self) -> Tuple[np.ndarray, np.ndarray]:
+        with self._lock:
+            due = self._due
+        if due is None:
+            ns = self.df["fecha_vencimiento"].to_numpy().astype("datetime64[ns]").view(np.int64)
+            pos = np.flatnonzero(ns != np.iinfo(np.int64).min)  # sin NaT
+            order = pos[np.argsort(ns[pos], kind="stable")]
+            due = (ns[order], order)
+            with self._lock:
+                self._due = due
+        return due
+
+    def _by_id(self, name: str, value: Any) -> np.ndarray:
+        col = self.filter_columns.get(name)
+        if col is None or col not in self.df.columns:
+            return np.zeros(0, dtype=np.int64)
+        index = self._hash_index(col)
+        hit = index.get(value)  # int32 o float64 (ids con nulos): misma clave que el int
+        return np.zeros(0, dtype=np.int64) if hit is None else hit
+
+    def _by_cliente(self, text: str) -> np.ndarray:
+        if "cliente_nombre" not in self.df.columns:
+            return np.zeros(0, dtype=np.int64)
+        names = self.df["cliente_nombre"].astype("category").cat.categories
+        codes = np.flatnonzero(names.astype(str).str.contains(text, case=False, regex=False))
+        index = self._hash_index("cliente_nombre")
+        hits = [index[c] for c in codes if c in index]
+        return np.sort(np.concatenate(hits)) if hits else np.zeros(0, dtype=np.int64)
+
+    def _by_due(self, desde: Optional[pd.Timestamp], hasta: Optional[pd.Timestamp]) -> np.ndarray:
+        if "fecha_vencimiento" not in self.df.columns:
+            return np.zeros(0, dtype=np.int64)
+        ns, order = self._due_index()
+        lo = 0 if desde is None else np.searchsorted(ns, desde.value, side="left")
+        # vence_hasta es un día completo: hasta el final de esa fecha
+        hi = len(ns) if hasta is None else np.searchsorted(
+            ns, (hasta.normalize() + pd.Timedelta(days=1)).value, side="left")
+        return np.sort(order[lo:hi])
+
+    # ------------------------------------------------------------------
+    # Selección
+    # ------------------------------------------------------------------
+    def select(self, filtros: Dict[str, Any]) -> Optional[np.ndarray]:
+        """
+        Posiciones (orden original) que cumplen todos los filtros no nulos;
+        None si no hay filtros (todas las filas).
+        """
+        parts = []
+        for name in ("expediente_id", "id_cliente"):
+            if filtros.get(name) is not None:
+                parts.append(self._by_id(name, filtros[name]))
+        if filtros.get("cliente"):
+            parts.append(self._by_cliente(filtros["cliente"]))
+        if filtros.get("vence_desde") is not None or filtros.get("vence_hasta") is not None:
+            parts.append(self._by_due(filtros.get("vence_desde"), filtros.get("vence_hasta")))
+        if not parts:
+            return None
+        parts.sort(key=len)
+        out = parts[0]
+        for other in parts[1:]:
+            out = np.intersect1d(out, other, assume_unique=True)
+        return out
+
+
+def top_positions(score: np.ndarray, positions: Optional[np.ndarray], k: int) -> np.ndarray:
+    """Las k posiciones de mayor score (desc., empates en orden original) dentro de `positions` (None = todas)."""
+    if positions is None:
+        return np.argsort(-score, kind="stable")[:k]
+    return positions[np.argsort(-score[positions], kind="stable")][:k]
+
+
+def anomaly_top(sf: ScoredFrame, filtros: Dict[str, Any], max_lista: int, explain: bool, k_reasons: int,
+                 base_fn) -> Dict[str, Any]:
+    """`top` (y filtros aplicados) a partir del scoring completo: solo se arman las filas devueltas."""
+    fm, labels, raw, norm = sf.meta["fm"], sf.meta["labels"], sf.meta["raw"], sf.meta["norm"]
+    # Orden estable por score descendente dentro de las filas que cumplen los filtros
+    positions = sf.select(filtros)
+    order = top_positions(norm, positions, max_lista)
+
+    # Explicaciones (z-scores): matriz una vez por resultado + top-k solo de las filas devueltas
+    if explain:
+        Xv = fm.X[order]
+        Z = sf.cached("zscore", lambda: zscore_matrix(fm.X))[order]
+        reasons_idx = top_k_features(np.abs(Z), k_reasons)
+
+    rows: List[Dict[str, Any]] = []
+    for i, idx in enumerate(order):
+        row = sf.df.iloc[idx]
+        base = {
+            **base_fn(row),
+            "es_anomalo": bool(labels[idx] == -1),
+            "anomaly_score": float(norm[idx]),
+            "iforest_raw": float(raw[idx]),
+            "features": fm.row(idx),
+        }
+        if explain:
+            base["reasons"] = format_reasons(reasons_idx, i, fm.columns, {"value": Xv, "zscore": Z})
+        rows.append(base)
+    out: Dict[str, Any] = {"top": rows}
+    if echo(filtros):
+        out["filtros"] = echo(filtros)
+        out["n_filtrados"] = int(len(positions))
+    return out
+
+
+def parse_filtros(expediente_id: Optional[int] = None, id_cliente: Optional[int] = None,
+                  cliente: Optional[str] = None, vence_desde: Optional[str] = None,
+                  vence_hasta: Optional[str] = None) -> Dict[str, Any]:
+    """Parámetros de query -> filtros de ScoredFrame.select (ValueError si una fecha es inválida)."""
+    return {
+        "expediente_id": expediente_id,
+        "id_cliente": id_cliente,
+        "cliente": (cliente or "").strip() or None,
+        "vence_desde": pd.Timestamp(vence_desde).normalize() if vence_desde else None,
+        "vence_hasta": pd.Timestamp(vence_hasta).normalize() if vence_hasta else None,
+    }
+
+
+def echo(filtros: Dict[str, Any]) -> Dict[str, Any]:
+    """Filtros aplicados, para la respuesta."""
+    return {k: (str(v.date()) if isinstance(v, pd.Timestamp) else v) for k, v in filtros.items() if v is not None}
+
+
+# ----------------------------------------------------------------------
+# Caché por endpoint + parámetros
+# ----------------------------------------------------------------------
+_cache: "OrderedDict[Tuple[str, Hashable], ScoredFrame]" = OrderedDict()
+_cache_lock = threading.Lock()
+_stats = {"fresh": 0, "same_version": 0, "scored": 0}
+
+
+def data_version(*frames: pd.DataFrame) -> Optional[Tuple]:
+    """Huella de los insumos; None si alguno viene degradado (no se cachea)."""
+    if any(df.attrs.get("upstream_errors") for df in frames):
+        return None
+    return tuple(df.attrs.get("fingerprint") or singleflight.fingerprint(df) for df in frames)
+
+
+def scored(name: str, params: Hashable, load: Callable[[], Tuple[Any, Optional[Hashable]]],
+           score: Callable[[Any], Optional[ScoredFrame]]) -> Optional[ScoredFrame]:
+    """
+    ScoredFrame de `name` con `params` (los que cambian el score, no el render).
+    load() -> (datos, versión|None); score(datos) -> ScoredFrame, o None si no
+    hay nada que cachear (sin datos, respuesta de error).
+    """
+    key = (name, params)
+    with _cache_lock:
+        sf = _cache.get(key)
+        if sf is not None:
+            _cache.move_to_end(key)
+    if sf is not None and time.time() - sf.checked_at < SCORED_FRESH_S:
+        _stats["fresh"] += 1
+        http_cache.replay(sf.versions)
+        return sf
+
+    data, version = load()
+    if sf is not None and version is not None and sf.version == version:
+        _stats["same_version"] += 1
+        sf.checked_at = time.time()
+        http_cache.replay(sf.versions)
+        return sf
+
+    def run(data: Any) -> Optional[ScoredFrame]:
+        out = score(data)
+        if out is not None:
+            # Versiones anotadas por quien calculó (datos + config del modelo)
+            out.version, out.versions = version, http_cache.noted_versions()
+        return out
+
+    # Requests concurrentes con los mismos datos comparten un solo scoring
+    sf = singleflight.fits.do(("scored", key, version), run, data) if version is not None else run(data)
+    _stats["scored"] += 1
+    if sf is None or version is None:
+        return sf
+    sf.checked_at = time.time()
+    with _cache_lock:
+        _cache[key] = sf
+        _cache.move_to_end(key)
+        while len(_cache) > SCORED_CACHE_SIZE:
+            _cache.popitem(last=False)
+    # Ya cacheado: recién ahora puede cortar con 304 (el líder corrió con los cortes suspendidos)
+    http_cache.replay(sf.versions)  # las que no anotó esta request (si otra calculó)
+    http_cache.check_not_modified()
+    return sf
+
+
+def resident_frames() -> Dict[str, pd.DataFrame]:
+    """DataFrames retenidos en el caché (para /debug/memory)."""
+    with _cache_lock:
+        return {f"{k[0]} {k[1]}": sf.df for k, sf in _cache.items()}
+
+
+def stats() -> Dict[str, Any]:
+    with _cache_lock:
+        entries = [{"endpoint": k[0], "params": repr(k[1]), "rows": len(sf),
+                    "age_s": round(time.time() - sf.checked_at, 1)} for k, sf in _cache.items()]
+    return {"fresh_s": SCORED_FRESH_S, "entries": entries, **_stats}
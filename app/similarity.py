@@ -0,0 +1,266 @@
+# app/similarity.py
+"""
+Índice de vecinos cercanos para "plazos similares".
+
+Embedding compacto por plazo (float32, norma 1; similitud = producto punto):
+- texto: TF-IDF de descripcion -> TruncatedSVD (SIM_SVD_DIM componentes)
+- numéricas estandarizadas, sin las relativas a "hoy" (days_*, recent_*,
+  docs_last_*, docs_per_week): cambian a diario y obligarían a reindexar todo
+  - peso SIM_NUM_WEIGHT del bloque numérico frente al de texto
+
+Búsqueda IVF: las filas se reparten en ~sqrt(n) listas por k-means sobre los
+embeddings; una consulta mira solo las SIM_NPROBE listas más cercanas (con
+menos de SIM_EXACT_BELOW filas hay una sola lista, es decir búsqueda exacta).
+
+Actualización incremental: con cada snapshot nuevo solo se embeben los plazos
+nuevos o cambiados (huella por fila) con los vectorizadores ya ajustados; van a
+un buffer delta que se busca exhaustivamente y sus versiones viejas quedan
+ocultas en el índice principal. Cuando el delta supera SIM_DELTA_MAX_FRAC del
+índice (o cambian las features), se reconstruye todo.
+"""
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import copy
+import os
+import re
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.decomposition import TruncatedSVD
+
+from . import singleflight
+from .text_features import make_text_vectorizer
+
+SIM_SVD_DIM = int(os.getenv("SIM_SVD_DIM", "64"))
+SIM_NUM_WEIGHT = float(os.getenv("SIM_NUM_WEIGHT", "0.3"))        # 0 = solo texto, 1 = solo numéricas
+SIM_NPROBE = int(os.getenv("SIM_NPROBE", "16"))
+SIM_EXACT_BELOW = int(os.getenv("SIM_EXACT_BELOW", "5000"))
+SIM_DELTA_MAX_FRAC = float(os.getenv("SIM_DELTA_MAX_FRAC", "0.1"))
+SIM_MAX_FEATURES = int(os.getenv("SIM_MAX_FEATURES", "5000"))
+SIM_TRAIN_ROWS = int(os.getenv("SIM_TRAIN_ROWS", "50000"))        # filas para ajustar TF-IDF/SVD/listas
+RANDOM_STATE = 42
+
+# Features que dependen de la fecha actual (no sirven para comparar plazos de distintas épocas)
+_RELATIVE = re.compile(r"^(days_|recent_|docs_last_)|^docs_per_week$")
+
+
+def embedding_features(num_feats: Sequence[str]) -> List[str]:
+    return [f for f in num_feats if not _RELATIVE.match(f)]
+
+
+# ----------------------------------------------------------------------
+# Embedding
+# ----------------------------------------------------------------------
+class Embedder:
+    """TF-IDF + SVD + escalado de numéricas ajustados una vez; transform() embebe filas nuevas sin refit."""
+
+    def __init__(self, feats: List[str], svd_dim: int = SIM_SVD_DIM, num_weight: float = SIM_NUM_WEIGHT,
+                 random_state: int = RANDOM_STATE):
+        self.feats = feats
+        self.svd_dim = svd_dim
+        self.num_weight = num_weight
+        self.random_state = random_state
+
+    def fit(self, df: pd.DataFrame) -> "Embedder":
+        rng = np.random.default_rng(self.random_state)
+        sample = df if len(df) <= SIM_TRAIN_ROWS else df.iloc[np.sort(rng.choice(len(df), SIM_TRAIN_ROWS, replace=False))]
+        self.vectorizer = make_text_vectorizer(max_features=SIM_MAX_FEATURES)
+        T = self.vectorizer.fit_transform(sample["descripcion"].fillna(""))
+        n_comp = max(1, min(self.svd_dim, T.shape[1] - 1, T.shape[0] - 1))
+        self.svd = TruncatedSVD(n_components=n_comp, random_state=self.random_state).fit(T) if T.shape[1] > 1 else None
+        N = sample[self.feats].to_numpy(dtype=float, na_value=0.0)
+        self.mean = N.mean(axis=0) if len(self.feats) else np.zeros(0)
+        scale = N.std(axis=0) if len(self.feats) else np.zeros(0)
+        scale[scale == 0.0] = 1.0
+        self.scale = scale
+        return self
+
+    @property
+    def dim(self) -> int:
+        return (self.svd.n_components if self.svd is not None else 0) + len(self.feats)
+
+    def transform(self, df: pd.DataFrame) -> np.ndarray:
+        n = len(df)
+        if self.svd is not None:
+            U = self.svd.transform(self.vectorizer.transform(df["descripcion"].fillna("")))
+            U /= np.maximum(np.linalg.norm(U, axis=1, keepdims=True), 1e-12)
+        else:
+            U = np.zeros((n, 0))
+        V = (df[self.feats].to_numpy(dtype=float, na_value=0.0) - self.mean) / self.scale
+        V /= np.sqrt(max(len(self.feats), 1))  # norma esperada ~1, como el bloque de texto
+        E = np.hstack([np.sqrt(1.0 - self.num_weight) * U, np.sqrt(self.num_weight) * V]).astype(np.float32)
+        E /= np.maximum(np.linalg.norm(E, axis=1, keepdims=True), 1e-12)
+        return E
+
+
+def indexable(df: pd.DataFrame) -> pd.DataFrame:
+    """Filas con id_plazo (entero, único: gana la última) y descripcion."""
+    out = df[pd.to_numeric(df["id_plazo"], errors="coerce").notna()]
+    out = out.assign(id_plazo=pd.to_numeric(out["id_plazo"]).astype("int64"))
+    if "descripcion" not in out.columns:
+        out = out.assign(descripcion=None)
+    return out.drop_duplicates("id_plazo", keep="last")
+
+
+def row_hashes(df: pd.DataFrame, feats: List[str]) -> np.ndarray:
+    """Huella por fila de lo que entra al embedding (detecta plazos cambiados entre snapshots)."""
+    return pd.util.hash_pandas_object(df[["descripcion"] + feats], index=False).to_numpy()
+
+
+# ----------------------------------------------------------------------
+# Índice IVF + buffer delta
+# ----------------------------------------------------------------------
+class SimilarityIndex:
+    def __init__(self, df: pd.DataFrame, feats: List[str], random_state: int = RANDOM_STATE):
+        t0 = time.perf_counter()
+        self.feats = feats
+        self.embedder = Embedder(feats, random_state=random_state).fit(df)
+        ids = df["id_plazo"].to_numpy(dtype=np.int64)
+        E = self.embedder.transform(df)
+        self._build_lists(E, ids, random_state)
+        self.hashes: Dict[int, int] = dict(zip(ids.tolist(), row_hashes(df, feats).tolist()))
+        self.where: Dict[int, Tuple[str, int]] = {int(i): ("main", p) for p, i in enumerate(self.ids.tolist())}
+        self.hidden = np.zeros(len(self.ids), dtype=bool)  # filas del principal reemplazadas o borradas
+        self.delta_E = np.zeros((0, E.shape[1]), dtype=np.float32)
+        self.delta_ids = np.zeros(0, dtype=np.int64)
+        self.fingerprint: Optional[str] = df.attrs.get("fingerprint")
+        self.updates = 0
+        self.build_s = round(time.perf_counter() - t0, 3)
+
+    def _build_lists(self, E: np.ndarray, ids: np.ndarray, random_state: int) -> None:
+        n = len(E)
+        nlist = 1 if n < SIM_EXACT_BELOW else int(np.sqrt(n))
+        if nlist > 1:
+            rng = np.random.default_rng(random_state)
+            train = E[rng.choice(n, min(n, SIM_TRAIN_ROWS), replace=False)]
+            km = MiniBatchKMeans(n_clusters=nlist, n_init=1, random_state=random_state, batch_size=4096).fit(train)
+            C = km.cluster_centers_.astype(np.float32)
+            C /= np.maximum(np.linalg.norm(C, axis=1, keepdims=True), 1e-12)
+            assign = np.argmax(E @ C.T, axis=1)
+        else:
+            C = np.zeros((1, E.shape[1]), dtype=np.float32)
+            assign = np.zeros(n, dtype=np.int64)
+        order = np.argsort(assign, kind="stable")
+        # Filas de una misma lista contiguas: escanear una lista es un slice
+        self.E = np.ascontiguousarray(E[order])
+        self.ids = ids[order]
+        self.centroids = C
+        self.offsets = np.r_[0, np.cumsum(np.bincount(assign, minlength=len(C)))]
+
+    def __len__(self) -> int:
+        return int((~self.hidden).sum() + (self.delta_ids >= 0).sum())
+
+    def clone(self) -> "SimilarityIndex":
+        """Copia que comparte lo inmutable (embeddings, listas, embedder); update() se aplica sobre ella."""
+        out = copy.copy(self)
+        out.hidden = self.hidden.copy()
+        out.where = dict(self.where)
+        out.delta_ids = self.delta_ids.copy()
+        return out
+
+    def update(self, df: pd.DataFrame) -> bool:
+        """
+        Aplica un snapshot nuevo: embebe solo filas nuevas/cambiadas (al delta) y
+        oculta las viejas. Devuelve False si conviene reconstruir (delta grande).
+        """
+        new = dict(zip(df["id_plazo"].astype("int64").tolist(), row_hashes(df, self.feats).tolist()))
+        changed = [i for i, h in new.items() if self.hashes.get(i) != h]
+        gone = [i for i in self.hashes if i not in new]
+        if len(self.delta_ids) + len(changed) > SIM_DELTA_MAX_FRAC * max(len(self.ids), 1):
+            return False
+
+        for i in changed + gone:
+            loc = self.where.pop(int(i), None)
+            if loc is None:
+                continue
+            if loc[0] == "main":
+                self.hidden[loc[1]] = True
+            else:
+                self.delta_ids[loc[1]] = -1  # tombstone en el delta
+        if len(changed):
+            rows = df[df["id_plazo"].isin(changed)]
+            E = self.embedder.transform(rows)
+            start = len(self.delta_ids)
+            self.delta_E = np.vstack([self.delta_E, E])
+            self.delta_ids = np.r_[self.delta_ids, rows["id_plazo"].to_numpy(dtype=np.int64)]
+            for j, i in enumerate(rows["id_plazo"].tolist()):
+                self.where[int(i)] = ("delta", start + j)
+        self.hashes = new
+        self.fingerprint = df.attrs.get("fingerprint")
+        self.updates += 1
+        return True
+
+    def vector(self, id_plazo: int) -> Optional[np.ndarray]:
+        loc = self.where.get(int(id_plazo))
+        if loc is None:
+            return None
+        return self.E[loc[1]] if loc[0] == "main" else self.delta_E[loc[1]]
+
+    def search(self, q: np.ndarray, k: int, nprobe: int = SIM_NPROBE,
+               exclude: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """(ids, similitudes) de los k vecinos más cercanos a q (coseno), mejores primero."""
+        lists = np.argsort(-(self.centroids @ q))[:max(1, nprobe)] if len(self.centroids) > 1 else [0]
+        cand_ids, cand_sims = [self.delta_ids], [self.delta_E @ q]
+        for c in lists:
+            a, b = self.offsets[c], self.offsets[c + 1]
+            keep = ~self.hidden[a:b]
+            cand_ids.append(self.ids[a:b][keep])
+            cand_sims.append(self.E[a:b][keep] @ q)
+        ids, sims = np.concatenate(cand_ids), np.concatenate(cand_sims)
+        ok = ids >= 0
+        if exclude is not None:
+            ok &= ids != exclude
+        ids, sims = ids[ok], sims[ok]
+        k = min(k, len(ids))
+        if k == 0:
+            return ids[:0], sims[:0]
+        top = np.argpartition(-sims, k - 1)[:k]
+        top = top[np.argsort(-sims[top], kind="stable")]
+        return ids[top], sims[top]
+
+    def stats(self) -> Dict[str, Any]:
+        return {"n": len(self), "n_main": int(len(self.ids)), "n_delta": int((self.delta_ids >= 0).sum()),
+                "nlist": int(len(self.centroids)), "dim": int(self.E.shape[1]), "updates": self.updates,
+                "build_s": self.build_s}
+
+
+_index: Dict[str, Any] = {"index": None}
+_index_lock = threading.Lock()
+
+
+def current_index(df: pd.DataFrame, num_feats: Sequence[str]) -> SimilarityIndex:
+    """Índice al día con el snapshot df: lo reutiliza, lo actualiza (delta) o lo reconstruye."""
+    feats = embedding_features(num_feats)
+    fp = df.attrs.get("fingerprint")
+
+    def refresh() -> SimilarityIndex:
+        with _index_lock:
+            idx = _index["index"]
+        if idx is not None and idx.feats == feats and fp is not None and idx.fingerprint == fp:
+            return idx
+        rows = indexable(df)
+        # Las búsquedas en curso siguen usando el índice anterior mientras se actualiza la copia
+        if idx is not None and idx.feats == feats:
+            idx = idx.clone()
+            if not idx.update(rows):
+                idx = None
+        if idx is None:
+            idx = SimilarityIndex(rows, feats)
+        with _index_lock:
+            _index["index"] = idx
+        return idx
+
+    with _index_lock:
+        idx = _index["index"]
+    if idx is not None and idx.feats == feats and fp is not None and idx.fingerprint == fp:
+        return idx
+    # Una sola actualización a la vez; las requests concurrentes la comparten
+    return singleflight.features.do(("similares", fp), refresh)
+
+
+def stats() -> Optional[Dict[str, Any]]:
+    with _index_lock:
+        idx = _index["index"]
+    return idx.stats() if idx is not None else None
@@ -0,0 +1,128 @@
+# app/singleflight.py
+"""
+Coalescing "single-flight": si varias requests concurrentes piden el mismo
+cómputo (misma clave), solo una lo ejecuta y el resto espera y comparte el
+resultado (o la excepción). No es un caché: al terminar, la clave se libera.
+
+Los handlers son `def` síncronos (threadpool de uvicorn), por eso se usa
+threading y no asyncio.
+
+El líder corre con los cortes 304 suspendidos (http_cache.suspend_not_modified):
+el resultado y las excepciones se comparten, un 304 es solo de su request.
+
+Los grupos cpu_bound (fits) ejecutan al líder dentro de una concesión de
+hilos (app/cpu_budget.py); quienes esperan el resultado no toman fichas, y si
+ya tenían una concesión (un fit anidado en el scoring) la devuelven mientras
+esperan: el líder puede necesitar esas fichas.
+"""
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+import hashlib
+import threading
+
+import numpy as np
+import pandas as pd
+
+from . import artifacts, cpu_budget
+
+
+class _Call:
+    __slots__ = ("event", "result", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    def __init__(self, name: str, cpu_bound: bool = False):
+        self.name = name
+        self.cpu_bound = cpu_bound
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, _Call] = {}
+        self.executed = 0   # cómputos reales
+        self.shared = 0     # requests que reutilizaron un cómputo en vuelo
+
+    def do(self, key: Hashable, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.shared += 1
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                self.executed += 1
+                leader = True
+
+        if not leader:
+            with cpu_budget.idle():
+                call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        from . import http_cache  # import tardío: http_cache importa este módulo
+
+        try:
+            # NotModified (304 de esta request) no debe llegar a los que esperan el resultado
+            with http_cache.suspend_not_modified():
+                if self.cpu_bound:
+                    with cpu_budget.threads():
+                        call.result = fn(*args, **kwargs)
+                else:
+                    call.result = fn(*args, **kwargs)
+        except BaseException as exc:
+            call.error = exc
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+        return call.result
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            in_flight = len(self._calls)
+        return {"executed": self.executed, "shared": self.shared, "in_flight": in_flight}
+
+
+# Grupos usados por el servicio
+upstreams = SingleFlight("upstreams")   # fetch_plazos / fetch_docs
+enrichment = SingleFlight("enrichment")  # enrich_plazos_with_docs
+fits = SingleFlight("fits", cpu_bound=True)             # (modelo, params, datos) -> estimador ajustado
+features = SingleFlight("features")     # (snapshot, columnas) -> features.FeatureMatrix
+
+
+def fingerprint(*parts: Any) -> str:
+    """
+    Huella estable de datos + parámetros. Soporta DataFrame/Series (hash por
+    fila de pandas), ndarray (bytes) y cualquier otro valor vía repr().
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for p in parts:
+        if isinstance(p, (pd.DataFrame, pd.Series)):
+            h.update(repr(list(p.columns) if isinstance(p, pd.DataFrame) else p.name).encode())
+            h.update(pd.util.hash_pandas_object(p, index=True).values.tobytes())
+        elif isinstance(p, np.ndarray):
+            arr = np.ascontiguousarray(p)
+            h.update(repr((arr.shape, arr.dtype.str)).encode())
+            h.update(arr.tobytes())
+        else:
+            h.update(repr(p).encode())
+        h.update(b"|")
+    return h.hexdigest()
+
+
+def shared_fit(key: Tuple, X: Any, fn: Callable[[], Any]) -> Any:
+    """
+    Ejecuta `fn` (un fit) una sola vez por (key, datos): entre requests
+    concurrentes de este proceso (single-flight) y, si ARTIFACTS_DIR está
+    configurado, entre workers/réplicas vía el almacén de artefactos.
+    """
+    data_fp = fingerprint(X)
+    return fits.do((key, data_fp), artifacts.load_or_fit, str(key[0]), fingerprint(key, data_fp), fn)
+
+
+def stats() -> Dict[str, Dict[str, Any]]:
+    return {g.name: g.stats() for g in (upstreams, enrichment, fits, features)}
@@ -0,0 +1,222 @@
+# app/snapshot.py
+"""
+Snapshots "last-good" en disco de los DataFrames que sirve el servicio
+(plazos enriquecidos y documentos) para arrancar en caliente y para cubrir
+caídas de upstreams.
+
+Formato columnar sin dependencias extra, en la línea de artifacts.py: un
+directorio por versión con un archivo por columna, cargado con
+np.load(mmap_mode="r"):
+
+- numéricas / bool      -> <col>.npy
+- datetime64            -> <col>.npy (int64 ns; NaT = mínimo int64)
+- category              -> <col>.codes.npy + categorías en el manifest
+- texto (str / None)    -> <col>.text.npy (UTF-8) + <col>.offsets.npy + <col>.null.npy
+- otros object          -> <col>.obj.npy (pickle; p. ej. ids mixtos)
+
+SNAPSHOT_DIR/<name>/<versión>/ + SNAPSHOT_DIR/<name>/CURRENT (nombre de la
+versión vigente, reemplazado de forma atómica). Solo se guardan datos
+completos (sin upstream_errors). Si SNAPSHOT_DIR no está definido (ni
+ARTIFACTS_DIR), los snapshots quedan desactivados.
+"""
+from typing import Any, Dict, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+
+import numpy as np
+import pandas as pd
+
+from .artifacts import ARTIFACTS_DIR
+from .singleflight import fingerprint
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", os.path.join(ARTIFACTS_DIR, "snapshots") if ARTIFACTS_DIR else "")
+SNAPSHOT_MIN_INTERVAL_S = float(os.getenv("SNAPSHOT_MIN_INTERVAL_S", "300"))  # entre escrituras por nombre
+SNAPSHOT_KEEP = int(os.getenv("SNAPSHOT_KEEP", "2"))
+
+_MANIFEST = "manifest.json"
+_CURRENT = "CURRENT"
+
+_lock = threading.Lock()
+_loaded: Dict[str, Tuple[str, pd.DataFrame, Dict[str, Any]]] = {}  # name -> (versión, df, meta)
+_last_write: Dict[str, float] = {}
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="snapshot")
+_stats = {"writes": 0, "write_errors": 0, "loads": 0, "served": 0}
+
+
+def enabled() -> bool:
+    return bool(SNAPSHOT_DIR)
+
+
+# ----------------------------------------------------------------------
+# Columnas <-> archivos
+# ----------------------------------------------------------------------
+def _is_text(values: np.ndarray) -> bool:
+    return all(v is None or isinstance(v, str) for v in values)
+
+
+def _write_frame(df: pd.DataFrame, path: str) -> Dict[str, Any]:
+    columns = []
+    for i, col in enumerate(df.columns):
+        s = df[col]
+        base = os.path.join(path, f"c{i}")
+        spec: Dict[str, Any] = {"name": col, "file": f"c{i}", "dtype": str(s.dtype)}
+        if isinstance(s.dtype, pd.CategoricalDtype):
+            spec["kind"] = "category"
+            spec["categories"] = s.cat.categories.tolist()
+            np.save(base + ".codes.npy", s.cat.codes.to_numpy())
+        elif pd.api.types.is_datetime64_dtype(s.dtype):
+            spec["kind"] = "datetime"
+            np.save(base + ".npy", s.to_numpy(dtype="datetime64[ns]").view("int64"))
+        elif s.to_numpy().dtype != object:
+            spec["kind"] = "numeric"
+            np.save(base + ".npy", s.to_numpy())
+        else:
+            values = s.to_numpy()
+            if _is_text(values):
+                spec["kind"] = "text"
+                null = pd.isna(values)
+                texts = ["" if n else v for v, n in zip(values, null)]
+                offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+                offsets[1:] = np.cumsum([len(t) for t in texts])  # offsets en caracteres
+                np.save(base + ".text.npy", np.frombuffer("".join(texts).encode("utf-8"), dtype=np.uint8))
+                np.save(base + ".offsets.npy", offsets)
+                np.save(base + ".null.npy", null)
+            else:
+                spec["kind"] = "object"
+                np.save(base + ".obj.npy", values, allow_pickle=True)
+        columns.append(spec)
+    return {"columns": columns, "rows": int(len(df))}
+
+
+def _read_column(path: str, spec: Dict[str, Any]) -> Any:
+    base = os.path.join(path, spec["file"])
+    kind = spec["kind"]
+    if kind == "category":
+        codes = np.load(base + ".codes.npy", mmap_mode="r")
+        return pd.Categorical.from_codes(codes, categories=spec["categories"])
+    if kind == "datetime":
+        return np.load(base + ".npy", mmap_mode="r").view("datetime64[ns]")
+    if kind == "numeric":
+        return np.load(base + ".npy", mmap_mode="r")
+    if kind == "text":
+        text = np.load(base + ".text.npy", mmap_mode="r").tobytes().decode("utf-8")
+        offsets = np.load(base + ".offsets.npy", mmap_mode="r").tolist()
+        null = np.load(base + ".null.npy", mmap_mode="r")
+        out = np.array([text[a:b] for a, b in zip(offsets[:-1], offsets[1:])], dtype=object)
+        out[null] = None
+        return out
+    return np.load(base + ".obj.npy", allow_pickle=True)
+
+
+def _read_frame(path: str) -> Tuple[pd.DataFrame, Dict[str, Any]]:
+    with open(os.path.join(path, _MANIFEST)) as fh:
+        manifest = json.load(fh)
+    data = {spec["name"]: _read_column(path, spec) for spec in manifest["columns"]}
+    # copy=False: un bloque por columna sobre su mmap (sin consolidar, que copiaría a memoria)
+    return pd.DataFrame(data, columns=[spec["name"] for spec in manifest["columns"]], copy=False), manifest
+
+
+# ----------------------------------------------------------------------
+# Lectura / escritura de versiones
+# ----------------------------------------------------------------------
+def _current_version(name: str) -> Optional[str]:
+    try:
+        with open(os.path.join(SNAPSHOT_DIR, name, _CURRENT)) as fh:
+            return fh.read().strip() or None
+    except OSError:
+        return None
+
+
+def load(name: str) -> Optional[Tuple[pd.DataFrame, Dict[str, Any]]]:
+    """Última versión guardada de `name` (cacheada en el proceso mientras no cambie CURRENT)."""
+    if not enabled():
+        return None
+    version = _current_version(name)
+    if version is None:
+        return None
+    with _lock:
+        cached = _loaded.get(name)
+        if cached is not None and cached[0] == version:
+            return cached[1], cached[2]
+    try:
+        df, manifest = _read_frame(os.path.join(SNAPSHOT_DIR, name, version))
+    except Exception:
+        logger.exception("Snapshot ilegible %s/%s", name, version)
+        return None
+    df.attrs["upstream_errors"] = {}
+    with _lock:
+        _loaded[name] = (version, df, manifest)
+        _stats["loads"] += 1
+    return df, manifest
+
+
+def _save(name: str, df: pd.DataFrame, meta: Dict[str, Any]) -> None:
+    root = os.path.join(SNAPSHOT_DIR, name)
+    version = f"{int(time.time() * 1000)}-{uuid.uuid4().hex[:8]}"
+    tmp = os.path.join(root, f".tmp-{version}")
+    try:
+        os.makedirs(tmp)
+        manifest = {**_write_frame(df, tmp), "meta": meta, "created_at": time.time(), "pid": os.getpid(),
+                    "fingerprint": df.attrs.get("fingerprint") or fingerprint(df)}
+        with open(os.path.join(tmp, _MANIFEST), "w") as fh:
+            json.dump(manifest, fh)
+        os.rename(tmp, os.path.join(root, version))
+        pointer = os.path.join(root, f".{_CURRENT}-{version}")
+        with open(pointer, "w") as fh:
+            fh.write(version)
+        os.replace(pointer, os.path.join(root, _CURRENT))  # atómico
+        _stats["writes"] += 1
+        _prune(root, version)
+    except Exception:
+        _stats["write_errors"] += 1
+        logger.exception("No se pudo guardar el snapshot %s", name)
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def _prune(root: str, current: str) -> None:
+    versions = sorted(d for d in os.listdir(root) if not d.startswith(".") and d != _CURRENT)
+    for old in versions[:-SNAPSHOT_KEEP] if SNAPSHOT_KEEP > 0 else []:
+        if old != current:
+            shutil.rmtree(os.path.join(root, old), ignore_errors=True)
+
+
+def offer(name: str, df: pd.DataFrame, meta: Optional[Dict[str, Any]] = None) -> bool:
+    """
+    Propone datos completos como nuevo snapshot. Se escriben en segundo plano
+    como mucho una vez cada SNAPSHOT_MIN_INTERVAL_S por nombre (barato llamarlo
+    en cada carga). Devuelve True si se programó una escritura.
+    """
+    if not enabled() or df.empty or df.attrs.get("upstream_errors"):
+        return False
+    now = time.time()
+    with _lock:
+        if now - _last_write.get(name, 0.0) < SNAPSHOT_MIN_INTERVAL_S:
+            return False
+        _last_write[name] = now
+    _writer.submit(_save, name, df.copy(), dict(meta or {}))
+    return True
+
+
+def info(manifest: Dict[str, Any]) -> Dict[str, Any]:
+    """Resumen para las respuestas: antigüedad del snapshot servido."""
+    return {"created_at": manifest["created_at"], "age_s": round(time.time() - manifest["created_at"], 1)}
+
+
+def resident_frames() -> Dict[str, pd.DataFrame]:
+    """Snapshots cargados en memoria (para /debug/memory)."""
+    with _lock:
+        return {name: df for name, (_, df, _) in _loaded.items()}
+
+
+def stats() -> Dict[str, Any]:
+    with _lock:
+        loaded = {name: {"version": v, "rows": len(df)} for name, (v, df, _) in _loaded.items()}
+    return {"enabled": enabled(), "dir": SNAPSHOT_DIR or None, "loaded": loaded, **_stats}
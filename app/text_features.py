@@ -0,0 +1,367 @@
+# app/text_features.py
+"""
+Backends de vectorización de texto (descripcion) para los pipelines de models.py.
+TEXT_BACKEND elige uno:
+
+- tfidf   (default): TfidfVectorizer ajustado en cada fit, como hasta ahora.
+- hashing: HashingVectorizer sin estado + IDF cacheado por corpus (en memoria y,
+  si ARTIFACTS_DIR está configurado, en el volumen compartido) y la matriz
+  transformada del fit en memoria (TEXT_HASHED_CACHE_SIZE). Un corpus ya visto
+  no se vuelve a tokenizar en fit ni en fit_transform.
+- vocab:   vocabulario persistente (término -> columna + frecuencia por
+  documento) que se actualiza de forma incremental: solo se tokenizan los
+  textos no vistos y los términos nuevos se agregan al final, así que los
+  índices de columna son estables entre fits. Cuenta a lo sumo
+  TEXT_VOCAB_SEEN_MAX textos: los que no se ven hace más tiempo (p. ej.
+  borrados) salen y se descuentan de las frecuencias. Se persiste en segundo
+  plano, una escritura por tanda de fits.
+
+En los tres casos transformar plazos nuevos no requiere refit. Con
+TEXT_N_JOBS > 1 la tokenización de hashing/vocab se reparte en chunks de
+TEXT_CHUNK_ROWS filas entre procesos (joblib).
+"""
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from collections import OrderedDict
+import hashlib
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import joblib
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from joblib import Parallel, delayed
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.feature_extraction.text import CountVectorizer, HashingVectorizer, TfidfVectorizer
+from sklearn.preprocessing import normalize
+from sklearn.utils.validation import check_is_fitted
+
+from . import artifacts, cpu_budget
+from .singleflight import fingerprint
+
+logger = logging.getLogger(__name__)
+
+TEXT_BACKEND = os.getenv("TEXT_BACKEND", "tfidf").strip().lower()
+TEXT_HASH_FEATURES = int(os.getenv("TEXT_HASH_FEATURES", str(2**18)))
+TEXT_VOCAB_MAX = int(os.getenv("TEXT_VOCAB_MAX", "5000"))
+TEXT_CHUNK_ROWS = int(os.getenv("TEXT_CHUNK_ROWS", "20000"))
+TEXT_N_JOBS = int(os.getenv("TEXT_N_JOBS", "1"))
+TEXT_IDF_CACHE_SIZE = int(os.getenv("TEXT_IDF_CACHE_SIZE", "8"))
+TEXT_HASHED_CACHE_SIZE = int(os.getenv("TEXT_HASHED_CACHE_SIZE", "2"))  # matrices del fit (0 = sin caché)
+TEXT_VOCAB_SEEN_MAX = int(os.getenv("TEXT_VOCAB_SEEN_MAX", "500000"))
+
+NGRAM_RANGE = (1, 2)
+BACKENDS = ("tfidf", "hashing", "vocab")
+
+
+# ----------------------------------------------------------------------
+# Helpers
+# ----------------------------------------------------------------------
+def _as_texts(X: Any) -> List[str]:
+    """Columna de texto (Series, DataFrame de una columna, lista) -> lista de str."""
+    if isinstance(X, pd.DataFrame):
+        X = X.iloc[:, 0]
+    return pd.Series(X, dtype=object).fillna("").astype(str).tolist()
+
+
+def chunked_transform(fn: Callable[[List[str]], sp.spmatrix], texts: List[str],
+                      n_jobs: Optional[int] = None) -> sp.csr_matrix:
+    """Aplica fn por chunks de TEXT_CHUNK_ROWS textos (en paralelo si n_jobs > 1, dentro del presupuesto de CPU) y apila."""
+    n_jobs = cpu_budget.n_jobs(TEXT_N_JOBS if n_jobs is None else n_jobs)
+    chunks = [texts[i:i + TEXT_CHUNK_ROWS] for i in range(0, len(texts), TEXT_CHUNK_ROWS)] or [texts]
+    if n_jobs == 1 or len(chunks) == 1:
+        parts = [fn(c) for c in chunks]
+    else:
+        parts = Parallel(n_jobs=n_jobs)(delayed(fn)(c) for c in chunks)
+    return sp.vstack(parts, format="csr")
+
+
+def _smooth_idf(doc_freq: np.ndarray, n_docs: int) -> np.ndarray:
+    # Misma fórmula que TfidfVectorizer(smooth_idf=True)
+    return np.log((1.0 + n_docs) / (1.0 + doc_freq)) + 1.0
+
+
+def _apply_idf(X: sp.csr_matrix, idf: np.ndarray) -> sp.csr_matrix:
+    X = X.astype(np.float64)
+    X.data *= idf[X.indices]
+    return normalize(X, copy=False)
+
+
+# ----------------------------------------------------------------------
+# Hashing + IDF cacheado
+# ----------------------------------------------------------------------
+_idf_cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+_hashed_cache: "OrderedDict[str, sp.csr_matrix]" = OrderedDict()  # misma clave: matriz TF-IDF del corpus
+_idf_lock = threading.Lock()
+
+
+def _cached_idf(key: str, compute: Callable[[], np.ndarray]) -> np.ndarray:
+    with _idf_lock:
+        if key in _idf_cache:
+            _idf_cache.move_to_end(key)
+            return _idf_cache[key]
+    idf = artifacts.load_or_compute_arrays("text_idf", key, lambda: {"idf": compute()})["idf"]
+    with _idf_lock:
+        _idf_cache[key] = idf
+        while len(_idf_cache) > TEXT_IDF_CACHE_SIZE:
+            _idf_cache.popitem(last=False)
+    return idf
+
+
+def _cached_matrix(key: str) -> Optional[sp.csr_matrix]:
+    with _idf_lock:
+        X = _hashed_cache.get(key)
+        if X is not None:
+            _hashed_cache.move_to_end(key)
+        return X
+
+
+def _store_matrix(key: str, X: sp.csr_matrix) -> None:
+    if TEXT_HASHED_CACHE_SIZE <= 0:
+        return
+    with _idf_lock:
+        _hashed_cache[key] = X
+        while len(_hashed_cache) > TEXT_HASHED_CACHE_SIZE:
+            _hashed_cache.popitem(last=False)
+
+
+class HashingTfidfVectorizer(TransformerMixin, BaseEstimator):
+    """TF-IDF sobre HashingVectorizer: sin vocabulario; el fit solo calcula (o recupera) el IDF."""
+
+    def __init__(self, n_features: int = TEXT_HASH_FEATURES, ngram_range: Tuple[int, int] = NGRAM_RANGE,
+                 n_jobs: Optional[int] = None):
+        self.n_features = n_features
+        self.ngram_range = ngram_range
+        self.n_jobs = n_jobs
+
+    def _hasher(self) -> HashingVectorizer:
+        return HashingVectorizer(n_features=self.n_features, ngram_range=self.ngram_range,
+                                 alternate_sign=False, norm=None)
+
+    def _hash(self, texts: List[str]) -> sp.csr_matrix:
+        return chunked_transform(self._hasher().transform, texts, self.n_jobs)
+
+    def _fit(self, texts: List[str]) -> Tuple[str, Optional[sp.csr_matrix]]:
+        key = fingerprint("hashing_idf", self.n_features, self.ngram_range, pd.Series(texts, dtype=object))
+        hashed: Dict[str, sp.csr_matrix] = {}
+
+        def compute() -> np.ndarray:
+            Xh = hashed["X"] = self._hash(texts)
+            # Filas CSR sin índices repetidos => bincount de índices = frecuencia por documento
+            doc_freq = np.bincount(Xh.indices, minlength=self.n_features)
+            return _smooth_idf(doc_freq, Xh.shape[0])
+
+        self.idf_ = np.asarray(_cached_idf(key, compute))
+        return key, hashed.get("X")
+
+    def fit(self, X, y=None):
+        self._fit(_as_texts(X))
+        return self
+
+    def fit_transform(self, X, y=None, **fit_params):
+        texts = _as_texts(X)
+        key, Xh = self._fit(texts)
+        Xt = _cached_matrix(key)
+        if Xt is None:
+            Xt = _apply_idf(Xh if Xh is not None else self._hash(texts), self.idf_)
+            _store_matrix(key, Xt)
+        return Xt.copy()  # la cacheada no se comparte con quien la modifique
+
+    def transform(self, X):
+        check_is_fitted(self, "idf_")
+        return _apply_idf(self._hash(_as_texts(X)), self.idf_)
+
+
+# ----------------------------------------------------------------------
+# Vocabulario persistente incremental
+# ----------------------------------------------------------------------
+_vocab_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="text-vocab")
+
+
+def _text_key(text: str) -> bytes:
+    return hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=8).digest()
+
+
+class SharedVocabulary:
+    """
+    Vocabulario compartido por proceso (y persistido en ARTIFACTS_DIR/text_vocab/
+    si está configurado): término -> columna, frecuencia por documento y huellas
+    de los textos ya contados (con sus columnas, para descontarlos al salir).
+    Tope de TEXT_VOCAB_MAX términos y de `max_seen` textos (LRU por último fit
+    que los vio).
+    """
+
+    def __init__(self, name: str, max_terms: int, ngram_range: Tuple[int, int],
+                 max_seen: int = TEXT_VOCAB_SEEN_MAX):
+        self.name = name
+        self.max_terms = max_terms
+        self.ngram_range = tuple(ngram_range)
+        self.max_seen = max_seen
+        self.terms: Dict[str, int] = {}
+        self.doc_freq = np.zeros(max_terms, dtype=np.int64)
+        self.n_docs = 0
+        self.seen: "OrderedDict[bytes, np.ndarray]" = OrderedDict()  # huella -> columnas contadas
+        self.updates = 0
+        self._lock = threading.Lock()
+        self._mtime = 0.0
+        self._save_pending = False
+
+    @property
+    def path(self) -> Optional[str]:
+        if not artifacts.enabled():
+            return None
+        key = fingerprint(self.name, self.max_terms, self.ngram_range)
+        return os.path.join(artifacts.ARTIFACTS_DIR, "text_vocab", f"{self.name}-{key}.joblib")
+
+    def _reload_locked(self) -> None:
+        path = self.path
+        if not path or not os.path.exists(path) or os.path.getmtime(path) <= self._mtime:
+            return
+        try:
+            state = joblib.load(path)
+        except Exception:
+            logger.exception("Vocabulario ilegible %s; se ignora", path)
+            return
+        if "updates" not in state:  # formato anterior (sin columnas por texto): se reconstruye
+            return
+        if state["updates"] >= self.updates:
+            self.terms, self.doc_freq = state["terms"], state["doc_freq"]
+            self.n_docs, self.seen, self.updates = state["n_docs"], state["seen"], state["updates"]
+            self._mtime = os.path.getmtime(path)
+
+    def _schedule_save_locked(self) -> None:
+        """Encola una escritura en segundo plano; los fits que llegan antes de que corra van en la misma."""
+        if not self.path or self._save_pending:
+            return
+        self._save_pending = True
+        _vocab_writer.submit(self._save)
+
+    def _save(self) -> None:
+        path = self.path
+        with self._lock:
+            self._save_pending = False
+            state = {"terms": dict(self.terms), "doc_freq": self.doc_freq.copy(), "n_docs": self.n_docs,
+                     "seen": OrderedDict(self.seen), "updates": self.updates}
+        tmp = f"{path}.tmp-{os.getpid()}"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            joblib.dump(state, tmp)
+            os.replace(tmp, path)  # atómico; si dos workers escriben, gana el último
+            with self._lock:
+                self._mtime = max(self._mtime, os.path.getmtime(path))
+        except Exception:
+            logger.exception("No se pudo guardar el vocabulario %s", path)
+
+    def _evict_locked(self) -> int:
+        """Saca los textos menos recientes sobre max_seen y los descuenta de doc_freq."""
+        evicted = 0
+        while len(self.seen) > self.max_seen:
+            _, cols = self.seen.popitem(last=False)
+            self.doc_freq[cols] -= 1
+            evicted += 1
+        self.n_docs -= evicted
+        return evicted
+
+    def partial_fit(self, texts: List[str]) -> int:
+        """Cuenta solo los textos no vistos (los vistos pasan a recientes); devuelve cuántos se agregaron."""
+        analyzer = CountVectorizer(ngram_range=self.ngram_range).build_analyzer()
+        with self._lock:
+            self._reload_locked()
+            added = 0
+            for text in texts:
+                k = _text_key(text)
+                if k in self.seen:
+                    self.seen.move_to_end(k)
+                    continue
+                cols = []
+                for tok in set(analyzer(text)):
+                    idx = self.terms.get(tok)
+                    if idx is None:
+                        if len(self.terms) >= self.max_terms:
+                            continue
+                        idx = self.terms[tok] = len(self.terms)
+                    self.doc_freq[idx] += 1
+                    cols.append(idx)
+                self.seen[k] = np.asarray(cols, dtype=np.int32)
+                added += 1
+            if added:
+                self.n_docs += added
+                self._evict_locked()
+                self.updates += 1
+                self._schedule_save_locked()
+            return added
+
+    def snapshot(self) -> Tuple[Dict[str, int], np.ndarray]:
+        """(vocabulario, idf) congelados para un estimador ajustado."""
+        with self._lock:
+            n = len(self.terms)
+            return dict(self.terms), _smooth_idf(self.doc_freq[:n], self.n_docs)
+
+
+_vocabularies: Dict[Tuple, SharedVocabulary] = {}
+_vocab_lock = threading.Lock()
+
+
+def shared_vocabulary(name: str, max_terms: int = TEXT_VOCAB_MAX,
+                      ngram_range: Tuple[int, int] = NGRAM_RANGE) -> SharedVocabulary:
+    key = (name, max_terms, tuple(ngram_range))
+    with _vocab_lock:
+        voc = _vocabularies.get(key)
+        if voc is None:
+            voc = _vocabularies[key] = SharedVocabulary(name, max_terms, ngram_range)
+        return voc
+
+
+class SharedVocabVectorizer(TransformerMixin, BaseEstimator):
+    """TF-IDF con el vocabulario compartido `name`; fit = actualización incremental + snapshot."""
+
+    def __init__(self, name: str = "descripcion", max_terms: int = TEXT_VOCAB_MAX,
+                 ngram_range: Tuple[int, int] = NGRAM_RANGE, n_jobs: Optional[int] = None):
+        self.name = name
+        self.max_terms = max_terms
+        self.ngram_range = ngram_range
+        self.n_jobs = n_jobs
+
+    def fit(self, X, y=None):
+        voc = shared_vocabulary(self.name, self.max_terms, self.ngram_range)
+        voc.partial_fit(_as_texts(X))
+        self.vocabulary_, self.idf_ = voc.snapshot()
+        return self
+
+    def transform(self, X):
+        check_is_fitted(self, "idf_")
+        texts = _as_texts(X)
+        if not self.vocabulary_:
+            return sp.csr_matrix((len(texts), 0))
+        cv = CountVectorizer(vocabulary=self.vocabulary_, ngram_range=self.ngram_range)
+        return _apply_idf(chunked_transform(cv.transform, texts, self.n_jobs), self.idf_)
+
+
+# ----------------------------------------------------------------------
+# Fábrica
+# ----------------------------------------------------------------------
+def feature_names(vectorizer) -> Optional[np.ndarray]:
+    """Término de cada columna del vectorizador ajustado; None con hashing (sin vocabulario)."""
+    if isinstance(vectorizer, SharedVocabVectorizer):
+        names = np.empty(len(vectorizer.vocabulary_), dtype=object)
+        for term, idx in vectorizer.vocabulary_.items():
+            names[idx] = term
+        return names
+    if hasattr(vectorizer, "get_feature_names_out"):
+        return vectorizer.get_feature_names_out()
+    return None
+
+
+def make_text_vectorizer(max_features: int = 500, backend: Optional[str] = None,
+                         ngram_range: Tuple[int, int] = NGRAM_RANGE):
+    """Vectorizador de `descripcion` según TEXT_BACKEND (max_features aplica a tfidf)."""
+    backend = TEXT_BACKEND if backend is None else backend
+    if backend == "hashing":
+        return HashingTfidfVectorizer(ngram_range=ngram_range)
+    if backend == "vocab":
+        return SharedVocabVectorizer(ngram_range=ngram_range)
+    if backend != "tfidf":
+        logger.warning("TEXT_BACKEND=%s desconocido (opciones: %s); se usa tfidf", backend, BACKENDS)
+    return TfidfVectorizer(max_features=max_features, ngram_range=ngram_range)
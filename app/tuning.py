@@ -0,0 +1,207 @@
+# app/tuning.py
+"""
+Búsqueda de hiperparámetros del modelo de riesgo (pipeline supervisado) con
+successive halving (HalvingGridSearchCV): todos los candidatos arrancan con
+pocas filas y solo los mejores (1/TUNE_FACTOR por ronda) siguen con más.
+
+- El paso "pre" (TF-IDF + numéricas) se cachea con joblib.Memory: candidatos
+  que solo difieren en el clasificador (C, max_iter) reutilizan la
+  tokenización del mismo fold/tamaño en vez de volver a tokenizar.
+- Candidatos y folds se reparten en TUNE_N_JOBS procesos (acotado a la
+  concesión de CPU; loky limita los hilos BLAS de cada worker).
+- El ganador se compara contra la config actual con los mismos folds sobre
+  todas las filas etiquetadas y, si no es peor, se promueve al pipeline servido
+  (models.promote_supervised_config) junto con sus métricas de CV.
+- Como job, la promoción ocurre en el worker; sin SUPERVISED_CONFIG_PATH no
+  llegaría al proceso API, así que jobs la repite al recibir el resultado
+  (apply_job_result).
+"""
+from typing import Any, Dict, List
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+from joblib import Memory
+from sklearn.experimental import enable_halving_search_cv  # noqa: F401
+from sklearn.model_selection import HalvingGridSearchCV, StratifiedKFold, cross_validate
+
+from . import cpu_budget
+from .models import (
+    RANDOM_STATE,
+    build_supervised_pipeline,
+    build_train_labels,
+    promote_supervised_config,
+    supervised_config,
+)
+
+TUNE_CV = int(os.getenv("TUNE_CV", "3"))
+TUNE_FACTOR = int(os.getenv("TUNE_FACTOR", "3"))
+TUNE_N_JOBS = int(os.getenv("TUNE_N_JOBS", "-1"))
+TUNE_SCORING = os.getenv("TUNE_SCORING", "roc_auc")
+TUNE_CACHE_DIR = os.getenv("TUNE_CACHE_DIR", "")  # vacío = directorio temporal por búsqueda
+
+# Métricas reportadas para el ganador y la config actual
+CV_METRICS = ("roc_auc", "average_precision", "balanced_accuracy")
+# Métrica que decide la promoción
+PROMOTE_KEY = TUNE_SCORING if TUNE_SCORING in CV_METRICS else "roc_auc"
+
+# Parámetro del grid -> clave de la config del pipeline (models.SUPERVISED_DEFAULTS)
+_GRID_TO_CONFIG = {
+    "pre__txt__max_features": "max_features",
+    "pre__txt__ngram_range": "ngram_range",
+    "clf__C": "C",
+    "clf__max_iter": "max_iter",
+}
+
+
+# ----------------------------------------------------------------------
+# Helpers
+# ----------------------------------------------------------------------
+def n_jobs_budget(n_jobs: int = TUNE_N_JOBS) -> int:
+    """n_jobs efectivo: -1 = los hilos de la concesión de CPU en curso (app/cpu_budget.py)."""
+    return cpu_budget.n_jobs(n_jobs)
+
+
+def param_grid(max_features: List[int], ngram_max: List[int], C: List[float],
+               max_iter: List[int]) -> Dict[str, List[Any]]:
+    return {
+        "pre__txt__max_features": sorted(set(max_features)),
+        "pre__txt__ngram_range": [(1, n) for n in sorted(set(ngram_max))],
+        "clf__C": sorted(set(C)),
+        "clf__max_iter": sorted(set(max_iter)),
+    }
+
+
+def _to_config(params: Dict[str, Any]) -> Dict[str, Any]:
+    cfg = {_GRID_TO_CONFIG[k]: v for k, v in params.items() if k in _GRID_TO_CONFIG}
+    if "ngram_range" in cfg:
+        cfg["ngram_range"] = list(cfg["ngram_range"])
+    return cfg
+
+
+def _cv_metrics(pipe, X, y, cv, n_jobs: int) -> Dict[str, Any]:
+    res = cross_validate(pipe, X, y, cv=cv, scoring=list(CV_METRICS), n_jobs=n_jobs, error_score=np.nan)
+    out: Dict[str, Any] = {}
+    for m in CV_METRICS:
+        scores = res[f"test_{m}"]
+        out[m] = round(float(np.nanmean(scores)), 4) if not np.isnan(scores).all() else None
+        out[f"{m}_std"] = round(float(np.nanstd(scores)), 4) if not np.isnan(scores).all() else None
+    out["fit_time_s"] = round(float(np.mean(res["fit_time"])), 3)
+    return out
+
+
+def _promotion_metrics(cv_metrics: Dict[str, Any], n_folds: int, n_labeled: int) -> Dict[str, Any]:
+    return {**cv_metrics, "scoring": PROMOTE_KEY, "cv": n_folds, "n_etiquetados": n_labeled}
+
+
+# ----------------------------------------------------------------------
+# Búsqueda
+# ----------------------------------------------------------------------
+def tune_supervised(
+    df: pd.DataFrame,
+    num_feats: List[str],
+    grid: Dict[str, List[Any]],
+    cv: int = TUNE_CV,
+    factor: int = TUNE_FACTOR,
+    n_jobs: int = TUNE_N_JOBS,
+    promote: bool = True,
+    random_state: int = RANDOM_STATE,
+) -> Dict[str, Any]:
+    t0 = time.perf_counter()
+    df_lab = build_train_labels(df)
+    if df_lab.empty:
+        return {"status": "Sin datos etiquetados; no hay nada que ajustar."}
+    X = df_lab[["descripcion"] + num_feats].reset_index(drop=True)
+    y = df_lab["y"].reset_index(drop=True)
+
+    # Cada fold necesita ambas clases
+    counts = y.value_counts()
+    n_folds = min(cv, int(counts.min())) if len(counts) == 2 else 0
+    if n_folds < 2:
+        return {
+            "status": f"Clases insuficientes para CV (conteos={counts.to_dict()}); se mantiene la config actual.",
+            "actual": supervised_config(),
+        }
+
+    current = supervised_config()["params"]
+    n_jobs = n_jobs_budget(n_jobs)
+    cache_dir = TUNE_CACHE_DIR or tempfile.mkdtemp(prefix="sw2ml-tune-")
+    try:
+        memory = Memory(cache_dir, verbose=0)
+        pipe = build_supervised_pipeline(num_feats, current, memory=memory)
+        # Parámetros que el backend de texto no expone (p. ej. max_features con hashing) se omiten
+        valid = pipe.get_params()
+        grid = {k: v for k, v in grid.items() if k in valid and v}
+        folds = StratifiedKFold(n_splits=n_folds, shuffle=True, random_state=random_state)
+
+        search = HalvingGridSearchCV(
+            pipe, grid, factor=factor, cv=folds, scoring=TUNE_SCORING, refit=False,
+            n_jobs=n_jobs, random_state=random_state, error_score=np.nan,
+        ).fit(X, y)
+
+        results = search.cv_results_
+        best = search.best_index_
+        winner = {**current, **_to_config(search.best_params_)}
+        # Ganador vs. actual: mismos folds, todas las filas etiquetadas
+        winner_cv = _cv_metrics(build_supervised_pipeline(num_feats, winner, memory=memory), X, y, folds, n_jobs)
+        current_cv = _cv_metrics(build_supervised_pipeline(num_feats, current, memory=memory), X, y, folds, n_jobs)
+    finally:
+        if not TUNE_CACHE_DIR:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+    better = (winner_cv[PROMOTE_KEY] or 0.0) >= (current_cv[PROMOTE_KEY] or 0.0)
+    promoted = persisted = False
+    if promote and better and winner != current:
+        persisted = promote_supervised_config(winner, _promotion_metrics(winner_cv, n_folds, int(len(y))))
+        promoted = True
+
+    iters = pd.DataFrame({"iter": results["iter"], "n_resources": results["n_resources"]})
+    rounds = iters.groupby("iter")["n_resources"].agg(n_candidatos="size", n_filas="first")
+    if persisted:
+        status = "Config ganadora promovida al pipeline servido."
+    elif promoted:
+        status = "Config ganadora promovida en este proceso (sin SUPERVISED_CONFIG_PATH no se persiste)."
+    elif winner == current:
+        status = "La config actual ya es la mejor."
+    elif not better:
+        status = "El ganador no mejora a la config actual en CV; no se promueve."
+    else:
+        status = "Búsqueda terminada (promote=false)."
+    return {
+        "status": status,
+        "n_etiquetados": int(len(y)),
+        "cv": n_folds,
+        "scoring": TUNE_SCORING,
+        "n_jobs": n_jobs,
+        "grid": {k: [list(v) if isinstance(v, tuple) else v for v in vals] for k, vals in grid.items()},
+        "n_candidatos": int(search.n_candidates_[0]),
+        "rondas": [{"iter": int(i), "n_candidatos": int(r.n_candidatos), "n_filas": int(r.n_filas)}
+                   for i, r in rounds.iterrows()],
+        "ganador": {
+            "config": winner,
+            "halving_score": round(float(results["mean_test_score"][best]), 4),
+            "cv": winner_cv,
+        },
+        "actual": {"config": current, "cv": current_cv},
+        "promovido": promoted,
+        "persistido": persisted,
+        "segundos": round(time.perf_counter() - t0, 2),
+    }
+
+
+def apply_job_result(result: Dict[str, Any]) -> None:
+    """
+    Lado API de un job de tuning. Si el worker promovió sin persistir (sin
+    SUPERVISED_CONFIG_PATH), el proceso API no se entera: se promueve aquí
+    el mismo ganador. Con la config persistida, supervised_config() ya la relee.
+    """
+    if not result.get("promovido") or result.get("persistido"):
+        return
+    winner = result["ganador"]
+    promote_supervised_config(winner["config"], _promotion_metrics(winner["cv"], result["cv"], result["n_etiquetados"]))
+    result["promovido_en"] = "api"
+    result["status"] = ("Config ganadora promovida al proceso API (sin SUPERVISED_CONFIG_PATH no se persiste: "
+                        "otros procesos o réplicas siguen con la anterior).")
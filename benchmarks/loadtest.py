@@ -0,0 +1,263 @@
+# benchmarks/loadtest.py
+"""
+Prueba de carga end-to-end contra la app FastAPI con tráfico mixto.
+
+Modo offline completo (levanta stub + app como subprocesos):
+    python -m benchmarks.loadtest --spawn --plazos 5000 --docs 10000 \
+        --upstream-latency-ms 150 --upstream-jitter-ms 50 \
+        --concurrency 8 --duration 60 --out load.json
+
+Contra una app ya levantada (RSS solo si se pasa --app-pid):
+    python -m benchmarks.loadtest --base-url http://127.0.0.1:8010 --app-pid 1234
+
+Reporta por endpoint: p50/p95/p99 de latencia, throughput, errores y RSS del
+proceso de la app (máximo observado al completar requests de ese endpoint).
+Con --per-endpoint además corre cada endpoint aislado y registra su pico de RSS.
+"""
+from typing import Any, Dict, List, Optional, Tuple
+import argparse
+import datetime as _dt
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+import requests
+
+# Endpoint -> peso en el tráfico mixto (aprox. lo que abre un dashboard)
+DEFAULT_MIX: Dict[str, float] = {
+    "/ml/supervisado/prob_riesgo": 3,
+    "/ml/no_supervisado/clusters?k=3": 2,
+    "/ml/no_supervisado/anomalias": 2,
+    "/docs/no_supervisado/clusters?k=3": 1,
+    "/docs/no_supervisado/anomalias": 1,
+    "/ml/regresion/plazos/dias_restantes": 1,
+    "/docs/regresion/size_mb": 1,
+    "/ml/deep/plazos/autoencoder?epochs=40": 1,
+    "/health": 2,
+}
+
+
+# ----------------------------------------------------------------------
+# RSS del proceso de la app
+# ----------------------------------------------------------------------
+def read_rss_mb(pid: int) -> Optional[float]:
+    """VmRSS (MB) desde /proc (Linux); None si no está disponible."""
+    try:
+        with open(f"/proc/{pid}/status") as fh:
+            for line in fh:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        return None
+    return None
+
+
+def _parse_mix(spec: Optional[str]) -> Dict[str, float]:
+    if not spec:
+        return dict(DEFAULT_MIX)
+    mix = {}
+    for part in spec.split(","):
+        path, _, w = part.rpartition("@") if "@" in part else (part, "", "")
+        mix[path.strip()] = float(w) if w else 1.0
+    return mix
+
+
+# ----------------------------------------------------------------------
+# Driver
+# ----------------------------------------------------------------------
+def _summarize(samples: List[Tuple[float, bool, Optional[float]]], wall_s: float) -> Dict[str, Any]:
+    lat = np.array([s[0] for s in samples], dtype=float) * 1000.0
+    ok = [s for s in samples if s[1]]
+    rss = [s[2] for s in samples if s[2] is not None]
+    out: Dict[str, Any] = {
+        "requests": len(samples),
+        "errors": len(samples) - len(ok),
+        "throughput_rps": len(samples) / wall_s if wall_s > 0 else None,
+    }
+    if len(lat):
+        out.update({
+            "p50_ms": float(np.percentile(lat, 50)),
+            "p95_ms": float(np.percentile(lat, 95)),
+            "p99_ms": float(np.percentile(lat, 99)),
+            "max_ms": float(lat.max()),
+            "mean_ms": float(lat.mean()),
+        })
+    if rss:
+        out["rss_mb_max"] = float(max(rss))
+        out["rss_mb_mean"] = float(sum(rss) / len(rss))
+    return out
+
+
+def run_load(
+    base_url: str,
+    mix: Dict[str, float],
+    duration_s: float,
+    concurrency: int,
+    app_pid: Optional[int] = None,
+    timeout_s: float = 120.0,
+    seed: int = 0,
+) -> Dict[str, Any]:
+    """Corre `concurrency` workers durante `duration_s` eligiendo endpoints según `mix`."""
+    paths = list(mix.keys())
+    weights = [mix[p] for p in paths]
+    samples: Dict[str, List[Tuple[float, bool, Optional[float]]]] = {p: [] for p in paths}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration_s
+    rss_peak = [read_rss_mb(app_pid) if app_pid else None]
+
+    def worker(wid: int) -> None:
+        rng = random.Random(seed + wid)
+        session = requests.Session()
+        while time.perf_counter() < deadline:
+            path = rng.choices(paths, weights=weights)[0]
+            t0 = time.perf_counter()
+            try:
+                r = session.get(base_url.rstrip("/") + path, timeout=timeout_s)
+                ok = r.status_code < 400
+            except Exception:
+                ok = False
+            elapsed = time.perf_counter() - t0
+            rss = read_rss_mb(app_pid) if app_pid else None
+            with lock:
+                samples[path].append((elapsed, ok, rss))
+                if rss is not None and (rss_peak[0] is None or rss > rss_peak[0]):
+                    rss_peak[0] = rss
+
+    t_start = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - t_start
+
+    all_samples = [s for v in samples.values() for s in v]
+    return {
+        "wall_s": wall,
+        "concurrency": concurrency,
+        "total": _summarize(all_samples, wall),
+        "rss_mb_peak": rss_peak[0],
+        "endpoints": {p: _summarize(v, wall) for p, v in samples.items() if v},
+    }
+
+
+# ----------------------------------------------------------------------
+# Subprocesos (stub + app) para modo offline
+# ----------------------------------------------------------------------
+def _wait_http(url: str, timeout_s: float = 60.0) -> None:
+    t_end = time.time() + timeout_s
+    while time.time() < t_end:
+        try:
+            if requests.get(url, timeout=2).status_code < 500:
+                return
+        except Exception:
+            pass
+        time.sleep(0.3)
+    raise RuntimeError(f"Timeout esperando {url}")
+
+
+def spawn_stack(args) -> Tuple[List[subprocess.Popen], str, int]:
+    stub_port, app_port = args.stub_port, args.app_port
+    stub = subprocess.Popen([
+        sys.executable, "-m", "benchmarks.stub_upstreams",
+        "--plazos", str(args.plazos), "--docs", str(args.docs),
+        "--latency-ms", str(args.upstream_latency_ms), "--jitter-ms", str(args.upstream_jitter_ms),
+        "--error-rate", str(args.upstream_error_rate), "--port", str(stub_port),
+    ])
+    _wait_http(f"http://127.0.0.1:{stub_port}/_stats")
+
+    env = dict(os.environ)
+    env["PLAZOS_ENDPOINT"] = f"http://127.0.0.1:{stub_port}/plazos"
+    env["DOCS_ENDPOINT"] = f"http://127.0.0.1:{stub_port}/admin/documentos"
+    app = subprocess.Popen([
+        sys.executable, "-m", "uvicorn", "app.main:app",
+        "--host", "127.0.0.1", "--port", str(app_port), "--log-level", "warning",
+    ], env=env)
+    base_url = f"http://127.0.0.1:{app_port}"
+    try:
+        _wait_http(base_url + "/health")
+    except RuntimeError:
+        app.terminate()
+        stub.terminate()
+        raise
+    return [app, stub], base_url, app.pid
+
+
+def main(argv: Optional[list] = None) -> None:
+    ap = argparse.ArgumentParser(description="Prueba de carga sw2-ml")
+    ap.add_argument("--base-url", default="http://127.0.0.1:8010")
+    ap.add_argument("--app-pid", type=int, help="PID de la app para muestrear RSS")
+    ap.add_argument("--mix", help='Ej: "/ml/supervisado/prob_riesgo@3,/health@1" (peso tras @)')
+    ap.add_argument("--duration", type=float, default=30.0, help="Segundos por fase")
+    ap.add_argument("--concurrency", type=int, default=8)
+    ap.add_argument("--timeout", type=float, default=120.0)
+    ap.add_argument("--per-endpoint", action="store_true", help="Además, una fase aislada por endpoint")
+    ap.add_argument("--out", default="load.json")
+    # Modo offline
+    ap.add_argument("--spawn", action="store_true", help="Levanta stub de upstreams + app localmente")
+    ap.add_argument("--plazos", type=int, default=2_000)
+    ap.add_argument("--docs", type=int, default=4_000)
+    ap.add_argument("--upstream-latency-ms", type=float, default=100.0)
+    ap.add_argument("--upstream-jitter-ms", type=float, default=30.0)
+    ap.add_argument("--upstream-error-rate", type=float, default=0.0)
+    ap.add_argument("--stub-port", type=int, default=9100)
+    ap.add_argument("--app-port", type=int, default=8010)
+    args = ap.parse_args(argv)
+
+    mix = _parse_mix(args.mix)
+    procs: List[subprocess.Popen] = []
+    base_url, app_pid = args.base_url, args.app_pid
+    if args.spawn:
+        procs, base_url, app_pid = spawn_stack(args)
+
+    report: Dict[str, Any] = {
+        "meta": {
+            "timestamp": _dt.datetime.utcnow().isoformat() + "Z",
+            "base_url": base_url,
+            "duration_s": args.duration,
+            "concurrency": args.concurrency,
+            "mix": mix,
+            "spawn": bool(args.spawn),
+            "upstream": {
+                "plazos": args.plazos, "docs": args.docs,
+                "latency_ms": args.upstream_latency_ms, "jitter_ms": args.upstream_jitter_ms,
+                "error_rate": args.upstream_error_rate,
+            } if args.spawn else None,
+        },
+    }
+    try:
+        report["mixed"] = run_load(base_url, mix, args.duration, args.concurrency,
+                                   app_pid=app_pid, timeout_s=args.timeout)
+        if args.per_endpoint:
+            report["isolated"] = {
+                path: run_load(base_url, {path: 1.0}, args.duration, args.concurrency,
+                               app_pid=app_pid, timeout_s=args.timeout)
+                for path in mix
+            }
+    finally:
+        for p in procs:
+            p.terminate()
+        for p in procs:
+            try:
+                p.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                p.kill()
+
+    with open(args.out, "w") as fh:
+        json.dump(report, fh, indent=2)
+
+    print(f"{'endpoint':<44} {'req':>6} {'err':>5} {'rps':>7} {'p50':>8} {'p95':>8} {'p99':>8} {'rss':>7}")
+    for path, s in report["mixed"]["endpoints"].items():
+        print(f"{path:<44} {s['requests']:>6} {s['errors']:>5} {s['throughput_rps']:>7.2f} "
+              f"{s.get('p50_ms', 0):>8.1f} {s.get('p95_ms', 0):>8.1f} {s.get('p99_ms', 0):>8.1f} "
+              f"{s.get('rss_mb_max', 0) or 0:>7.1f}")
+    print(f"Reporte guardado en {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,397 @@
+# benchmarks/micro.py
+"""
+Microbenchmarks de las etapas de features/modelos y del cómputo de cada router,
+sobre payloads sintéticos (ver benchmarks/synthetic.py).
+
+Uso:
+    python -m benchmarks.micro run --sizes 1000 10000 --out bench.json
+    python -m benchmarks.micro run --only flatten_plazos --sizes 1000000
+    python -m benchmarks.micro compare antes.json despues.json
+
+Cada benchmark tiene un tamaño máximo por defecto (los O(n²) no tienen sentido
+con 1M filas); --no-limits lo ignora.
+
+Cada benchmark se mide en frío (cachés en memoria del proceso vaciadas antes de
+cada repetición, ver reset_caches) y en caliente (repeticiones seguidas, con
+los cachés de la anterior): min_s / median_s y warm_min_s / warm_median_s.
+"""
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from contextlib import contextmanager
+from dataclasses import dataclass
+import argparse
+import datetime as _dt
+import gc
+import inspect
+import json
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import pandas as pd
+
+from .synthetic import SIZES, make_docs_payload, make_plazos_payload
+
+
+# ----------------------------------------------------------------------
+# Upstreams sintéticos
+# ----------------------------------------------------------------------
+@contextmanager
+def patched_upstreams(plazos_payload: Dict[str, Any], docs_payload: List[Dict[str, Any]]):
+    """
+    Reemplaza fetch_plazos/fetch_docs/fetch_sources/fetch_docs_pages en todos los módulos
+    de `app` que los importaron por nombre, para medir solo el cómputo (sin red). Con
+    `on_page` se devuelve una sola página transformada, como el cliente real.
+    """
+    import app.main  # noqa: F401  (carga todos los routers)
+
+    def fetch_sources(on_page=None, key=None):
+        if on_page is None:
+            return plazos_payload, docs_payload, {}
+        return [on_page["plazos"](plazos_payload["data"])], [on_page["docs"](docs_payload)], {}
+
+    fakes = {
+        "fetch_plazos": lambda *a, **kw: (plazos_payload, {}),
+        "fetch_docs": lambda *a, **kw: (docs_payload, {}),
+        "fetch_sources": fetch_sources,
+        "fetch_docs_pages": lambda on_page, key=None: ([on_page(docs_payload)], {}),
+    }
+    saved = []
+    for mod_name, mod in list(sys.modules.items()):
+        if mod is None or not (mod_name == "app" or mod_name.startswith("app.")):
+            continue
+        for attr, fake in fakes.items():
+            if hasattr(mod, attr):
+                saved.append((mod, attr, getattr(mod, attr)))
+                setattr(mod, attr, fake)
+    try:
+        yield
+    finally:
+        for mod, attr, original in saved:
+            setattr(mod, attr, original)
+
+
+# Estado en memoria del proceso que hace que una repetición reutilice la anterior.
+# singleflight no retiene resultados (solo las claves en vuelo): no hay nada que vaciar.
+_CACHES = (
+    ("app.scored", "_cache"),
+    ("app.features", "_matrices"),
+    ("app.features", "_timelines"),
+    ("app.models", "_text_matrices"),
+    ("app.text_features", "_idf_cache"),
+    ("app.text_features", "_hashed_cache"),
+    ("app.text_features", "_vocabularies"),
+    ("app.online_ols", "_engines"),
+    ("app.artifacts", "_memo"),
+    ("app.snapshot", "_loaded"),
+)
+
+
+def reset_caches() -> None:
+    """Vacía los cachés en memoria de `app` (medición en frío; ARTIFACTS_DIR en disco no se toca)."""
+    for mod_name, attr in _CACHES:
+        mod = sys.modules.get(mod_name)
+        if mod is not None:
+            getattr(mod, attr).clear()
+    similarity = sys.modules.get("app.similarity")
+    if similarity is not None:
+        similarity._index["index"] = None
+
+
+def call_route(fn: Callable, **overrides) -> Any:
+    """Llama a un handler de FastAPI resolviendo los defaults de Query(...)."""
+    kwargs = {}
+    for name, p in inspect.signature(fn).parameters.items():
+        if name in overrides:
+            kwargs[name] = overrides[name]
+        elif p.default is not inspect.Parameter.empty:
+            kwargs[name] = getattr(p.default, "default", p.default)
+    return fn(**kwargs)
+
+
+# ----------------------------------------------------------------------
+# Definición de benchmarks
+# ----------------------------------------------------------------------
+@dataclass
+class Bench:
+    name: str
+    # setup(ctx) -> callable sin argumentos a medir. ctx trae payloads y frames ya calculados.
+    setup: Callable[[Dict[str, Any]], Callable[[], Any]]
+    max_n: int = SIZES[-1]
+    routes: bool = False  # requiere upstreams parcheados
+
+
+def _features():
+    from app import features
+    return features
+
+
+def _models():
+    from app import models
+    return models
+
+
+def _setup_enriched(ctx: Dict[str, Any]) -> Tuple[pd.DataFrame, List[str]]:
+    if "enriched" not in ctx:
+        with patched_upstreams(ctx["plazos"], ctx["docs"]):
+            ctx["enriched"] = _features().enrich_plazos_with_docs(ctx["df_plazos"])
+    return ctx["enriched"]
+
+
+def _bench_enrich(ctx):
+    f = _features()
+
+    def run():
+        with patched_upstreams(ctx["plazos"], ctx["docs"]):
+            return f.enrich_plazos_with_docs(ctx["df_plazos"])
+    return run
+
+
+def _bench_labels(ctx):
+    df, _ = _setup_enriched(ctx)
+    return lambda: _models().build_train_labels(df)
+
+
+def _bench_score(ctx):
+    df, num_feats = _setup_enriched(ctx)
+    m = _models()
+    model, _ = m.ensure_supervised_model(df, num_feats)
+    return lambda: m.score_supervised(df, model, num_feats)
+
+
+def _bench_near_dup(ctx):
+    df = ctx["df_docs"]
+    return lambda: _models().near_duplicate_pairs(df["filename"], df["size_mb"], 0.85, 50)
+
+
+def _bench_text(backend: str):
+    def setup(ctx):
+        from app.text_features import make_text_vectorizer
+        texts = ctx["df_plazos"]["descripcion"]
+        return lambda: make_text_vectorizer(500, backend=backend).fit_transform(texts)
+    return setup
+
+
+def _route(module: str, fn_name: str, **overrides):
+    def setup(ctx):
+        import importlib
+        mod = importlib.import_module(module)
+        fn = getattr(mod, fn_name)
+
+        def run():
+            with patched_upstreams(ctx["plazos"], ctx["docs"]):
+                return call_route(fn, **overrides)
+        return run
+    return setup
+
+
+BENCHES: List[Bench] = [
+    Bench("flatten_plazos", lambda ctx: (lambda: _features().flatten_plazos(ctx["plazos"]))),
+    Bench("flatten_docs", lambda ctx: (lambda: _features().flatten_docs(ctx["docs"]))),
+    Bench("aggregate_docs_per_expediente",
+          lambda ctx: (lambda: _features().aggregate_docs_per_expediente(ctx["df_docs"]))),
+    Bench("enrich_plazos_with_docs", _bench_enrich),
+    Bench("build_train_labels", _bench_labels),
+    Bench("text_fit_transform:tfidf", _bench_text("tfidf")),
+    Bench("text_fit_transform:hashing", _bench_text("hashing")),
+    Bench("text_fit_transform:vocab", _bench_text("vocab")),
+    Bench("score_supervised", _bench_score, max_n=100_000),
+    Bench("near_duplicate_pairs", _bench_near_dup, max_n=1_000),
+    # Cómputo completo de cada router (con upstreams en memoria)
+    Bench("route:supervisado.prob_riesgo", _route("app.routers.supervisado", "prob_riesgo"),
+          max_n=100_000, routes=True),
+    Bench("route:no_supervisado.clusters", _route("app.routers.nosupervisado", "clusters"),
+          max_n=100_000, routes=True),
+    Bench("route:no_supervisado.anomalias", _route("app.routers.nosupervisado", "anomalias", explain=True),
+          max_n=100_000, routes=True),
+    Bench("route:docs.clusters", _route("app.routers.docs_analytics", "docs_clusters"),
+          max_n=100_000, routes=True),
+    Bench("route:docs.anomalias", _route("app.routers.docs_analytics", "docs_anomalias", explain=True),
+          max_n=100_000, routes=True),
+    Bench("route:docs.near_duplicados", _route("app.routers.docs_analytics", "docs_near_duplicados"),
+          max_n=1_000, routes=True),
+    Bench("route:regresion.plazos", _route("app.routers.regresion", "reg_plazos_dias_restantes"),
+          max_n=100_000, routes=True),
+    Bench("route:regresion.docs", _route("app.routers.regresion", "reg_docs_size_mb"),
+          max_n=100_000, routes=True),
+    Bench("route:deep.plazos_autoencoder", _route("app.routers.deep", "deep_plazos_autoencoder"),
+          max_n=100_000, routes=True),
+    Bench("route:deep.docs_autoencoder", _route("app.routers.deep", "deep_docs_autoencoder"),
+          max_n=100_000, routes=True),
+]
+
+
+# ----------------------------------------------------------------------
+# Medición
+# ----------------------------------------------------------------------
+def _time_it(run: Callable[[], Any], repeat: int, cold: bool = True) -> List[float]:
+    """Tiempos de `repeat` ejecuciones; en frío se vacían los cachés antes de cada una (fuera del tiempo)."""
+    times = []
+    for _ in range(repeat):
+        if cold:
+            reset_caches()
+        gc.collect()
+        t0 = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - t0)
+    return times
+
+
+def _peak_mem_mb(run: Callable[[], Any]) -> float:
+    """Pico de memoria asignada (Python + NumPy, vía tracemalloc) durante una ejecución en frío."""
+    reset_caches()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / (1024.0 * 1024.0)
+
+
+def _maxrss_mb() -> float:
+    # Linux reporta KiB, macOS bytes
+    r = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return r / (1024.0 * 1024.0) if sys.platform == "darwin" else r / 1024.0
+
+
+def _meta(seed: int, anchor: pd.Timestamp) -> Dict[str, Any]:
+    import numpy, sklearn
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                                text=True, timeout=5).stdout.strip() or None
+    except Exception:
+        commit = None
+    return {
+        "timestamp": _dt.datetime.utcnow().isoformat() + "Z",
+        "git_commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "numpy": numpy.__version__,
+        "pandas": pd.__version__,
+        "sklearn": sklearn.__version__,
+        "seed": seed,
+        "anchor": anchor.isoformat(),
+    }
+
+
+def run_benchmarks(
+    sizes: List[int],
+    only: Optional[List[str]] = None,
+    repeat: int = 3,
+    seed: int = 0,
+    no_limits: bool = False,
+    memory: bool = True,
+) -> Dict[str, Any]:
+    anchor = pd.Timestamp.now().normalize()
+    selected = [b for b in BENCHES if not only or any(o in b.name for o in only)]
+    results: List[Dict[str, Any]] = []
+
+    for n in sizes:
+        todo = [b for b in selected if no_limits or n <= b.max_n]
+        if not todo:
+            continue
+        f = _features()
+        ctx: Dict[str, Any] = {
+            "plazos": make_plazos_payload(n, seed=seed, anchor=anchor),
+            "docs": make_docs_payload(n, seed=seed, anchor=anchor),
+        }
+        ctx["df_plazos"] = f.flatten_plazos(ctx["plazos"])
+        ctx["df_docs"] = f.flatten_docs(ctx["docs"])
+
+        for b in todo:
+            run = b.setup(ctx)
+            # Repeticiones menores en tamaños grandes
+            reps = repeat if n <= 10_000 else 1
+            times = _time_it(run, reps)
+            warm = _time_it(run, reps, cold=False)  # la última en frío dejó los cachés cargados
+            entry = {
+                "name": b.name,
+                "n": n,
+                "repeat": reps,
+                "seconds": times,
+                "min_s": min(times),
+                "median_s": statistics.median(times),
+                "rows_per_s": n / min(times) if min(times) > 0 else None,
+                "warm_seconds": warm,
+                "warm_min_s": min(warm),
+                "warm_median_s": statistics.median(warm),
+            }
+            if memory:
+                entry["peak_alloc_mb"] = _peak_mem_mb(run)
+            entry["maxrss_mb"] = _maxrss_mb()
+            results.append(entry)
+            print(f"{b.name:<36} n={n:<8} min={entry['min_s']:.4f}s warm={entry['warm_min_s']:.4f}s"
+                  + (f" peak={entry['peak_alloc_mb']:.1f}MB" if memory else ""), flush=True)
+        del ctx
+        gc.collect()
+
+    return {"meta": _meta(seed, anchor), "results": results}
+
+
+def compare(path_a: str, path_b: str) -> List[Dict[str, Any]]:
+    """Compara dos corridas (A = base, B = nueva) por (name, n)."""
+    with open(path_a) as fa, open(path_b) as fb:
+        a, b = json.load(fa), json.load(fb)
+    idx_a = {(r["name"], r["n"]): r for r in a["results"]}
+    rows = []
+    for r in b["results"]:
+        base = idx_a.get((r["name"], r["n"]))
+        if not base:
+            continue
+        row = {
+            "name": r["name"],
+            "n": r["n"],
+            "min_s_a": base["min_s"],
+            "min_s_b": r["min_s"],
+            "speedup": base["min_s"] / r["min_s"] if r["min_s"] > 0 else None,
+        }
+        if "warm_min_s" in base and "warm_min_s" in r:
+            row["warm_min_s_a"] = base["warm_min_s"]
+            row["warm_min_s_b"] = r["warm_min_s"]
+        if "peak_alloc_mb" in base and "peak_alloc_mb" in r:
+            row["peak_mb_a"] = base["peak_alloc_mb"]
+            row["peak_mb_b"] = r["peak_alloc_mb"]
+        rows.append(row)
+    return rows
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    ap = argparse.ArgumentParser(description="Microbenchmarks sw2-ml")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    r = sub.add_parser("run")
+    r.add_argument("--sizes", type=int, nargs="+", default=list(SIZES))
+    r.add_argument("--only", nargs="*", help="Subcadenas de nombres de benchmark a correr")
+    r.add_argument("--repeat", type=int, default=3)
+    r.add_argument("--seed", type=int, default=0)
+    r.add_argument("--no-limits", action="store_true")
+    r.add_argument("--no-memory", action="store_true", help="Omite la pasada con tracemalloc")
+    r.add_argument("--out", default="bench.json")
+
+    c = sub.add_parser("compare")
+    c.add_argument("a")
+    c.add_argument("b")
+
+    args = ap.parse_args(argv)
+    if args.cmd == "run":
+        out = run_benchmarks(args.sizes, only=args.only, repeat=args.repeat, seed=args.seed,
+                             no_limits=args.no_limits, memory=not args.no_memory)
+        with open(args.out, "w") as fh:
+            json.dump(out, fh, indent=2)
+        print(f"Resultados guardados en {args.out}")
+    else:
+        for row in compare(args.a, args.b):
+            sp = row["speedup"]
+            print(f"{row['name']:<36} n={row['n']:<8} {row['min_s_a']:.4f}s -> {row['min_s_b']:.4f}s"
+                  + (f"  x{sp:.2f}" if sp else "")
+                  + (f"  (caliente {row['warm_min_s_a']:.4f}s -> {row['warm_min_s_b']:.4f}s)"
+                     if "warm_min_s_a" in row else ""))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,454 @@
+# benchmarks/parity.py
+"""
+Comprobaciones de paridad: las versiones optimizadas deben devolver lo mismo
+que la implementación original (copiada aquí como referencia) sobre datos
+sintéticos. El repo no tiene suite de tests; esto se corre a mano o en CI:
+
+    python -m benchmarks.parity
+    python -m benchmarks.parity --only aggregate_docs --sizes 1000 100000
+
+Sale con código 1 si alguna comprobación falla.
+"""
+from typing import Callable, Dict, List, Optional
+import argparse
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from .synthetic import make_docs_payload, make_plazos_payload
+
+
+# ----------------------------------------------------------------------
+# Referencias (implementación original)
+# ----------------------------------------------------------------------
+def _ref_aggregate_docs_per_expediente(df_docs: pd.DataFrame) -> pd.DataFrame:
+    from app.features import now_ts
+
+    agg = df_docs.groupby("id_expediente").agg(
+        docs_count_exp=("doc_id", "count"),
+        docs_total_size_mb=("size_mb", "sum"),
+        last_doc=("created_at", "max"),
+        pdf_count=("file_ext", lambda s: (s.str.lower() == "pdf").sum()),
+    ).reset_index()
+    today = now_ts()
+    delta = today - agg["last_doc"]
+    agg["days_since_last_doc"] = delta.dt.days
+    agg["recent_docs_7d"] = agg["last_doc"].apply(lambda x: int(pd.notna(x) and (today - x).days <= 7))
+    agg["pdf_ratio_exp"] = np.where(agg["docs_count_exp"] > 0, agg["pdf_count"] / agg["docs_count_exp"], 0.0)
+    return agg.drop(columns=["last_doc", "pdf_count"])
+
+
+def _ref_top_k_reasons(x_row: pd.Series, mu: pd.Series, sigma: pd.Series, feats: List[str], k: int = 3):
+    z = (x_row[feats] - mu[feats]) / sigma[feats]
+    absz = z.abs().sort_values(ascending=False)
+    return [{"feature": f, "value": float(x_row[f]), "zscore": float(z[f])} for f in absz.index[:k]]
+
+
+def _ref_build_train_labels(df: pd.DataFrame) -> pd.DataFrame:
+    if df.empty:
+        return df
+
+    def label_row(row):
+        fv = row["fecha_vencimiento"]   # Timestamp o NaT
+        fc = row["fecha_cumplimiento"]  # Timestamp o NaT
+        cumplido = row["cumplido"]
+        todayd = pd.Timestamp.now().normalize()
+
+        if cumplido:
+            if pd.isna(fc) or pd.isna(fv):
+                return None
+            return 1 if fc > fv else 0
+        else:
+            if pd.isna(fv):
+                return None
+            return 1 if todayd > fv else None
+
+    y = df.apply(label_row, axis=1)
+    df_lab = df.copy()
+    df_lab["y"] = y
+    df_lab = df_lab[~df_lab["y"].isna()]
+    df_lab["y"] = df_lab["y"].astype(int)
+    return df_lab
+
+
+# ----------------------------------------------------------------------
+# Utilidades
+# ----------------------------------------------------------------------
+def assert_frames_close(got: pd.DataFrame, ref: pd.DataFrame, key: str, rtol: float = 1e-5) -> None:
+    """Mismas columnas y filas (ordenadas por `key`); numéricas con tolerancia relativa."""
+    assert list(got.columns) == list(ref.columns), f"columnas {list(got.columns)} != {list(ref.columns)}"
+    got = got.sort_values(key).reset_index(drop=True)
+    ref = ref.sort_values(key).reset_index(drop=True)
+    assert len(got) == len(ref), f"filas {len(got)} != {len(ref)}"
+    for c in ref.columns:
+        a, b = got[c], ref[c]
+        if pd.api.types.is_numeric_dtype(b):
+            ok = np.allclose(a.to_numpy(dtype=float), b.to_numpy(dtype=float), rtol=rtol, atol=1e-6, equal_nan=True)
+        else:
+            ok = a.astype(str).equals(b.astype(str))
+        assert ok, f"columna {c} difiere"
+
+
+def _docs_frame(n: int, seed: int = 0) -> pd.DataFrame:
+    from app.features import flatten_docs
+
+    df = flatten_docs(make_docs_payload(n, seed=seed), include_filename=False)
+    # Casos borde: sin fecha, extensión en mayúsculas, sin doc_id
+    k = max(1, n // 50)
+    df.loc[df.index[:k], "created_at"] = pd.NaT
+    df["file_ext"] = df["file_ext"].cat.add_categories(["PDF"])
+    df.loc[df.index[k:2 * k], "file_ext"] = "PDF"
+    df.loc[df.index[2 * k:3 * k], "doc_id"] = None
+    return df
+
+
+# ----------------------------------------------------------------------
+# Comprobaciones
+# ----------------------------------------------------------------------
+def check_aggregate_docs(n: int) -> None:
+    from app.features import aggregate_docs_per_expediente
+
+    df = _docs_frame(n)
+    ref = _ref_aggregate_docs_per_expediente(df)
+    assert_frames_close(aggregate_docs_per_expediente(df), ref, "id_expediente")
+
+
+def check_doc_timeline(n: int) -> None:
+    from app.features import DocTimelineIndex, aggregate_docs_per_expediente, now_ts
+
+    df = _docs_frame(n)
+    today = now_ts()
+    idx = DocTimelineIndex(df)
+    windows = (0, 7, 30, 90)
+    got = idx.features(windows, today)
+
+    # Referencia: un groupby completo por ventana
+    dated = df.dropna(subset=["id_expediente", "created_at"])
+    days = (today - dated["created_at"]).dt.days
+    g = dated.assign(days=days).groupby("id_expediente")
+    ref = pd.DataFrame({"id_expediente": g.size().index})
+    for w in windows:
+        ref[f"docs_last_{w}d"] = g["days"].apply(lambda d, w=w: int((d <= w).sum())).to_numpy()
+    first = g["created_at"].min()
+    ref["days_since_first_doc"] = (today - first).dt.days.to_numpy()
+    ref["docs_per_week"] = g.size().to_numpy() / np.maximum(ref["days_since_first_doc"] / 7.0, 1.0)
+    assert_frames_close(got, ref, "id_expediente")
+
+    # recent_docs_7d de los agregados == (docs_last_7d > 0)
+    agg = aggregate_docs_per_expediente(df).merge(got, on="id_expediente", how="left")
+    assert (agg["recent_docs_7d"] == (agg["docs_last_7d"].fillna(0) > 0).astype(int)).all(), "recent_docs_7d"
+
+
+def check_large_n(n: int) -> None:
+    from sklearn.ensemble import IsolationForest
+    from app.models import chunked_apply, stratified_sample_idx
+
+    rng = np.random.default_rng(0)
+    strata = rng.choice(["pdf", "docx", "png", None], size=n, p=[0.7, 0.2, 0.09, 0.01])
+    max_rows = max(10, n // 10)
+    idx = stratified_sample_idx(n, max_rows, strata, random_state=3)
+    assert len(idx) == max_rows and len(np.unique(idx)) == max_rows, "tamaño de muestra"
+    assert np.array_equal(idx, stratified_sample_idx(n, max_rows, strata, random_state=3)), "reproducible"
+    full = pd.Series(strata).value_counts(dropna=False, normalize=True)
+    got = pd.Series(strata[idx]).value_counts(dropna=False, normalize=True)
+    assert set(got.index) == set(full.index), "todos los estratos presentes"
+    assert (got.reindex(full.index) - full).abs().max() < 2.0 * len(full) / max_rows + 1e-9, "proporciones"
+
+    # Scoring por chunks == scoring de una vez (y labels == predict)
+    X = rng.normal(size=(n, 4))
+    iso = IsolationForest(n_estimators=50, random_state=0).fit(X[idx])
+    scores = chunked_apply(iso.score_samples, X, chunk_rows=max(1, n // 7))
+    assert np.allclose(scores, iso.score_samples(X)), "score por chunks"
+    assert np.array_equal(np.where(scores - iso.offset_ < 0, -1, 1), iso.predict(X)), "labels"
+
+
+def check_top_k_reasons(n: int) -> None:
+    from app.models import format_reasons, top_k_features, zscore_matrix
+
+    rng = np.random.default_rng(1)
+    feats = [f"f{i}" for i in range(8)]
+    X = pd.DataFrame(rng.normal(size=(n, len(feats))) * rng.uniform(0.1, 10, len(feats)), columns=feats)
+    X["f7"] = 1.0  # columna constante (sigma 0 -> 1e-9)
+    mu, sigma = X.mean(), X.std().replace(0, 1e-9)
+    Z = zscore_matrix(X.values)
+    for k in (1, 3, len(feats)):
+        top = top_k_features(np.abs(Z), k)
+        for i in np.linspace(0, n - 1, num=min(n, 200), dtype=int):
+            got = format_reasons(top, i, feats, {"value": X.values, "zscore": Z})
+            ref = _ref_top_k_reasons(X.iloc[i], mu, sigma, feats, k)
+            # Mismos |z| en el mismo orden (los empates pueden cambiar de feature)
+            assert np.allclose([abs(r["zscore"]) for r in got], [abs(r["zscore"]) for r in ref]), f"fila {i}, k={k}"
+            assert {r["feature"] for r in got} == {r["feature"] for r in ref} or k < len(feats), f"fila {i}"
+
+
+def check_feature_matrix(n: int) -> None:
+    from sklearn.preprocessing import StandardScaler
+    from app.features import FeatureMatrix
+
+    rng = np.random.default_rng(2)
+    df = pd.DataFrame({
+        "a": rng.normal(size=n) * 100,
+        "b": rng.integers(0, 5, size=n).astype("float32"),
+        "c": 1.0,                                    # varianza 0
+        "d": np.where(rng.random(n) < 0.1, np.nan, rng.exponential(size=n)),
+    })
+    cols = list(df.columns)
+    fm = FeatureMatrix(df[cols].to_numpy(dtype=float, na_value=0.0), cols, "parity")
+    X = df[cols].copy().astype(float).fillna(0.0)   # lo que hacía cada router
+    assert np.allclose(fm.X, X.values), "X"
+    assert np.allclose(fm.Xs, StandardScaler().fit_transform(X.values)), "Xs"
+    assert fm.X.flags.c_contiguous and not fm.Xs.flags.writeable, "contigua / solo lectura"
+
+    # varying() == filtro de los autoencoders (std ddof=0 > 1e-8) + escalado de esas columnas
+    stds = X.std(ddof=0)
+    keep = stds[stds > 1e-8].index.tolist()
+    sub = fm.varying()
+    assert sub.columns == keep, f"columnas {sub.columns} != {keep}"
+    assert np.allclose(sub.Xs, StandardScaler().fit_transform(X[keep].values)), "Xs de subset"
+    assert fm.row(n - 1) == {c: float(X.iloc[n - 1][c]) for c in cols}, "row"
+
+
+def check_train_labels(n: int) -> None:
+    from app.backtest import plazos_as_of
+    from app.features import flatten_plazos, now_ts
+    from app.models import build_train_labels
+
+    df = flatten_plazos(make_plazos_payload(n))
+    k = max(1, n // 50)
+    df.loc[df.index[:k], "fecha_vencimiento"] = pd.NaT       # sin vencimiento
+    df.loc[df.index[k:2 * k], "cumplido"] = True             # cumplidos sin fecha de cumplimiento
+    df.loc[df.index[k:2 * k], "fecha_cumplimiento"] = pd.NaT
+    got, ref = build_train_labels(df), _ref_build_train_labels(df)
+    assert got.index.equals(ref.index), "filas etiquetadas"
+    assert (got["y"] == ref["y"]).all() and got["y"].dtype == ref["y"].dtype, "etiquetas"
+
+    # Point-in-time a hoy: mismas etiquetas que el presente (sin los cumplidos sin fecha;
+    # el sintético trae fechas de cumplimiento futuras, que a hoy aún no se ven)
+    today = now_ts()
+    seen = df[~(df["fecha_cumplimiento"] > today)]
+    asof = build_train_labels(plazos_as_of(seen, today), today=today)
+    now = _ref_build_train_labels(seen)
+    now = now[~(now["cumplido"] & now["fecha_cumplimiento"].isna())]
+    assert (asof["y"].to_numpy() == now["y"].to_numpy()).all(), "as_of = hoy"
+    # Cumplimientos posteriores a la fecha de corte no se ven
+    past = today - pd.Timedelta(days=60)
+    snap = plazos_as_of(df, past)
+    assert not (snap["fecha_cumplimiento"] > past).any(), "sin cumplimientos futuros"
+    assert np.allclose(snap["days_to_due"].dropna(), (snap["fecha_vencimiento"] - past).dt.days.dropna()), "days_to_due"
+
+
+def check_similarity_index(n: int) -> None:
+    from app.similarity import SimilarityIndex
+
+    rng = np.random.default_rng(3)
+    words = np.array(["audiencia", "demanda", "alegatos", "recurso", "apelacion", "pericial",
+                      "notificacion", "prueba", "sentencia", "embargo", "contestacion", "informe"])
+    df = pd.DataFrame({
+        "id_plazo": np.arange(n),
+        "descripcion": [" ".join(rng.choice(words, 4)) for _ in range(n)],
+        "a": rng.normal(size=n),
+        "b": rng.exponential(size=n),
+    })
+    idx = SimilarityIndex(df, ["a", "b"])
+    assert len(idx) == n, "tamaño"
+
+    # IVF (nprobe por defecto) vs. búsqueda exacta (todas las listas): recall@10 con empates
+    # (un vecino aproximado cuenta si alcanza la 10ª similitud exacta)
+    recall = []
+    for i in rng.choice(n, min(n, 200), replace=False):
+        q = idx.vector(i)
+        _, approx = idx.search(q, 10, exclude=i)
+        _, sims = idx.search(q, 10, nprobe=len(idx.centroids), exclude=i)
+        assert np.allclose(sims, np.sort(idx.E[idx.ids != i] @ q)[::-1][:10], atol=1e-5), "exacta"
+        recall.append(float(np.mean(approx >= sims[-1] - 1e-6)))
+    assert np.mean(recall) >= 0.9, f"recall@10 {np.mean(recall):.3f}"
+
+    # Incremental == embedding con el mismo embedder; ids borrados desaparecen
+    df2 = df.iloc[1:].copy()
+    df2.loc[df2.index[:5], "descripcion"] = "embargo urgente"
+    assert idx.update(df2), "update"
+    assert idx.vector(0) is None and len(idx) == n - 1, "borrado"
+    row = df2.iloc[[0]]
+    assert np.allclose(idx.vector(int(row["id_plazo"].iloc[0])), idx.embedder.transform(row)[0]), "delta"
+    ids, _ = idx.search(idx.vector(int(row["id_plazo"].iloc[0])), 10, nprobe=len(idx.centroids))
+    assert 0 not in ids and len(set(ids)) == len(ids), "sin ocultos ni duplicados"
+
+
+def _ref_regression(X: pd.DataFrame, y: pd.Series):
+    """Pipeline original de /ml/regresion (imputer + scaler + LinearRegression)."""
+    from sklearn.impute import SimpleImputer
+    from sklearn.linear_model import LinearRegression
+    from sklearn.pipeline import Pipeline
+    from sklearn.preprocessing import StandardScaler
+
+    return Pipeline(steps=[
+        ("imputer", SimpleImputer(strategy="median")),
+        ("scaler", StandardScaler(with_mean=True, with_std=True)),
+        ("reg", LinearRegression()),
+    ]).fit(X, y)
+
+
+def check_online_ols(n: int) -> None:
+    from sklearn.metrics import mean_absolute_error
+    from app.online_ols import OnlineOLS
+
+    rng = np.random.default_rng(5)
+    feats = ["a", "b", "c", "const"]
+
+    def frame(ids: np.ndarray) -> pd.DataFrame:
+        df = pd.DataFrame({
+            "id": ids,
+            "a": rng.normal(50, 10, len(ids)),
+            "b": rng.exponential(3, len(ids)),
+            "c": rng.integers(0, 2, len(ids)).astype(float),
+            "const": 7.0,
+        })
+        df.loc[rng.random(len(ids)) < 0.1, "a"] = np.nan  # faltantes -> mediana
+        df["y"] = 2 * df["a"].fillna(50) - 3 * df["b"] + df["c"] + rng.normal(0, 1, len(ids))
+        return df
+
+    def same(eng: OnlineOLS, df: pd.DataFrame, what: str) -> None:
+        ref = _ref_regression(df[feats], df["y"])
+        fit = eng.fit()
+        assert np.allclose(fit.coef, ref.named_steps["reg"].coef_, rtol=1e-6, atol=1e-8), f"coef {what}"
+        assert np.isclose(fit.intercept, ref.named_steps["reg"].intercept_, rtol=1e-9), f"intercept {what}"
+        assert np.allclose(fit.predict(df[feats].to_numpy()), ref.predict(df[feats]), rtol=1e-7, atol=1e-6), \
+            f"predict {what}"
+        # Cada fold == pipeline reentrenado sin las filas del fold
+        cv = eng.cross_validate()
+        for f in range(eng.splits):
+            X_test, y_test = eng.test_rows(f)
+            train = eng.alive & (eng.fold != f)
+            X_tr = pd.DataFrame(np.where(eng.M[train], np.nan, eng.O[train] + eng.shift), columns=feats)
+            ref_f = _ref_regression(X_tr, eng.y[train] + eng.y_shift)
+            got = mean_absolute_error(y_test, ref_f.predict(pd.DataFrame(X_test, columns=feats)))
+            assert np.isclose(cv["mae"][f], got, rtol=1e-7), f"mae fold {f} {what}"
+        assert len(eng) == len(df), f"filas vivas {what}"
+
+    df = frame(np.arange(n))
+    eng = OnlineOLS(df, feats, "y", "id", 5)
+    same(eng, df, "inicial")
+
+    # Snapshot nuevo: borrados, cambiados y nuevos -> actualización incremental
+    k = max(1, n // 50)
+    df2 = pd.concat([df.iloc[k:], frame(np.arange(n, n + k))], ignore_index=True)
+    changed = frame(df2["id"].iloc[:k].to_numpy())
+    df2.iloc[:k] = changed.to_numpy()
+    inc = eng.clone()
+    assert inc.update(df2) and inc.last["modo"] == "incremental", "update"
+    assert len(eng) == n and eng.fit().coef is not None, "la copia no toca el original"
+    same(inc, df2, "incremental")
+
+
+def check_scored_filters(n: int) -> None:
+    from app.scored import DOCS_FILTER_COLUMNS, ScoredFrame, parse_filtros, top_positions
+
+    rng = np.random.default_rng(4)
+    nombres = pd.Categorical(rng.choice(["Ana Pérez", "Luis Gómez", "PEREZ Hnos", "Marta Ruiz"], n))
+    fv = pd.Timestamp("2025-01-01") + pd.to_timedelta(rng.integers(0, 365 * 24, n), unit="h")
+    df = pd.DataFrame({
+        "expediente_id": rng.integers(1, max(2, n // 10), n).astype("int32"),
+        "id_cliente": pd.array(np.where(rng.random(n) < 0.05, np.nan, rng.integers(1, 50, n)), dtype="Int32"),
+        "cliente_nombre": nombres,
+        "fecha_vencimiento": pd.Series(fv).where(rng.random(n) > 0.05),
+    })
+    sf = ScoredFrame(df)
+
+    # Índices vs. máscaras booleanas sobre el DataFrame
+    cases = [
+        ({"expediente_id": 3}, df["expediente_id"] == 3),
+        ({"id_cliente": 7}, df["id_cliente"].eq(7).fillna(False)),
+        ({"cliente": "perez"}, df["cliente_nombre"].astype(str).str.lower().str.contains("perez")),
+        ({"vence_desde": "2025-03-01", "vence_hasta": "2025-03-31"},
+         (df["fecha_vencimiento"] >= "2025-03-01") & (df["fecha_vencimiento"] < "2025-04-01")),
+        ({"id_cliente": 7, "vence_hasta": "2025-06-30", "cliente": "ana"},
+         df["id_cliente"].eq(7).fillna(False) & (df["fecha_vencimiento"] < "2025-07-01")
+         & df["cliente_nombre"].astype(str).str.lower().str.contains("ana")),
+        ({"expediente_id": -1}, pd.Series(False, index=df.index)),
+    ]
+    for params, mask in cases:
+        got = sf.select(parse_filtros(**params))
+        assert np.array_equal(got, np.flatnonzero(mask.to_numpy())), f"select {params}"
+    assert sf.select(parse_filtros()) is None, "sin filtros"
+
+    # Columnas de documentos: expediente_id -> id_expediente
+    docs = ScoredFrame(df.rename(columns={"expediente_id": "id_expediente"}), filter_columns=DOCS_FILTER_COLUMNS)
+    assert np.array_equal(docs.select({"expediente_id": 3}), np.flatnonzero(df["expediente_id"] == 3)), "docs"
+
+    # top_positions == orden estable descendente sobre las filas filtradas
+    score = rng.integers(0, 20, n).astype(float)
+    pos = sf.select(parse_filtros(cliente="perez"))
+    ref = np.flatnonzero(df["cliente_nombre"].astype(str).str.lower().str.contains("perez"))
+    ref = ref[np.argsort(-score[ref], kind="stable")][:25]
+    assert np.array_equal(top_positions(score, pos, 25), ref), "top filtrado"
+    assert np.array_equal(top_positions(score, None, 25), np.argsort(-score, kind="stable")[:25]), "top"
+
+
+def check_paged_fetch(n: int) -> None:
+    from fastapi.testclient import TestClient
+
+    from app import clients
+    from .stub_upstreams import StubConfig, create_stub_app
+
+    size = max(10, n // 4)
+    # Upstream que topa el tamaño de página (primera página corta con total_pages > 1) y uno que no
+    for label, cap in (("tope", size // 3), ("sin_tope", 0)):
+        stub = TestClient(create_stub_app(StubConfig(plazos=n, docs=1, max_page_size=cap)))
+        expected = stub.get("/plazos").json()["data"]
+
+        def get_json(url, timeout, params=None):
+            r = stub.get(url.replace("http://stub", ""), params=params)
+            r.raise_for_status()
+            return r.json()
+
+        saved = clients._get_json, clients.UPSTREAM_PAGE_SIZE, clients._SOURCES
+        clients._get_json, clients.UPSTREAM_PAGE_SIZE = get_json, size
+        clients._SOURCES = {**clients._SOURCES, "plazos": ("http://stub/plazos", 5.0, "page")}
+        try:
+            pages = clients._fetch_pages("plazos", lambda items: items)
+        finally:
+            clients._get_json, clients.UPSTREAM_PAGE_SIZE, clients._SOURCES = saved
+        got = [item for page in pages for item in page]
+        assert got == expected, f"{label}: {len(got)} de {len(expected)} filas"
+
+
+CHECKS: Dict[str, Callable[[int], None]] = {
+    "aggregate_docs": check_aggregate_docs,
+    "doc_timeline": check_doc_timeline,
+    "feature_matrix": check_feature_matrix,
+    "large_n": check_large_n,
+    "online_ols": check_online_ols,
+    "paged_fetch": check_paged_fetch,
+    "scored_filters": check_scored_filters,
+    "similarity_index": check_similarity_index,
+    "top_k_reasons": check_top_k_reasons,
+    "train_labels": check_train_labels,
+}
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    ap = argparse.ArgumentParser(description="Paridad optimizado vs. referencia")
+    ap.add_argument("--only", nargs="*", default=None, help="nombres de comprobaciones")
+    ap.add_argument("--sizes", nargs="*", type=int, default=[1_000, 10_000])
+    args = ap.parse_args(argv)
+
+    failed = 0
+    for name, check in CHECKS.items():
+        if args.only and name not in args.only:
+            continue
+        for n in args.sizes:
+            t0 = time.perf_counter()
+            try:
+                check(n)
+                status = "ok"
+            except AssertionError as exc:
+                failed += 1
+                status = f"FALLA: {exc}"
+            print(f"{name:<28} n={n:<9} {time.perf_counter() - t0:7.2f}s  {status}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
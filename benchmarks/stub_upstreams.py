@@ -0,0 +1,108 @@
+# benchmarks/stub_upstreams.py
+"""
+Servidor local que imita los upstreams (/plazos y /admin/documentos) con
+payloads sintéticos, latencia, jitter y tasa de error configurables.
+
+Con ?page=N&limit=M (PLAZOS_PAGINATION/DOCS_PAGINATION=page) responde esa
+página como {"data": [...], "meta": {"page", "total_pages", "total"}}.
+--max-page-size topa el tamaño de página por debajo del pedido, como hacen
+algunos upstreams (total_pages se calcula con el tamaño efectivo).
+
+Uso:
+    python -m benchmarks.stub_upstreams --plazos 10000 --docs 20000 \
+        --latency-ms 120 --jitter-ms 40 --error-rate 0.01 --port 9100
+
+y luego apuntar el servicio al stub:
+    PLAZOS_ENDPOINT=http://127.0.0.1:9100/plazos
+    DOCS_ENDPOINT=http://127.0.0.1:9100/admin/documentos
+"""
+from typing import Optional
+from dataclasses import dataclass
+import argparse
+import asyncio
+import json
+import random
+
+from fastapi import FastAPI, Query, Response
+
+from .synthetic import make_docs_payload, make_plazos_payload
+
+
+@dataclass
+class StubConfig:
+    plazos: int = 1_000
+    docs: int = 2_000
+    latency_ms: float = 0.0
+    jitter_ms: float = 0.0
+    error_rate: float = 0.0
+    max_page_size: int = 0   # 0 = sin tope
+    seed: int = 0
+
+
+def create_stub_app(cfg: StubConfig) -> FastAPI:
+    """App con los payloads pre-serializados (el stub no debe ser el cuello de botella)."""
+    plazos_items = make_plazos_payload(cfg.plazos, seed=cfg.seed)["data"]
+    docs_items = make_docs_payload(cfg.docs, seed=cfg.seed, n_expedientes=max(1, cfg.plazos // 8))
+    plazos_body = json.dumps({"data": plazos_items}).encode()
+    docs_body = json.dumps(docs_items).encode()
+    rng = random.Random(cfg.seed)
+    stats = {"plazos": 0, "docs": 0, "errors": 0}
+
+    app = FastAPI(title="Stub upstreams (plazos/documentos)")
+
+    def _page(items: list, page: int, limit: int) -> bytes:
+        size = min(limit, cfg.max_page_size) if cfg.max_page_size > 0 else limit
+        start = (page - 1) * size
+        return json.dumps({
+            "data": items[start:start + size],
+            "meta": {"page": page, "total_pages": max(1, -(-len(items) // size)), "total": len(items)},
+        }).encode()
+
+    async def _serve(name: str, body: bytes) -> Response:
+        stats[name] += 1
+        delay = cfg.latency_ms + (rng.uniform(-cfg.jitter_ms, cfg.jitter_ms) if cfg.jitter_ms else 0.0)
+        if delay > 0:
+            await asyncio.sleep(delay / 1000.0)
+        if cfg.error_rate and rng.random() < cfg.error_rate:
+            stats["errors"] += 1
+            return Response(content=b'{"detail":"stub error"}', status_code=503, media_type="application/json")
+        return Response(content=body, media_type="application/json")
+
+    @app.get("/plazos")
+    async def plazos(page: Optional[int] = Query(None, ge=1), limit: int = Query(1000, ge=1)):
+        return await _serve("plazos", plazos_body if page is None else _page(plazos_items, page, limit))
+
+    @app.get("/admin/documentos")
+    async def documentos(page: Optional[int] = Query(None, ge=1), limit: int = Query(1000, ge=1)):
+        return await _serve("docs", docs_body if page is None else _page(docs_items, page, limit))
+
+    @app.get("/_stats")
+    async def _stats():
+        return {**stats, "config": cfg.__dict__}
+
+    return app
+
+
+def main(argv: Optional[list] = None) -> None:
+    import uvicorn
+
+    ap = argparse.ArgumentParser(description="Stub de upstreams para pruebas de carga")
+    ap.add_argument("--plazos", type=int, default=1_000, help="Filas de /plazos")
+    ap.add_argument("--docs", type=int, default=2_000, help="Filas de /admin/documentos")
+    ap.add_argument("--latency-ms", type=float, default=0.0)
+    ap.add_argument("--jitter-ms", type=float, default=0.0)
+    ap.add_argument("--error-rate", type=float, default=0.0, help="Proporción de respuestas 503 (0-1)")
+    ap.add_argument("--max-page-size", type=int, default=0, help="Tope del tamaño de página (0 = el pedido)")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=9100)
+    args = ap.parse_args(argv)
+
+    cfg = StubConfig(plazos=args.plazos, docs=args.docs, latency_ms=args.latency_ms,
+                     jitter_ms=args.jitter_ms, error_rate=args.error_rate,
+                     max_page_size=args.max_page_size, seed=args.seed)
+    uvicorn.run(create_stub_app(cfg), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+# benchmarks/synthetic.py
+"""
+Generadores deterministas de payloads sintéticos con la misma forma que
+devuelven los upstreams reales:
+
+- /plazos            -> {"data": [ {id_plazo, descripcion, fecha_vencimiento,
+                          cumplido, fecha_cumplimiento, expediente: {id_expediente,
+                          estado, titulo, cliente: {nombre_completo}}} ]}
+- /admin/documentos  -> [ {doc_id|_id, filename (URL-encoded), size, id_cliente,
+                          id_expediente, created_at} ]
+
+Misma (n, seed, anchor) => mismo payload.
+"""
+from typing import Any, Dict, List, Optional
+from urllib.parse import quote
+import random
+
+import pandas as pd
+
+SIZES = (1_000, 10_000, 100_000, 1_000_000)
+
+_VERBOS = ["Presentar", "Contestar", "Apelar", "Notificar", "Adjuntar", "Revisar", "Subsanar", "Audiencia de"]
+_OBJETOS = ["memorial", "demanda", "recurso", "pruebas", "alegatos", "informe pericial",
+            "observaciones", "excepciones", "conciliación", "testigos"]
+_ESTADOS = ["ABIERTO", "abierto", "CERRADO", "ARCHIVADO", "En trámite"]
+_NOMBRES = ["Ana", "Luis", "María", "Carlos", "Lucía", "Jorge", "Sofía", "Diego"]
+_APELLIDOS = ["Pérez", "Gómez", "Rojas", "Vargas", "Flores", "Mendoza", "Suárez"]
+_DOC_BASE = ["Escrito de demanda", "Poder notarial", "Contrato", "Informe pericial",
+             "Acta de audiencia", "Resolución", "Notificación", "Anexo"]
+_EXTS = ["pdf", "pdf", "pdf", "docx", "jpg", "png", "xlsx", ""]
+
+
+def _iso(ts: pd.Timestamp) -> str:
+    # Mismo formato que el backend (UTC con 'Z')
+    return ts.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def _anchor(anchor: Optional[pd.Timestamp]) -> pd.Timestamp:
+    return pd.Timestamp(anchor).normalize() if anchor is not None else pd.Timestamp.now().normalize()
+
+
+def n_expedientes_for(n_rows: int) -> int:
+    """Cantidad de expedientes razonable para n filas (~8 plazos por expediente)."""
+    return max(1, n_rows // 8)
+
+
+def make_expedientes(n_expedientes: int, seed: int = 0) -> List[Dict[str, Any]]:
+    rng = random.Random(seed)
+    n_clientes = max(1, n_expedientes // 3)
+    clientes = [
+        {"id_cliente": i + 1, "nombre_completo": f"{rng.choice(_NOMBRES)} {rng.choice(_APELLIDOS)} {i + 1}"}
+        for i in range(n_clientes)
+    ]
+    expedientes = []
+    for i in range(n_expedientes):
+        cliente = clientes[rng.randrange(n_clientes)]
+        expedientes.append({
+            "id_expediente": i + 1,
+            "estado": rng.choice(_ESTADOS),
+            "titulo": f"Expediente {i + 1} - {rng.choice(_OBJETOS)}",
+            "cliente": cliente,
+        })
+    return expedientes
+
+
+def make_plazos_payload(
+    n: int,
+    seed: int = 0,
+    anchor: Optional[pd.Timestamp] = None,
+    n_expedientes: Optional[int] = None,
+) -> Dict[str, Any]:
+    """Payload de /plazos con n filas. Los expedientes anidados se comparten entre plazos."""
+    rng = random.Random(seed)
+    today = _anchor(anchor)
+    expedientes = make_expedientes(n_expedientes or n_expedientes_for(n), seed=seed)
+    data = []
+    for i in range(n):
+        exp = expedientes[rng.randrange(len(expedientes))]
+        venc = today + pd.Timedelta(days=rng.randint(-120, 90), hours=rng.choice([0, 4, 23]))
+        cumplido = rng.random() < 0.55
+        fecha_cumpl = None
+        if cumplido:
+            # mayoría a tiempo, algunos tarde
+            fecha_cumpl = _iso(venc + pd.Timedelta(days=rng.randint(-10, 6)))
+        data.append({
+            "id_plazo": i + 1,
+            "descripcion": f"{rng.choice(_VERBOS)} {rng.choice(_OBJETOS)} {rng.choice(_OBJETOS)}"
+                           if rng.random() > 0.02 else None,
+            "fecha_vencimiento": _iso(venc) if rng.random() > 0.01 else None,
+            "cumplido": cumplido,
+            "fecha_cumplimiento": fecha_cumpl,
+            "expediente": exp if rng.random() > 0.01 else None,
+        })
+    return {"data": data}
+
+
+def make_docs_payload(
+    n: int,
+    seed: int = 0,
+    anchor: Optional[pd.Timestamp] = None,
+    n_expedientes: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    """Lista de /admin/documentos con n filas, nombres URL-encoded y fechas ISO con 'Z'."""
+    rng = random.Random(seed + 1)
+    today = _anchor(anchor)
+    n_exp = n_expedientes or n_expedientes_for(n)
+    docs = []
+    for i in range(n):
+        id_exp = rng.randint(1, n_exp)
+        ext = rng.choice(_EXTS)
+        name = f"{rng.choice(_DOC_BASE)} {id_exp}-{i}"
+        if ext:
+            name = f"{name}.{ext.upper() if rng.random() < 0.1 else ext}"
+        created = today - pd.Timedelta(days=rng.randint(0, 400), seconds=rng.randint(0, 86_399))
+        doc = {
+            "filename": quote(name),
+            "size": int(rng.lognormvariate(12, 1.2)),
+            "id_cliente": max(1, id_exp // 3),
+            "id_expediente": id_exp,
+            "created_at": _iso(created),
+        }
+        # Ambos nombres de id aparecen en producción (Mongo expone _id)
+        doc["doc_id" if i % 2 == 0 else "_id"] = f"{i:024x}"
+        docs.append(doc)
+    return docs